@@ -0,0 +1,453 @@
+# Building and uploading CouchDB design documents from a "couchapp"
+# directory without running the external `couchapp` program.
+#
+# The layout follows the convention used by the couchapp tool:
+#
+#   - Each directory becomes a JSON object and each file becomes a
+#     property of that object, named after the file with its
+#     extension removed e.g. `views/branches/map.js` is stored at
+#     `doc["views"]["branches"]["map"]`.
+#
+#   - Files ending in `.json` are parsed, other files are stored as
+#     (stripped) text.
+#
+#   - `_attachments/` holds the attachments and so does each
+#     `vendor/NAME/_attachments/`, under the `vendor/NAME/` prefix.
+#
+#   - `couchapp.json` becomes the `couchapp` property and `_id`, if
+#     present, names the document.  Other names starting with an
+#     underscore at the top level, and all dotfiles such as
+#     `.couchapprc`, are ignored.  So is anything matching a regular
+#     expression in `.couchappignore`.
+#
+# Re-uploading all of the attachments on every deploy is the expensive
+# part so the MD5 digest of each attachment is computed locally and
+# recorded in the design document, under `couchapp_digests`, to be
+# compared on the next deploy.  The digest that CouchDB reports is no
+# good for this as it may be of the compressed data that CouchDB
+# stores.  Unchanged attachments are sent as stubs and only changed
+# attachments are sent inline.
+#
+# The files can also come straight from the `git-tree` and `git-blob`
+# documents written by gitcouchdbsync.py, without touching the local
+# disk.  Then the git blob id of each attachment is recorded in the
+# design document, under `couchapp_git_blob_ids`, and an attachment
+# whose blob id has not changed is reused without even being fetched.
+#
+# Pages listed under `bundle_pages` in `couchapp.json` have their
+# scripts and stylesheets bundled, see below.
+
+from __future__ import with_statement
+
+from collections import namedtuple
+from couchdblib import get, put_update, file_md5, iter_docs
+import base64
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+
+### Sources
+#
+# The builder reads through a small "source" interface so that the
+# files need not be on a local filesystem.  A source lists a directory
+# as `(name, is_dir)` pairs, reads a file's bytes and describes an
+# attachment.  Paths are relative and `/` separated with `""` being
+# the root.  An attachment has a `digest`, a git `blob_id` or both.
+Attachment = namedtuple("Attachment", 
+                        ["content_type", "digest", "read", "blob_id"])
+Attachment.__new__.__defaults__ = (None,)
+
+def guess_content_type(name):
+    content_type, encoding = mimetypes.guess_type(name)
+    if content_type is None:
+        content_type = "application/octet-stream"
+    return content_type
+
+def join_path(*parts):
+    return "/".join(p for p in parts if p != "")
+
+class FilesystemSource(object):
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _local_path(self, path):
+        if path == "":
+            return self.root
+        return os.path.join(self.root, *path.split("/"))
+
+    def listdir(self, path):
+        local_path = self._local_path(path)
+        return [(name, os.path.isdir(os.path.join(local_path, name)))
+                for name in sorted(os.listdir(local_path))]
+
+    def exists(self, path):
+        return os.path.exists(self._local_path(path))
+
+    def read(self, path):
+        with open(self._local_path(path), "rb") as fh:
+            return fh.read()
+
+    def attachment(self, path):
+        with open(self._local_path(path), "rb") as fh:
+            digest = "md5-" + file_md5(fh)
+        return Attachment(guess_content_type(path), digest,
+                          lambda: self.read(path))
+
+# A GitTreeSource reads the tree documents a level at a time, as
+# selfcouchapp.tree_to_fs does, and the blobs of all the files that
+# become document fields along with them.  Attachment blobs are only
+# fetched when `prefetch()` is asked for them, in bulk, or else one
+# at a time when read.  Attachments that did not come from a blob,
+# such as a bundled page, are left alone by `prefetch()`.
+def blob_to_data(blob_data):
+    if blob_data["encoding"] == "raw":
+        return blob_data["raw"].encode("utf-8")
+    elif blob_data["encoding"] == "base64":
+        return base64.b64decode(blob_data["base64"])
+    else:
+        raise NotImplementedError(blob_data)
+
+def is_attachment_path(path):
+    parts = path.split("/")
+    return (parts[0] == "_attachments" 
+            or (parts[0] == "vendor" and parts[2:3] == ["_attachments"]))
+
+class GitTreeSource(object):
+
+    def __init__(self, git_couchdb_url, tree_id):
+        self.git_couchdb_url = git_couchdb_url
+        self.listings = {}
+        self.blob_ids = {}
+        self.blobs = {}
+        pending = {tree_id: [""]}
+        while len(pending) > 0:
+            level = pending
+            pending = {}
+            for doc_id, document in iter_docs(git_couchdb_url, 
+                                              sorted(level)):
+                if document["type"] == "git-blob":
+                    self.blobs[doc_id] = blob_to_data(document)
+                    continue
+                assert document["type"] == "git-tree", document
+                for path in level[doc_id]:
+                    self._add_tree(path, document, pending)
+
+    def _add_tree(self, path, document, pending):
+        listing = self.listings[path] = []
+        for entry in document["children"]:
+            child_path = join_path(path, entry["basename"])
+            child_id = entry["child"]["_id"]
+            if entry["child"]["type"] == "git-tree":
+                listing.append((entry["basename"], True))
+                pending.setdefault(child_id, []).append(child_path)
+            elif entry["child"]["type"] == "git-blob":
+                listing.append((entry["basename"], False))
+                self.blob_ids[child_path] = child_id
+                if not is_attachment_path(child_path):
+                    pending.setdefault(child_id, []).append(child_path)
+            else:
+                raise NotImplementedError(entry)
+        listing.sort()
+
+    def listdir(self, path):
+        return self.listings[path]
+
+    def exists(self, path):
+        return path in self.listings or path in self.blob_ids
+
+    def _blob(self, blob_id):
+        if blob_id not in self.blobs:
+            self.blobs[blob_id] = blob_to_data(
+                get(posixpath.join(self.git_couchdb_url, blob_id)))
+        return self.blobs[blob_id]
+
+    def read(self, path):
+        return self._blob(self.blob_ids[path])
+
+    def attachment(self, path):
+        blob_id = self.blob_ids[path]
+        return Attachment(guess_content_type(path), None,
+                          lambda: self._blob(blob_id), blob_id)
+
+    def prefetch(self, attachments):
+        blob_ids = set(a.blob_id for a in attachments 
+                       if a.blob_id is not None) - set(self.blobs)
+        for doc_id, document in iter_docs(self.git_couchdb_url, 
+                                          sorted(blob_ids)):
+            self.blobs[doc_id] = blob_to_data(document)
+
+### Building the document
+def parse_ignores(text):
+    text = re.sub(r"(?m)^\s*//.*$", "", text)
+    return [re.compile(p) for p in json.loads(text)]
+
+def file_to_value(name, data):
+    if name.endswith(".json"):
+        return json.loads(data)
+    try:
+        return data.decode("utf-8").strip()
+    except UnicodeDecodeError:
+        return "base64-encoded;%s" % (base64.b64encode(data),)
+
+def dir_to_fields(source, path, ignores, depth=0):
+    fields = {}
+    for name, is_dir in source.listdir(path):
+        child_path = join_path(path, name)
+        if name.startswith("."):
+            continue
+        elif any(p.match(name) for p in ignores):
+            continue
+        elif name == "_attachments" or (depth == 0 and name.startswith("_")):
+            continue
+        elif depth == 0 and name == "couchapp.json":
+            content = json.loads(source.read(child_path))
+            if not isinstance(content, dict):
+                content = {"meta": content}
+            fields.setdefault("couchapp", {}).update(content)
+        elif is_dir:
+            fields[name] = dir_to_fields(source, child_path, ignores,
+                                         depth + 1)
+        else:
+            key = os.path.splitext(name)[0]
+            if key in fields:
+                raise Exception("Duplicate property %r from %r"
+                                % (key, child_path))
+            fields[key] = file_to_value(name, source.read(child_path))
+    return fields
+
+def collect_attachments(source, path, prefix, ignores, result):
+    for name, is_dir in source.listdir(path):
+        if name.startswith(".") or any(p.match(name) for p in ignores):
+            continue
+        child_path = join_path(path, name)
+        if is_dir:
+            collect_attachments(source, child_path, prefix + name + "/",
+                                ignores, result)
+        else:
+            result[prefix + name] = source.attachment(child_path)
+    return result
+
+def build_design_doc(source):
+    ignores = []
+    if source.exists(".couchappignore"):
+        ignores = parse_ignores(source.read(".couchappignore"))
+    doc = dir_to_fields(source, "", ignores)
+    if source.exists("_id"):
+        doc["_id"] = source.read("_id").strip()
+    attachments = {}
+    if source.exists("_attachments"):
+        collect_attachments(source, "_attachments", "", ignores,
+                            attachments)
+    if source.exists("vendor"):
+        for name, is_dir in source.listdir("vendor"):
+            vendor_attachments = join_path("vendor", name, "_attachments")
+            if is_dir and source.exists(vendor_attachments):
+                collect_attachments(source, vendor_attachments,
+                                    "vendor/%s/" % (name,), ignores,
+                                    attachments)
+    pages = doc.get("couchapp", {}).get("bundle_pages", [])
+    if len(pages) > 0:
+        bundle_pages(doc, attachments, pages, 
+                     getattr(source, "prefetch", None))
+    return doc, attachments
+
+### Bundling
+#
+# The local scripts and stylesheets that a page loads from `/static/`
+# are each concatenated, in order, into one bundle named after its
+# content, such as `bundle-0123456789abcdef.js`, and the page is
+# rewritten to load the bundles instead.  The bundles are stored under
+# `bundles` in the design document so that a show function can serve
+# them with far-future caching headers, which attachments cannot have.
+# A `.min.js` or `-min.js` version of a script is used where there is
+# one.  Stylesheets are minified here, with their `url()`s made
+# absolute, but scripts are not.
+STATIC_PREFIX = "/static/"
+BUNDLE_PREFIX = "/bundle/"
+SCRIPT_TAG = re.compile(r'([ \t]*)<script src="/static/([^"]+\.js)"></script>'
+                        r'(\r?\n)?')
+STYLESHEET_TAG = re.compile(r'([ \t]*)<link\b[^>]*?\bhref="/static/'
+                            r'([^"]+\.css)"[^>]*>(\r?\n)?')
+CSS_URL = re.compile(r'url\((["\']?)([^"\')]+)\1\)')
+CSS_TOKEN = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|url\([^)]*\))'
+                       r'|/\*.*?\*/', re.S)
+
+def minified_name(name, attachments):
+    if name.endswith(".js") and not re.search(r"[.-]min\.js$", name):
+        for suffix in (".min.js", "-min.js"):
+            candidate = name[:-len(".js")] + suffix
+            if candidate in attachments:
+                return candidate
+    return name
+
+def absolute_css_urls(css, name):
+    def absolute(match):
+        url = match.group(2)
+        if url.startswith("/") or re.match(r"^[a-z]+:", url):
+            return match.group(0)
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(name), 
+                                                 url))
+        return 'url("%s%s")' % (STATIC_PREFIX, path)
+    return CSS_URL.sub(absolute, css)
+
+def squash_css(css):
+    css = re.sub(r"\s+", " ", css)
+    return re.sub(r" ?([{};,]) ?", r"\1", css)
+
+# Strings and `url()`s are kept as they are and comments are dropped;
+# only the whitespace between them is squashed.
+def minify_css(css):
+    parts = []
+    position = 0
+    for match in CSS_TOKEN.finditer(css):
+        parts.append(squash_css(css[position:match.start()]))
+        if match.group(1) is not None:
+            parts.append(match.group(1))
+        position = match.end()
+    parts.append(squash_css(css[position:]))
+    return "".join(parts).strip()
+
+def bundle_tags(html, tag_re, make_tag, read_bundle):
+    names = [m.group(2) for m in tag_re.finditer(html)]
+    if len(names) == 0:
+        return html
+    bundle_url = BUNDLE_PREFIX + read_bundle(names)
+    first = []
+    def replace(match):
+        if len(first) > 0:
+            return ""
+        first.append(match)
+        return match.group(1) + make_tag(bundle_url) + (match.group(3) or "")
+    return tag_re.sub(replace, html)
+
+def bundled_names(html, attachments):
+    names = set(minified_name(m.group(2), attachments) 
+                for m in SCRIPT_TAG.finditer(html))
+    names.update(m.group(2) for m in STYLESHEET_TAG.finditer(html))
+    return names
+
+# Only the pages, and then the scripts and stylesheets that they load,
+# are prefetched.
+def bundle_pages(doc, attachments, pages, prefetch=None):
+    bundles = doc.setdefault("bundles", {})
+    if prefetch is not None:
+        prefetch([attachments[p] for p in pages])
+        names = set()
+        for page in pages:
+            names.update(bundled_names(attachments[page].read(), 
+                                       attachments))
+        prefetch([attachments[n] for n in sorted(names)])
+    def read(name):
+        return attachments[name].read().decode("utf-8")
+    def add_bundle(data, extension, content_type):
+        name = "bundle-%s%s" % (
+            hashlib.sha1(data.encode("utf-8")).hexdigest()[:16], extension)
+        bundles[name] = {"content_type": content_type, "data": data}
+        return name
+    def read_scripts(names):
+        scripts = [read(minified_name(n, attachments)) for n in names]
+        return add_bundle(u"\n;\n".join(scripts), ".js", 
+                          "application/javascript")
+    def read_stylesheets(names):
+        css = u"\n".join(absolute_css_urls(read(n), n) for n in names)
+        return add_bundle(minify_css(css), ".css", "text/css")
+    for page in pages:
+        html = attachments[page].read()
+        html = bundle_tags(html, SCRIPT_TAG, 
+                           lambda u: '<script src="%s"></script>' % (u,),
+                           read_scripts)
+        html = bundle_tags(html, STYLESHEET_TAG, 
+                           lambda u: '<link href="%s" rel="stylesheet">' 
+                           % (u,), read_stylesheets)
+        digest = "md5-" + base64.b64encode(hashlib.md5(html).digest())
+        attachments[page] = Attachment(attachments[page].content_type, 
+                                       digest, lambda html=html: html)
+
+### Uploading the document
+#
+# The document is replaced wholesale apart from attachments whose
+# recorded digest (or git blob id) and content type are unchanged,
+# which are kept as stubs.  If nothing has changed at all then no new
+# revision is written.
+def is_same_attachment(existing, name, attachment):
+    old = existing.get("_attachments", {}).get(name)
+    if old is None or old.get("content_type") != attachment.content_type:
+        return False
+    if attachment.digest is not None:
+        old_digests = existing.get("couchapp_digests", {})
+        return old_digests.get(name) == attachment.digest
+    old_blob_ids = existing.get("couchapp_git_blob_ids", {})
+    return old_blob_ids.get(name) == attachment.blob_id
+
+def add_source_ids(doc, attachments):
+    for field, attr in (("couchapp_digests", "digest"), 
+                        ("couchapp_git_blob_ids", "blob_id")):
+        ids = dict((name, getattr(a, attr)) 
+                   for (name, a) in attachments.items()
+                   if getattr(a, attr) is not None)
+        if len(ids) > 0:
+            doc = dict(doc, **{field: ids})
+    return doc
+
+def merge_attachments(existing, attachments):
+    existing_attachments = existing.get("_attachments", {})
+    merged = {}
+    changed = []
+    for name, attachment in sorted(attachments.items()):
+        if is_same_attachment(existing, name, attachment):
+            merged[name] = existing_attachments[name]
+        else:
+            merged[name] = {"content_type": attachment.content_type,
+                            "data": base64.b64encode(attachment.read())}
+            changed.append(name)
+    return merged, changed
+
+def is_unchanged(existing, doc, attachments):
+    if existing.get("error") is not None:
+        return False
+    existing_fields = dict((k, v) for (k, v) in existing.items()
+                           if k not in ("_id", "_rev", "_attachments"))
+    if existing_fields != doc:
+        return False
+    if set(existing.get("_attachments", {})) != set(attachments):
+        return False
+    for name, attachment in attachments.items():
+        if not is_same_attachment(existing, name, attachment):
+            return False
+    return True
+
+# A `prefetch` function, such as GitTreeSource.prefetch, is given the
+# attachments that look like they will need uploading so that it can
+# fetch them all at once.
+def push_design_doc(url, doc, attachments, prefetch=None):
+    doc = dict((k, v) for (k, v) in doc.items() if k != "_id")
+    doc = add_source_ids(doc, attachments)
+    existing = get(url)
+    if is_unchanged(existing, doc, attachments):
+        return []
+    if prefetch is not None:
+        prefetch([a for (name, a) in sorted(attachments.items())
+                  if not is_same_attachment(existing, name, a)])
+    uploaded = []
+    def update(existing):
+        new_doc = dict(doc)
+        new_doc["_attachments"], changed = merge_attachments(existing,
+                                                             attachments)
+        uploaded[:] = changed
+        return new_doc
+    put_update(url, update)
+    return uploaded
+
+def push_couchapp(url, local_path):
+    doc, attachments = build_design_doc(FilesystemSource(local_path))
+    return push_design_doc(url, doc, attachments)
+
+def push_git_tree(url, git_couchdb_url, tree_id, extra_fields={}):
+    source = GitTreeSource(git_couchdb_url, tree_id)
+    doc, attachments = build_design_doc(source)
+    doc.update(extra_fields)
+    return push_design_doc(url, doc, attachments, source.prefetch)
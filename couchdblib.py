@@ -4,16 +4,26 @@
 
 from __future__ import with_statement
 
+from collections import namedtuple, OrderedDict
 from jwalutil import StringIO
 from pprint import pformat
-from process import call
+import atexit
+import base64
 import contextlib
+import hashlib
 import json
 import os
 import posixpath
 import pycurl as curl
+import random
+import re
+import sys
+import threading
+import time
 import urllib
+import urlparse
 import uuid
+import zlib
 
 ### URL quoting
 # The default safe characters in the standard library's
@@ -22,33 +32,411 @@ import uuid
 def url_quote(part):
     return urllib.quote(part, safe="")
 
-### Simple document fetching
-# 
-# Allows normal size documents to be fetched using a single line
-# function call.  Assumes that the return document is JSON.
-def get(url):
+### Request tracing
+#
+# When a deploy or a sync is slow it helps to know whether the time
+# went on DNS, connecting, TLS, the server or the transfer itself.
+# Every request made by this module goes through `perform()`, which
+# passes a RequestTrace with curl's timing breakdown (in seconds) to
+# each of the functions in `REQUEST_HOOKS`.  Hooks are called even
+# when the request fails, with a status of 0.
+RequestTrace = namedtuple("RequestTrace", [
+        "method", "url", "status", "bytes_sent", "bytes_received",
+        "namelookup_time", "connect_time", "appconnect_time",
+        "starttransfer_time", "total_time"])
+
+REQUEST_HOOKS = []
+
+def add_request_hook(hook):
+    REQUEST_HOOKS.append(hook)
+
+def remove_request_hook(hook):
+    REQUEST_HOOKS.remove(hook)
+
+def fire_request_hooks(c, method, url):
+    if len(REQUEST_HOOKS) == 0:
+        return
+    trace = RequestTrace(
+        method, url, c.getinfo(c.RESPONSE_CODE),
+        int(c.getinfo(c.SIZE_UPLOAD)), int(c.getinfo(c.SIZE_DOWNLOAD)),
+        c.getinfo(c.NAMELOOKUP_TIME), c.getinfo(c.CONNECT_TIME),
+        c.getinfo(c.APPCONNECT_TIME), c.getinfo(c.STARTTRANSFER_TIME),
+        c.getinfo(c.TOTAL_TIME))
+    for hook in list(REQUEST_HOOKS):
+        hook(trace)
+
+def record_transfer(c, method, url):
+    count_transfer("sent_wire", int(c.getinfo(c.SIZE_UPLOAD)))
+    count_transfer("received_wire", int(c.getinfo(c.SIZE_DOWNLOAD)))
+    fire_request_hooks(c, method, url)
+
+def perform(c, method, url):
+    try:
+        c.perform()
+    finally:
+        record_transfer(c, method, url)
+
+### Endpoint classes
+#
+# For reporting, requests are grouped by the kind of resource rather
+# than by the exact URL: `_all_docs`, `_changes`, a view, a design
+# document or a kind of document such as `git-blob-*`.  The resource
+# starts at the first path component that is either a special `_`
+# name or a git document id.
+GIT_ID_RE = re.compile(r"^(git-[a-z]+)(-.*)?$")
+
+def endpoint_class(method, url):
+    path = urlparse.urlsplit(url).path
+    parts = [urllib.unquote(p) for p in path.split("/") if p != ""]
+    for i, part in enumerate(parts):
+        if part.startswith("_") or GIT_ID_RE.match(part):
+            rest = parts[i:]
+            break
+    else:
+        return "%s %s" % (method, "database" if len(parts) > 0 else "server")
+    if rest[0] == "_design":
+        if len(rest) <= 2:
+            name = "_design"
+        elif rest[2].startswith("_"):
+            name = "_design/%s" % (rest[2],)
+        else:
+            name = "_design attachment"
+    elif rest[0].startswith("_"):
+        name = rest[0]
+    else:
+        match = GIT_ID_RE.match(rest[0])
+        name = match.group(1) + ("-*" if match.group(2) else "")
+        if len(rest) > 1:
+            name += " attachment"
+    return "%s %s" % (method, name)
+
+### Latency histograms
+#
+# A built-in hook that counts requests into power-of-two millisecond
+# buckets for each endpoint class and reports the mean time spent in
+# each phase of the request.  The curl phase times are cumulative so
+# the report shows the difference between consecutive phases.
+class LatencyHistogram(object):
+
+    phases = ["namelookup_time", "connect_time", "appconnect_time",
+              "starttransfer_time", "total_time"]
+    phase_labels = ["dns", "connect", "tls", "server", "transfer"]
+
+    def __init__(self):
+        self.classes = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, trace):
+        with self.lock:
+            self._count(trace)
+
+    def _count(self, trace):
+        stats = self.classes.setdefault(
+            endpoint_class(trace.method, trace.url),
+            {"count": 0, "errors": 0, "sent": 0, "received": 0, 
+             "max": 0.0, "buckets": {},
+             "phases": dict((p, 0.0) for p in self.phases)})
+        stats["count"] += 1
+        if trace.status == 0 or trace.status >= 400:
+            stats["errors"] += 1
+        stats["sent"] += trace.bytes_sent
+        stats["received"] += trace.bytes_received
+        stats["max"] = max(stats["max"], trace.total_time)
+        previous = 0.0
+        for phase in self.phases:
+            # APPCONNECT_TIME is zero when there is no TLS
+            value = max(previous, getattr(trace, phase))
+            stats["phases"][phase] += value - previous
+            previous = value
+        bucket = 0
+        while 2 ** bucket < trace.total_time * 1000:
+            bucket += 1
+        stats["buckets"][bucket] = stats["buckets"].get(bucket, 0) + 1
+
+    def report(self):
+        lines = []
+        for name, stats in sorted(self.classes.items()):
+            count = stats["count"]
+            lines.append("%s: count=%s errors=%s sent=%s received=%s "
+                         "max=%.1fms" % (name, count, stats["errors"],
+                                         stats["sent"], stats["received"],
+                                         stats["max"] * 1000))
+            lines.append("    mean ms: " + " ".join(
+                    "%s=%.1f" % (label, stats["phases"][p] * 1000 / count)
+                    for p, label in zip(self.phases, self.phase_labels)))
+            width = max(stats["buckets"].values())
+            for bucket in range(max(stats["buckets"]) + 1):
+                n = stats["buckets"].get(bucket, 0)
+                lines.append("    %8s %6s %s" % (
+                        "<=%sms" % (2 ** bucket,), n, 
+                        "#" * int(round(40.0 * n / width))))
+        return "\n".join(lines)
+
+### Tracing from the environment
+#
+# Set `COUCHDBLIB_TRACE=histogram` to print the latency histograms to
+# stderr when the process exits, or `COUCHDBLIB_TRACE=log` to print one
+# line per request as it completes (or both, separated by a comma).
+def log_request(trace):
+    print >>sys.stderr, "%s %s %s sent=%s received=%s total=%.1fms" % (
+        trace.method, trace.url, trace.status, trace.bytes_sent, 
+        trace.bytes_received, trace.total_time * 1000)
+
+def install_tracing_from_environment(environ=os.environ):
+    modes = [m for m in environ.get("COUCHDBLIB_TRACE", "").split(",") 
+             if m != ""]
+    for mode in modes:
+        if mode == "histogram":
+            histogram = LatencyHistogram()
+            add_request_hook(histogram)
+            atexit.register(lambda: sys.stderr.write(
+                    histogram.report() + "\n"))
+        elif mode == "log":
+            add_request_hook(log_request)
+        else:
+            raise Exception("Unknown COUCHDBLIB_TRACE mode: %r" % (mode,))
+
+install_tracing_from_environment()
+
+### Compressed transfer
+#
+# JSON documents, and git trees and text blobs in particular, compress
+# very well.  Every request asks for a gzip `Content-Encoding` in the
+# response and curl decodes it transparently.  Request bodies can be
+# compressed too but not every server accepts that so it is only done
+# for bodies of at least `gzip_request_min_size` bytes, which is off
+# (None) unless set here or with the `COUCHDBLIB_GZIP_REQUESTS`
+# environment variable.
+#
+# `TRANSFER_COUNTS` records the bytes on the wire, as reported by
+# curl, alongside the uncompressed sizes so the saving can be seen.
+# Requests can be made from several threads at once so the counters,
+# like `CONFLICT_COUNTS` below, are only updated under `COUNTS_LOCK`.
+TRANSFER_COUNTS = {"sent_wire": 0, "sent_uncompressed": 0,
+                   "received_wire": 0, "received_uncompressed": 0}
+COUNTS_LOCK = threading.Lock()
+
+def count_transfer(name, size):
+    with COUNTS_LOCK:
+        TRANSFER_COUNTS[name] += size
+
+def parse_min_size(value):
+    if value in (None, ""):
+        return None
+    return int(value)
+
+gzip_request_min_size = parse_min_size(
+    os.environ.get("COUCHDBLIB_GZIP_REQUESTS"))
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def compress_body(body, headers):
+    count_transfer("sent_uncompressed", len(body))
+    if gzip_request_min_size is None or len(body) < gzip_request_min_size:
+        return body, list(headers)
+    return gzip_compress(body), list(headers) + ["Content-Encoding: gzip"]
+
+def accept_gzip(c, write):
+    def counting_write(data):
+        count_transfer("received_uncompressed", len(data))
+        return write(data)
+    c.setopt(c.ENCODING, "gzip")
+    c.setopt(c.WRITEFUNCTION, counting_write)
+
+def transfer_savings():
+    result = {}
+    for direction in ("sent", "received"):
+        wire = TRANSFER_COUNTS[direction + "_wire"]
+        uncompressed = TRANSFER_COUNTS[direction + "_uncompressed"]
+        result[direction] = uncompressed - wire
+    return result
+
+### Requests with status and headers
+#
+# The simple functions below only look at the JSON body of the
+# response.  Some features, such as conditional requests, need the
+# HTTP status code and headers as well.  Header names are lower cased
+# and only the headers of the final response are kept (not those of a
+# `100 Continue`, for example).
+Response = namedtuple("Response", ["status", "headers", "body"])
+
+def request(url, method="GET", body=None, headers=()):
     url = url.encode("ascii")
+    response_headers = {}
+    def on_header(line):
+        if line.startswith("HTTP/"):
+            response_headers.clear()
+        elif ":" in line:
+            name, value = line.split(":", 1)
+            response_headers[name.strip().lower()] = value.strip()
+    if body is not None:
+        body, headers = compress_body(body, headers)
     with contextlib.closing(curl.Curl()) as c:
         c.setopt(c.URL, url)
         out = StringIO()
-        c.setopt(c.WRITEFUNCTION, out.write)
-        c.perform()
-        return json.loads(out.getvalue())
+        accept_gzip(c, out.write)
+        c.setopt(c.HEADERFUNCTION, on_header)
+        if method == "PUT":
+            c.setopt(c.UPLOAD, True)
+            c.setopt(c.READFUNCTION, StringIO(body or "").read)
+            c.setopt(c.INFILESIZE, len(body or ""))
+        elif method == "POST":
+            c.setopt(c.POST, True)
+            c.setopt(c.POSTFIELDS, body or "")
+        elif method == "HEAD":
+            c.setopt(c.NOBODY, True)
+        elif method != "GET":
+            c.setopt(c.CUSTOMREQUEST, method)
+        c.setopt(c.HTTPHEADER, list(headers))
+        perform(c, method, url)
+        return Response(c.getinfo(c.RESPONSE_CODE), response_headers,
+                        out.getvalue())
+
+### Attachments
+#
+# Attachments can be much bigger than the JSON documents so they are
+# streamed between curl and a file object (anything with `read()` or
+# `write()`), a file descriptor or, for uploads, a path on disk.  The
+# data passes through Python one `ATTACHMENT_CHUNK_SIZE` block at a
+# time and the whole attachment is never held in memory.
+#
+# The MD5 digest, as used by the CouchDB `Content-MD5` header and the
+# `md5-...` digests of the `_attachments` stubs, is computed in the
+# same chunked way.  An upload from a seekable source is digested
+# first, so that CouchDB can reject a corrupted body, and a download is
+# digested as it is written and checked against the response header.
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+
+def file_md5(fh, chunk_size=ATTACHMENT_CHUNK_SIZE):
+    digest = hashlib.md5()
+    while True:
+        data = fh.read(chunk_size)
+        if data == "":
+            break
+        digest.update(data)
+    return base64.b64encode(digest.digest())
+
+def attachment_url(doc_url, name):
+    return posixpath.join(doc_url, 
+                          "/".join(url_quote(p) for p in name.split("/")))
+
+def get_rev(doc_url):
+    response = request(doc_url, "HEAD")
+    if response.status != 200:
+        return None
+    return json.loads(response.headers["etag"])
+
+def put_attachment(doc_url, name, source, 
+                   content_type="application/octet-stream", rev=None):
+    if isinstance(source, basestring):
+        with open(source, "rb") as fh:
+            return put_attachment(doc_url, name, fh, content_type, rev)
+    if isinstance(source, int):
+        with os.fdopen(os.dup(source), "rb") as fh:
+            return put_attachment(doc_url, name, fh, content_type, rev)
+    fh = source
+    if rev is None:
+        rev = get_rev(doc_url)
+    url = attachment_url(doc_url, name)
+    if rev is not None:
+        url = make_query_url(url, {"rev": rev})
+    headers = ["Content-Type: %s" % (content_type,)]
+    size = None
+    try:
+        start = fh.tell()
+        headers.append("Content-MD5: %s" % (file_md5(fh),))
+        size = fh.tell() - start
+        fh.seek(start)
+    except (AttributeError, IOError):
+        # A pipe or socket can only be read once, so upload without
+        # the digest check.
+        pass
+    with contextlib.closing(curl.Curl()) as c:
+        c.setopt(c.URL, url.encode("ascii"))
+        out = StringIO()
+        accept_gzip(c, out.write)
+        c.setopt(c.UPLOAD, True)
+        c.setopt(c.READFUNCTION, fh.read)
+        if size is not None:
+            c.setopt(c.INFILESIZE, size)
+        c.setopt(c.HTTPHEADER, headers)
+        perform(c, "PUT", url)
+        count_transfer("sent_uncompressed", int(c.getinfo(c.SIZE_UPLOAD)))
+        result = json.loads(out.getvalue())
+    if result.get("error") is not None:
+        raise Exception("Failed to upload %s:\n%s" % (url, pformat(result)))
+    return result
+
+def get_attachment(url, target):
+    if isinstance(target, int):
+        def write(data):
+            while len(data) > 0:
+                data = data[os.write(target, data):]
+    else:
+        write = target.write
+    digest = hashlib.md5()
+    state = {"status": None, "md5": None, "encoding": None, "length": 0}
+    error_body = StringIO()
+    def on_header(line):
+        if line.startswith("HTTP/"):
+            state["status"] = int(line.split(" ")[1])
+        elif line.lower().startswith("content-md5:"):
+            state["md5"] = line.split(":", 1)[1].strip()
+        elif line.lower().startswith("content-encoding:"):
+            state["encoding"] = line.split(":", 1)[1].strip().lower()
+    def on_data(data):
+        if state["status"] != 200:
+            error_body.write(data)
+            return
+        digest.update(data)
+        state["length"] += len(data)
+        write(data)
+    with contextlib.closing(curl.Curl()) as c:
+        c.setopt(c.URL, url.encode("ascii"))
+        c.setopt(c.HEADERFUNCTION, on_header)
+        accept_gzip(c, on_data)
+        perform(c, "GET", url)
+    if state["status"] != 200:
+        raise Exception("Failed to download %s: %s %s" 
+                        % (url, state["status"], error_body.getvalue()))
+    md5 = base64.b64encode(digest.digest())
+    # Content-MD5 is the digest of the body as sent, so it can only be
+    # compared when the body was not compressed on the wire.
+    if (state["md5"] is not None and state["encoding"] in (None, "identity")
+        and state["md5"] != md5):
+        raise Exception("Digest mismatch for %s: expected %s but got %s"
+                        % (url, state["md5"], md5))
+    return {"length": state["length"], "md5": md5}
+
+### Simple document fetching
+# 
+# Allows normal size documents to be fetched using a single line
+# function call.  Assumes that the return document is JSON.  If a
+# DocumentCache has been installed with `use_document_cache()` then
+# the fetch goes through it.
+def get(url):
+    if document_cache is not None:
+        return document_cache.get(url)
+    return json.loads(request(url).body)
 
 ### Simple document uploading
 # 
 # Allows a JSON-like object to be uploaded to a particular document
 # URL in the CouchDB.
 def put(url, document):
-    url = url.encode("ascii")
-    with contextlib.closing(curl.Curl()) as c:
-        c.setopt(c.URL, url)
-        out = StringIO()
-        c.setopt(c.WRITEFUNCTION, out.write)
-        c.setopt(c.UPLOAD, True)
-        c.setopt(c.READFUNCTION, StringIO(json.dumps(document)).read)
-        c.perform()
-        return json.loads(out.getvalue())
+    return json.loads(request(url, "PUT", json.dumps(document)).body)
+
+### Bulk uploading
+#
+# Many documents can be created or updated in a single request using
+# `_bulk_docs`.  The result has an entry for each document, in order,
+# which has either the new `rev` or an `error` such as `conflict`.
+def bulk_docs(db_url, documents):
+    return json.loads(request(posixpath.join(db_url, "_bulk_docs"), "POST",
+                              json.dumps({"docs": documents}),
+                              ["Content-Type: application/json"]).body)
 
 ### Delete a document
 #
@@ -57,19 +445,12 @@ def put(url, document):
 # only be deleted when that revision is the latest version.  The
 # default is to delete the latest revision.
 def delete(url, rev=None):
-    url = url.encode("ascii")
     if rev is None:
         rev = get(url)["_rev"]
-    with contextlib.closing(curl.Curl()) as c:
-        c.setopt(c.URL, url)
-        c.setopt(c.CUSTOMREQUEST, "DELETE")
-        out = StringIO()
-        c.setopt(c.WRITEFUNCTION, out.write)
-        c.setopt(c.HTTPHEADER, ["If-Match: %s" % (json.dumps(rev),)])
-        c.perform()
-        result = json.loads(out.getvalue())
-        if not result.get("ok", False):
-            raise Exception(result)
+    result = json.loads(request(url, "DELETE", headers=[
+                "If-Match: %s" % (json.dumps(rev),)]).body)
+    if not result.get("ok", False):
+        raise Exception(result)
 
 ### Posting a new document
 # 
@@ -83,21 +464,47 @@ def post_new(url, document, id_template="%s"):
             print i, "The race is on!"
         candidate = posixpath.join(
             url, url_quote(id_template % (uuid.uuid4(),)))
-        candidate = candidate.encode("ascii")
-        with contextlib.closing(curl.Curl()) as c:
-            c.setopt(c.URL, candidate)
-            out = StringIO()
-            c.setopt(c.WRITEFUNCTION, out.write)
-            c.setopt(c.UPLOAD, True)
-            c.setopt(c.READFUNCTION, StringIO(json.dumps(document)).read)
-            c.perform()
-            result = json.loads(out.getvalue())
-            if "id" in result:
-                return result
-            if result.get("error") != "conflict":
-                raise Exception(result)
+        result = put(candidate, document)
+        if "id" in result:
+            return result
+        if result.get("error") != "conflict":
+            raise Exception(result)
         i += 1
     
+### Conflict backoff
+#
+# When several writers are racing to update the same document, retrying
+# as quickly as possible just doubles the load on the server and makes
+# the next collision more likely.  Instead each retry waits for a
+# random interval drawn uniformly from a window that doubles after each
+# conflict (randomized binary exponential backoff), capped at
+# `PUT_UPDATE_MAX_DELAY` seconds.  The number of attempts is bounded
+# by a retry budget so that a hopelessly contended document results in
+# an error instead of an infinite loop.
+PUT_UPDATE_MAX_ATTEMPTS = 30
+PUT_UPDATE_BASE_DELAY = 0.01
+PUT_UPDATE_MAX_DELAY = 5.0
+
+def backoff_delay(attempt, base_delay=PUT_UPDATE_BASE_DELAY,
+                  max_delay=PUT_UPDATE_MAX_DELAY):
+    window = min(max_delay, base_delay * (2 ** min(attempt, 32)))
+    return random.uniform(0, window)
+
+### Conflict metrics
+#
+# Every time an update loses a race the URL of the document is counted
+# here.  A long running process, such as the test queue or the
+# synchronizer, can print or inspect these counters to find out which
+# documents are hot spots.
+CONFLICT_COUNTS = {}
+
+def record_conflict(url):
+    with COUNTS_LOCK:
+        CONFLICT_COUNTS[url] = CONFLICT_COUNTS.get(url, 0) + 1
+
+def is_conflict(result):
+    return result.get("error") == "conflict"
+
 ### Updating a document
 #
 # CouchDB documents can be updated using the PUT method but the API
@@ -113,15 +520,14 @@ def post_new(url, document, id_template="%s"):
 # replacement document.  In this case the function is effectvely a
 # forced replacement of the named document.
 # 
-# Ideally this function would use a randomized binary exponential
-# backoff for PUT attempts but at the moment it just tries as quickly
-# as it can.
-def put_update(url, update_func):
+# Conflicting attempts are retried after a `backoff_delay()` until
+# `max_attempts` is exhausted.  Any error other than a conflict is
+# raised straight away because retrying would not help.
+def put_update(url, update_func, max_attempts=PUT_UPDATE_MAX_ATTEMPTS):
     url = url.encode("ascii")
-    i = 0
-    while True:
-        if i % 1000 == 0 and i != 0:
-            print i, "The race is on!"
+    for attempt in range(max_attempts):
+        if attempt > 0:
+            time.sleep(backoff_delay(attempt - 1))
         old_doc = get(url)
         if (old_doc.get("error") == "not_found" 
             and old_doc.get("reason") in ("missing", "deleted")):
@@ -153,19 +559,502 @@ def put_update(url, update_func):
             new_doc["_rev"] = result["rev"]
             new_doc["_id"] = result["id"]
             return new_doc
-        i += 1
+        if not is_conflict(result):
+            raise Exception("Failed to update %s:\n%s" 
+                            % (url, pformat(result)))
+        record_conflict(url)
+    raise Exception("Gave up updating %s after %s conflicting attempts"
+                    % (url, max_attempts))
 
-### Uploading a CouchApp
-# 
-# Calls through to the command line program `couchapp` to generate a
-# CouchDB design document from a directory structure.  The design
-# document is uploaded to the given URL.
-def couchapp(url, local_path):
+### Server-side update handlers
+#
+# The read-modify-write cycle of `put_update()` costs two round trips
+# per attempt and the window between the GET and the PUT is where the
+# conflicts come from.  CouchDB can instead run the mutation itself
+# using an `_update` function from a design document, so that the
+# whole cycle is a single request.  The mutation has to be expressed
+# in JavaScript so only a couple of generic handlers are provided:
+#
+#   - `replace` stores the request body as the new document, like the
+#     forced replacement use of `put_update()`.
+#
+#   - `merge` copies the top-level attributes of the request body on
+#     top of the existing document.
+#
+# Use `install_update_handlers()` once to add them to a design
+# document and then `put_via_handler()` to apply updates.
+UPDATE_HANDLERS = {
+    "replace": """\
+function (doc, req) {
+  var new_doc = JSON.parse(req.body);
+  new_doc._id = req.id;
+  if (doc) {
+    new_doc._rev = doc._rev;
+  } else {
+    delete new_doc._rev;
+  }
+  return [new_doc, JSON.stringify({"ok": true, "id": req.id})];
+}
+""",
+    "merge": """\
+function (doc, req) {
+  var changes = JSON.parse(req.body);
+  if (!doc) {
+    doc = {"_id": req.id};
+  }
+  for (var key in changes) {
+    if (key != "_id" && key != "_rev") {
+      doc[key] = changes[key];
+    }
+  }
+  return [doc, JSON.stringify({"ok": true, "id": req.id})];
+}
+""",
+    }
+
+def install_update_handlers(design_url, handlers=UPDATE_HANDLERS):
+    def add_handlers(design_doc):
+        design_doc.setdefault("language", "javascript")
+        design_doc.setdefault("updates", {}).update(handlers)
+    return put_update(design_url, add_handlers)
+
+# The handler URL looks like `DB/_design/DESIGN/_update/NAME` and the
+# document id is appended to it.  The new revision is not visible to
+# the update function so CouchDB reports it in a response header.
+def put_via_handler(handler_url, doc_id, document,
+                    max_attempts=PUT_UPDATE_MAX_ATTEMPTS):
+    url = posixpath.join(handler_url, url_quote(doc_id))
+    for attempt in range(max_attempts):
+        if attempt > 0:
+            time.sleep(backoff_delay(attempt - 1))
+        response = request(url, "PUT", json.dumps(document))
+        result = json.loads(response.body)
+        if result.get("error") is None:
+            result["rev"] = response.headers.get("x-couch-update-newrev")
+            return result
+        if not is_conflict(result):
+            raise Exception("Failed to update %s via %s:\n%s" 
+                            % (doc_id, handler_url, pformat(result)))
+        record_conflict(url)
+    raise Exception("Gave up updating %s via %s after %s conflicting "
+                    "attempts" % (doc_id, handler_url, max_attempts))
+
+### Query URLs
+#
+# Most of the CouchDB query parameters, such as `startkey`, are JSON
+# values rather than plain strings.  This builds a URL from a
+# dictionary of parameters, JSON encoding the ones that need it.
+# Parameters with a value of None are left out.
+JSON_QUERY_PARAMS = ("key", "keys", "startkey", "endkey", 
+                     "start_key", "end_key")
+
+def make_query_url(url, params):
+    query = []
+    for name, value in sorted(params.items()):
+        if value is None:
+            continue
+        if name in JSON_QUERY_PARAMS:
+            value = json.dumps(value)
+        elif isinstance(value, bool):
+            value = "true" if value else "false"
+        elif isinstance(value, unicode):
+            value = value.encode("utf-8")
+        query.append((name, value))
+    if len(query) == 0:
+        return url
+    return url + ("&" if "?" in url else "?") + urllib.urlencode(query)
+
+### Streaming rows
+#
+# Responses from `_all_docs`, `_view` and `_changes` are a small JSON
+# envelope around one very long array, e.g. `{"total_rows": 3,
+# "offset": 0, "rows": [...]}`.  Loading the whole thing with
+# `json.loads()` means holding the full body and the full object graph
+# in memory at once.  The RowParser is fed the body a chunk at a time
+# and only decodes one array element at a time.  The elements are
+# found by tracking the nesting depth of brackets outside of strings
+# so the scan never goes back over data it has already seen.
+ROW_SCAN_RE = re.compile(r'["{}\[\]]')
+STRING_SCAN_RE = re.compile(r'["\\]')
+
+class RowParser(object):
+
+    def __init__(self, key="rows"):
+        self.key_re = re.compile(r'"%s"\s*:\s*\[' % (re.escape(key),))
+        self.buffer = ""
+        self.state = "envelope"
+        self.row_start = None
+        self.scan_pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.rows = []
+
+    def feed(self, data):
+        self.buffer += data
+        if self.state == "envelope":
+            match = self.key_re.search(self.buffer)
+            if match is None:
+                return
+            self.buffer = self.buffer[match.end():]
+            self.state = "rows"
+        if self.state == "rows":
+            self._scan()
+
+    def _scan(self):
+        buf = self.buffer
+        pos = self.scan_pos
+        while True:
+            if self.row_start is None:
+                while pos < len(buf) and buf[pos] in " \t\r\n,":
+                    pos += 1
+                if pos == len(buf):
+                    break
+                if buf[pos] == "]":
+                    self.state = "done"
+                    pos += 1
+                    break
+                self.row_start = pos
+            if self.in_string:
+                match = STRING_SCAN_RE.search(buf, pos)
+                if match is None:
+                    pos = len(buf)
+                    break
+                if match.group() == "\\":
+                    if match.end() == len(buf):
+                        pos = match.start()
+                        break
+                    pos = match.end() + 1
+                else:
+                    self.in_string = False
+                    pos = match.end()
+                continue
+            match = ROW_SCAN_RE.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            pos = match.end()
+            char = match.group()
+            if char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.rows.append(json.loads(buf[self.row_start:pos]))
+                    self.row_start = None
+        # Throw away whatever has already been decoded so that the
+        # buffer only ever holds the row currently being received.
+        keep_from = pos if self.row_start is None else self.row_start
+        self.buffer = buf[keep_from:]
+        self.scan_pos = pos - keep_from
+        if self.row_start is not None:
+            self.row_start = 0
+
+    def pop_rows(self):
+        rows = self.rows
+        self.rows = []
+        return rows
+
+    def close(self):
+        if self.state != "done":
+            raise Exception("Incomplete or unexpected response: %s"
+                            % (self.buffer[:1000],))
+
+# The curl multi interface is used so that control returns to the
+# caller between chunks.  Rows are handed out as soon as they have
+# been received and the next chunk is not read until the caller asks
+# for more.  A JSON `body` turns the request into a POST, as needed
+# for `_all_docs` with `keys`.
+def iter_rows(url, key="rows", body=None):
     url = url.encode("ascii")
-    local_path = os.path.abspath(local_path)
-    design_json = call(["couchapp", "push", "--export"],
-                        stderr=None, cwd=local_path)
-    # Strangely it seems to print a line before the design document
-    design_json = design_json[design_json.find("{"):]
-    put_update(url, lambda a=None: json.loads(design_json))
+    parser = RowParser(key)
+    with contextlib.closing(curl.Curl()) as c:
+        c.setopt(c.URL, url)
+        accept_gzip(c, parser.feed)
+        if body is not None:
+            data, headers = compress_body(
+                json.dumps(body), ["Content-Type: application/json"])
+            c.setopt(c.POST, True)
+            c.setopt(c.POSTFIELDS, data)
+            c.setopt(c.HTTPHEADER, headers)
+        multi = curl.CurlMulti()
+        multi.add_handle(c)
+        try:
+            while True:
+                while True:
+                    ret, num_handles = multi.perform()
+                    if ret != curl.E_CALL_MULTI_PERFORM:
+                        break
+                for row in parser.pop_rows():
+                    yield row
+                if num_handles == 0:
+                    break
+                multi.select(1.0)
+            num_queued, ok_list, err_list = multi.info_read()
+            for handle, errno, errmsg in err_list:
+                raise Exception("Failed to fetch %s: %s" % (url, errmsg))
+        finally:
+            record_transfer(c, "GET" if body is None else "POST", url)
+            multi.remove_handle(c)
+            multi.close()
+    for row in parser.pop_rows():
+        yield row
+    parser.close()
+
+### Paginated iteration
+#
+# Even with streaming, one huge request holds a connection and a
+# server-side snapshot open for as long as the caller takes to consume
+# it.  These helpers page through the keys instead, using the key of
+# the extra (`limit + 1`th) row as the `startkey` of the next page so
+# that no page needs a slow `skip`.  View keys need not be unique so
+# for map rows the document id of the extra row is passed as
+# `startkey_docid` too.
+def iter_pages(url, params, page_size, use_docid=False):
+    params = dict(params)
+    while True:
+        params["limit"] = page_size + 1
+        next_row = None
+        for i, row in enumerate(iter_rows(make_query_url(url, params))):
+            if i == page_size:
+                next_row = row
+            else:
+                yield row
+        if next_row is None:
+            break
+        params["startkey"] = next_row["key"]
+        if use_docid:
+            params["startkey_docid"] = next_row["id"]
+
+def iter_all_docs(db_url, page_size=1000, startkey=None, endkey=None,
+                  include_docs=False):
+    url = posixpath.join(db_url, "_all_docs")
+    params = {"startkey": startkey, "endkey": endkey,
+              "include_docs": include_docs}
+    return iter_pages(url, params, page_size)
+
+### Fetching many documents
+#
+# Fetching documents one `get` at a time costs a round trip each.
+# `iter_docs` asks for up to `batch_size` of them at once with a POST
+# to `_all_docs` and yields `(doc_id, document)` pairs as the rows
+# arrive, which is not necessarily the order asked for.  Immutable
+# documents already in the DocumentCache are yielded first without
+# being requested and the ones fetched are added to it.
+BULK_FETCH_BATCH_SIZE = 500
+
+def iter_docs(db_url, doc_ids, batch_size=BULK_FETCH_BATCH_SIZE):
+    url = make_query_url(posixpath.join(db_url, "_all_docs"),
+                         {"include_docs": True})
+    cache = document_cache
+    missing = []
+    for doc_id in doc_ids:
+        body = None
+        if cache is not None and doc_id.startswith(cache.immutable_prefixes):
+            body = cache.lookup(db_url, doc_id)
+        if body is None:
+            missing.append(doc_id)
+        else:
+            yield doc_id, json.loads(body)
+    for i in range(0, len(missing), batch_size):
+        for row in iter_rows(url, body={"keys": missing[i:i + batch_size]}):
+            if row.get("doc") is None:
+                raise Exception("Failed to fetch %s: %s" 
+                                % (row["key"], pformat(row)))
+            doc_id = row["id"]
+            if (cache is not None 
+                and doc_id.startswith(cache.immutable_prefixes)):
+                cache.count("misses")
+                cache.store(db_url, doc_id, json.dumps(row["doc"]))
+            yield doc_id, row["doc"]
+
+### Querying views
+#
+# A query on a view that is out of date blocks until the index has
+# caught up, which can take a long time after a big sync.  Callers
+# that can live with slightly old results can pass `stale="ok"` to
+# read the index as it is, or `stale="update_after"` to do the same
+# and have CouchDB bring the index up to date afterwards.
+#
+# Rows of a reduced view are one per group so their keys are unique.
+# Setting `group_level` implies grouping and `reduce=False` gives the
+# map rows of a view that has a reduce function.
+STALE_VALUES = (None, "ok", "update_after")
+
+def view_url(design_url, view_name):
+    return posixpath.join(design_url, "_view", url_quote(view_name))
+
+def iter_view(url, page_size=1000, startkey=None, endkey=None, 
+              include_docs=False, reduce=None, group_level=None, 
+              stale=None, descending=False):
+    if stale not in STALE_VALUES:
+        raise Exception("Unexpected stale value: %r" % (stale,))
+    params = {"startkey": startkey, "endkey": endkey,
+              "include_docs": include_docs or None, "reduce": reduce,
+              "group_level": group_level, "stale": stale,
+              "descending": descending or None}
+    is_reduced = reduce is not False and group_level is not None
+    return iter_pages(url, params, page_size, use_docid=not is_reduced)
+
+def query_view(url, **kwargs):
+    return list(iter_view(url, **kwargs))
+
+### Document caching
+#
+# Git objects are stored under ids that include their SHA-1 so the
+# `git-commit-*`, `git-tree-*` and `git-blob-*` documents never change
+# once they have been written.  The DocumentCache keeps the JSON text
+# of such documents in an in-process LRU, bounded by the total size of
+# the bodies, and optionally in a directory on disk so that they
+# survive between runs.  Different databases can hold different
+# documents under the same id, so they are keyed by the database URL
+# as well as the document id; on disk each database gets a
+# subdirectory named after a hash of its URL, which keeps any
+# credentials in the URL out of the file names.  A cached immutable
+# document is returned without making a request at all.
+#
+# Any other document, such as `git-branch-*` or a `_design` document,
+# may change at any time.  Those are kept in memory along with their
+# ETag and are revalidated with `If-None-Match` on every fetch so an
+# unchanged document costs a `304 Not Modified` and no body.
+#
+# One cache can be shared between threads.  The LRU and the counters
+# are guarded by a lock that is never held during a request.
+IMMUTABLE_PREFIXES = ("git-commit-", "git-tree-", "git-blob-")
+
+class DocumentCache(object):
+
+    def __init__(self, cache_dir=None, max_bytes=32*1024*1024,
+                 immutable_prefixes=IMMUTABLE_PREFIXES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.immutable_prefixes = tuple(immutable_prefixes)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def immutable_id(self, url):
+        if "?" in url:
+            return None
+        doc_id = urllib.unquote(posixpath.basename(url))
+        if doc_id.startswith(self.immutable_prefixes):
+            return doc_id
+        return None
+
+    def _recall(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+
+    def _remember(self, key, etag, body):
+        with self.lock:
+            self._forget_locked(key)
+            if len(body) > self.max_bytes:
+                return
+            self.entries[key] = (etag, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                unused, (unused, dropped) = self.entries.popitem(last=False)
+                self.size -= len(dropped)
+
+    def _forget(self, key):
+        with self.lock:
+            self._forget_locked(key)
+
+    def _forget_locked(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _disk_path(self, db_url, doc_id):
+        db_hash = hashlib.sha1(db_url.rstrip("/").encode("utf-8"))
+        return os.path.join(self.cache_dir, db_hash.hexdigest(),
+                            url_quote(doc_id))
+
+    def lookup(self, db_url, doc_id):
+        key = (db_url.rstrip("/"), doc_id)
+        entry = self._recall(key)
+        if entry is None and self.cache_dir is not None:
+            disk_path = self._disk_path(db_url, doc_id)
+            if os.path.exists(disk_path):
+                with open(disk_path, "rb") as fh:
+                    entry = (None, fh.read())
+                self._remember(key, None, entry[1])
+        if entry is None:
+            return None
+        self.count("hits")
+        return entry[1]
+
+    def store(self, db_url, doc_id, body):
+        self._remember((db_url.rstrip("/"), doc_id), None, body)
+        if self.cache_dir is not None:
+            disk_path = self._disk_path(db_url, doc_id)
+            if not os.path.exists(os.path.dirname(disk_path)):
+                try:
+                    os.makedirs(os.path.dirname(disk_path))
+                except OSError:
+                    # Another thread or process made it first
+                    if not os.path.isdir(os.path.dirname(disk_path)):
+                        raise
+            temp_path = "%s.%s.tmp" % (disk_path, uuid.uuid4())
+            with open(temp_path, "wb") as fh:
+                fh.write(body)
+            os.rename(temp_path, disk_path)
+
+    def _get_immutable_body(self, url, doc_id):
+        db_url = posixpath.dirname(url)
+        body = self.lookup(db_url, doc_id)
+        if body is not None:
+            return body
+        self.count("misses")
+        response = request(url)
+        if response.status == 200:
+            self.store(db_url, doc_id, response.body)
+        return response.body
+
+    def _get_mutable_body(self, url):
+        entry = self._recall(url)
+        headers = []
+        if entry is not None:
+            headers.append("If-None-Match: %s" % (entry[0],))
+        response = request(url, headers=headers)
+        if response.status == 304 and entry is not None:
+            self.count("revalidations")
+            return entry[1]
+        self.count("misses")
+        etag = response.headers.get("etag")
+        if response.status == 200 and etag is not None:
+            self._remember(url, etag, response.body)
+        else:
+            self._forget(url)
+        return response.body
+
+    def get_body(self, url):
+        doc_id = self.immutable_id(url)
+        if doc_id is None:
+            return self._get_mutable_body(url)
+        else:
+            return self._get_immutable_body(url, doc_id)
+
+    def get(self, url):
+        return json.loads(self.get_body(url))
+
+document_cache = None
 
+def use_document_cache(cache):
+    global document_cache
+    previous = document_cache
+    document_cache = cache
+    return previous
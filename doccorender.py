@@ -0,0 +1,81 @@
+# Copyright 2011 James Ascroft-Leigh
+#
+# Rendering files into the git browser's docco view ahead of time.
+#
+# The browser highlights a file with highlight.js, splits it into
+# documentation and code rows and converts the documentation with
+# Showdown, all in JavaScript (see
+# gitbrowser/_attachments/docco_worker.js).  Rather than reproduce
+# that in Python, and risk the two disagreeing, the same scripts are
+# run here under node so that the stored rows are exactly what the
+# browser would have made itself.
+
+from process import call
+import json
+import os
+
+GITBROWSER_ATTACHMENTS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "gitbrowser", "_attachments")
+
+RENDER_SCRIPTS = ["utils.js", "libmagic.js", 
+                  "highlight.js/highlight.pack.js", "showdown.js", 
+                  "docco_worker.js"]
+
+RENDER_BATCH_SIZE = 50
+
+# Run as `node -e NODE_DRIVER ROOT MODE SCRIPT...` with a JSON list
+# of requests on stdin and prints a JSON list of results.
+NODE_DRIVER = """\
+var fs = require("fs");
+var path = require("path");
+var vm = require("vm");
+var context = vm.createContext({"navigator": {"userAgent": ""}});
+var root = process.argv[1];
+var mode = process.argv[2];
+process.argv.slice(3).forEach(function(name) {
+    vm.runInContext(fs.readFileSync(path.join(root, name), "utf8"), 
+                    context, name);
+});
+var requests = JSON.parse(fs.readFileSync("/dev/stdin", "utf8"));
+var results = requests.map(function(request) {
+    if (mode == "mime_types") {
+        var mime_type = context.docco_mime_type(request);
+        return context.is_docco_mime_type(mime_type) ? mime_type : null;
+    } else if (mode == "render") {
+        return context.docco_render_file(request[0], request[1]);
+    } else {
+        throw new Error("Unknown mode: " + mode);
+    }
+});
+process.stdout.write(JSON.stringify(results));
+"""
+
+def run_node(mode, requests, node="node"):
+    output = call([node, "-e", NODE_DRIVER, GITBROWSER_ATTACHMENTS, mode] 
+                  + RENDER_SCRIPTS, 
+                  stdin_data=json.dumps(requests), stderr=None,
+                  do_crlf_fix=False)
+    return json.loads(output)
+
+### docco_mime_types
+#
+# The mime type that the browser would render a file with this
+# basename as, or None for files that it would not show as docco,
+# such as plain text and binary files.
+def docco_mime_types(basenames):
+    if len(basenames) == 0:
+        return []
+    return run_node("mime_types", list(basenames))
+
+### render_files
+#
+# Takes `(basename, text)` pairs and returns a `{"mime_type",
+# "segments"}` dictionary for each one, where each segment is a
+# `[docs_html, code_html]` row of the docco table.
+def render_files(files):
+    results = []
+    files = list(files)
+    for start in range(0, len(files), RENDER_BATCH_SIZE):
+        batch = [list(f) for f in files[start:start + RENDER_BATCH_SIZE]]
+        results.extend(run_node("render", batch))
+    return results
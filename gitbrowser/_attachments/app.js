@@ -1,92 +1,6 @@
 var base_path = "/";
 var db_base = base_path + "db/";
 
-function b64decode(b64data) {
-    /* Nod to http://www.webtoolkit.info/javascript-base64.html */
-    
-    var keys = ("ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-                + "abcdefghijklmnopqrstuvwxyz"
-                + "0123456789+/");
-    var output = [];
-    var chr1, chr2, chr3;
-    var enc1, enc2, enc3, enc4;
-    var i = 0;
-    var input = b64data.replace(/[^A-Za-z0-9\+\/]/g, "");
-    while (i < input.length)
-    {
-        enc1 = keys.indexOf(input.charAt(i++));
-        enc2 = keys.indexOf(input.charAt(i++));
-        chr1 = (enc1 << 2) | (enc2 >> 4);
-        output.push(chr1);
-        if (input.length == i)
-        {
-            break;
-        }
-        enc3 = keys.indexOf(input.charAt(i++));
-        chr2 = ((enc2 & 15) << 4) | (enc3 >> 2);
-        output.push(chr2);
-        if (input.length == i)
-        {
-            break;
-        }
-        enc4 = keys.indexOf(input.charAt(i++));	       
-        chr3 = ((enc3 & 3) << 6) | enc4;
-        output.push(chr3);
-    }
-    return output;
-}
-
-function hexdump(charcodes)
-{
-    var hex_result = [];
-    var str_result = [];
-    var result = [];
-    var i;
-    var flush = function()
-    {
-        var hex_part = hex_result.join(" ");
-        var hex_part_padding =  ("                        "
-                                 + "                        ");
-        var hex_part = hex_part + hex_part_padding;
-        var hex_part = hex_part.substr(0, hex_part_padding.length);
-        var hex_part = (
-            hex_part.substr(0, Math.floor(hex_part.length / 2)) + " " 
-            + hex_part.substr(Math.floor(hex_part.length / 2), 
-                              hex_part.length));
-        var line_id = "00000000" + (i - str_result.length + 1).toString(16);
-        var line_id = line_id.substring(line_id.length - 8);
-        if (str_result.length > 0)
-	    {
-            result.push(line_id + "  " + hex_part + " |" 
-                        + str_result.join("") + "|\r\n");
-        }
-        hex_result.splice(0, hex_result.length);
-        str_result.splice(0, str_result.length);
-    }
-    for (i = 0; i < charcodes.length; i++)
-    {
-        var code = charcodes[i];
-        hex_result.push(("0" + code.toString(16)).substr(-2, 2));
-        if (code >= 32 && code <= 126)
-        {
-            str_result.push(String.fromCharCode(code));
-        }
-        else
-        {
-            str_result.push(".");
-        }
-        if (i % 16 == 15)
-        {
-            flush();
-        }
-    }
-    flush();
-    var line_id = "00000000" + (i - str_result.length).toString(16);
-    var line_id = line_id.substring(line_id.length - 8);
-    result.push(line_id);
-    return result.join("");
-}
-
 function startswith(string, prefix)
 {
     return (string.length >= prefix.length 
@@ -208,6 +122,28 @@ function split_path(path_string)
     return decoded_path;
 }
 
+function make_history_url(branch_name, revision)
+{
+    return ("/history/" + encodeURIComponent(branch_name) + "/"
+	    + encodeURIComponent(revision));
+}
+
+function make_search_url(branch_name, query)
+{
+    var url = "/search/" + encodeURIComponent(branch_name);
+    if (query != "")
+    {
+	url += "/" + encodeURIComponent(query);
+    }
+    return url;
+}
+
+function make_diff_url(branch_name, sha, path)
+{
+    return make_show_url(branch_name, sha, path).replace(/^\/show\//, 
+							 "/diff/");
+}
+
 function make_show_url(branch_name, revision, path)
 {
     var result = [];
@@ -221,26 +157,119 @@ function make_show_url(branch_name, revision, path)
     return "/" + (result.join("/"));
 }
 
-var EXTRA_TEXT_TYPES = [
-    "application/javascript",
-    "application/json",
-    "application/x-sh"
-];
-
-var HIGHLIGHT_MIME_TYPES = {
-    "text/x-python": {"name": "python", "line_func": function(l) {
-	return l.replace(/^#/gm, "");
-    }},
-    "application/javascript": {"name": "javascript", "line_func": function(l) {
-	return l.replace(/^\/\//gm, "");
-    }},
-    "text/x-coffeescript": {"name": "coffeescript", "line_func": function(l) {
-	return l.replace(/^#/gm, "");
-    }},
-    "text/x-sql": {"name": "sql", "line_func": function(l) {
-        return l.replace(/^\-\-/gm, "");
-    }}
-};
+// Highlighting and splitting a file into docco rows happens in
+// docco_worker.js, in a web worker where there is one, and the rows
+// are then added a chunk at a time so that the top of the file shows
+// up straight away.  If there is no worker, or it fails to load or
+// throws, the rows are worked out in the page instead.
+var DOCCO_CHUNK_ROWS = 50;
+var docco_worker = null;
+var docco_requests = {};
+var docco_next_id = 0;
+
+function docco_in_page(request)
+{
+    request.callback(docco_segments(request.text, request.options.name,
+				    request.options.comment));
+}
+
+function start_docco_worker()
+{
+    if (typeof Worker == "undefined")
+    {
+	return false;
+    }
+    try
+    {
+	var worker = new Worker(base_path + "static/docco_worker.js");
+    }
+    catch (error)
+    {
+	return false;
+    }
+    worker.onmessage = function(event) {
+	var request = docco_requests[event.data.id];
+	delete docco_requests[event.data.id];
+	request.callback(event.data.segments);
+    };
+    worker.onerror = function(event) {
+	event.preventDefault();
+	worker.terminate();
+	docco_worker = false;
+	var requests = docco_requests;
+	docco_requests = {};
+	for (var id in requests)
+	{
+	    docco_in_page(requests[id]);
+	}
+    };
+    return worker;
+}
+
+function highlight_docco(text, mime_type, callback)
+{
+    var request = {"text": text, "options": highlight_options(mime_type),
+		   "callback": callback};
+    if (docco_worker === null)
+    {
+	docco_worker = start_docco_worker();
+    }
+    if (docco_worker === false)
+    {
+	return docco_in_page(request);
+    }
+    var id = docco_next_id;
+    docco_next_id += 1;
+    docco_requests[id] = request;
+    docco_worker.postMessage({"id": id, "text": text,
+			      "language": request.options.name,
+			      "comment": request.options.comment});
+}
+
+// gitcouchdbsync.py --render stores the rows for the files at the
+// head of each branch, named after the blob, in which case there is
+// nothing left to do here but add them to the table
+function render_docco(table, doc, text)
+{
+    function render_rows(segments)
+    {
+	var next = 0;
+	function render_chunk()
+	{
+	    var end = Math.min(next + DOCCO_CHUNK_ROWS, segments.length);
+	    for (var i = next; i < end; i++)
+	    {
+		var row = $('<tr><td class="docs_cell"></td>'
+			    + '<td class="code_cell"><pre></pre></td></tr>');
+		$(".docs_cell", row).html(segments[i][0]);
+		$(".code_cell pre", row).html(segments[i][1]);
+		table.append(row);
+	    }
+	    next = end;
+	    if (next < segments.length)
+	    {
+		setTimeout(render_chunk, 0);
+	    }
+	}
+	render_chunk();
+    }
+    function render_here()
+    {
+	highlight_docco(text, doc.mime_type, render_rows);
+    }
+    fetch_doc("git-rendered-" + trim_prefix(doc._id, "git-blob-"),
+	      function(rendered) {
+		  if (rendered.mime_type == doc.mime_type)
+		  {
+		      render_rows(rendered.segments);
+		  }
+		  else
+		  {
+		      render_here();
+		  }
+	      },
+	      render_here);
+}
 
 function normalize_line_endings(text) {
     var text = text.replace(/\r/g, "").replace(/\n/g, "\r\n");
@@ -267,10 +296,21 @@ function get_origin() {
     return origin + "/";
 }
 
+// Documents can arrive after the page has moved on, or twice when a
+// cached branch document turns out to be stale, so only the latest
+// page is rendered
+var current_show = 0;
+
 function show_file_or_folder(branch_name, revision, path)
 {
-    function render_tree_or_blob(doc)
+    current_show += 1;
+    var show_id = current_show;
+    function render_tree_or_blob(doc, commit_sha)
     {
+	if (show_id != current_show)
+	{
+	    return;
+	}
 	var body = $('<div></div>');
 	if (path.length > 0)
 	{
@@ -280,21 +320,32 @@ function show_file_or_folder(branch_name, revision, path)
 					       up_path));
 	    body.append(up_link);
 	}
+	if (revision == "head")
+	{
+	    // Pinned to the commit, so the browser can cache it forever
+	    var permalink = $("<a>[permalink]</a>");
+	    permalink.attr("href", make_show_url(branch_name, commit_sha,
+						 path));
+	    body.append(" ");
+	    body.append(permalink);
+	}
+	var history_link = $("<a>[history]</a>");
+	history_link.attr("href", make_history_url(branch_name, revision));
+	body.append(" ");
+	body.append(history_link);
+	var changes_link = $("<a>[changes]</a>");
+	changes_link.attr("href", make_diff_url(branch_name, commit_sha, []));
+	body.append(" ");
+	body.append(changes_link);
+	var search_link = $("<a>[search]</a>");
+	search_link.attr("href", make_search_url(branch_name, ""));
+	body.append(" ");
+	body.append(search_link);
 	if (doc.type == "git-blob")
 	{
 	    doc.basename = path[path.length - 1];
 	    guess_file_type(doc);
-	    var is_text = false;
-	    if (startswith(doc.mime_type, "text/")) {
-		is_text = true;
-	    } else {
-		for (var i = 0; i < EXTRA_TEXT_TYPES.length; i++) {
-		    if (doc.mime_type == EXTRA_TEXT_TYPES[i]) {
-			is_text = true;
-		    }
-		}
-	    }
-	    if (is_text) {
+	    if (is_text_mime_type(doc.mime_type)) {
 		var text = get_text(doc);
 		var text = normalize_line_endings(text);
 		var heading = $('<h1></h1>');
@@ -310,86 +361,7 @@ function show_file_or_folder(branch_name, revision, path)
 				  + '<col class="docs_column"></col>'
 				  + '<col class="code_column"></col>'
 				  + '</table>');
-		    var pre = $('<pre style="display: none"></pre>');
-		    var line_func = function(l) {return l};
-		    for (var i in HIGHLIGHT_MIME_TYPES) {
-			if (doc.mime_type == i) {
-			    pre.addClass(HIGHLIGHT_MIME_TYPES[i].name);
-			    line_func = HIGHLIGHT_MIME_TYPES[i].line_func;
-			    break;
-			}
-		    }
-		    pre.text(text);
-		    body.append(pre);
-		    hljs.highlightBlock(pre[0], null, true);
-		    var language = pre.attr("class");
-		    var peek = function(container, offset) {
-			var child_nodes = container.childNodes;
-			return (child_nodes.length >= 2
-				&& child_nodes[0].nodeType 
-				== child_nodes[0].ELEMENT_NODE
-				&& child_nodes[0].nodeName == "SPAN"
-				&& $(child_nodes[0]).hasClass("comment")
-				&& child_nodes[1].nodeType
-				== child_nodes[1].TEXT_NODE
-				&& startswith(child_nodes[1].data, "\n"));
-		    };
-		    while (pre[0].childNodes.length > 0) {
-			var row = $('<tr></tr>');
-			table.append(row);
-			var docs_cell = $(
-			    '<td class="docs_cell"></td>');
-			var docs_pre = $('<pre></pre>');
-			docs_cell.append(docs_pre);
-			row.append(docs_cell);
-			var code_cell = $(
-			    '<td class="code_cell"></td>');
-			var code_pre = $('<pre></pre>');
-			row.append(code_cell);
-			code_cell.append(code_pre);
-			var child_nodes = pre[0].childNodes;
-			while (peek(pre[0])) {
-			    var comment = pre[0].childNodes[0];
-			    var newline = pre[0].childNodes[1];
-			    if (newline.data == "\n") {
-				pre[0].removeChild(newline);
-				docs_pre.append($(newline));
-			    } else {
-				newline.data = trim_prefix(newline.data, "\n");
-				var unused = $('<div></div>');
-				unused.text("\n");
-				var new_node = unused[0].childNodes[0];
-				unused[0].removeChild(new_node);
-				docs_pre.append($(new_node));
-			    }
-			    pre[0].removeChild(comment);
-			    docs_pre.append($(comment));
-			}
-			if (docs_pre[0].childNodes.length > 0
-			    && pre[0].childNodes.length > 0 
-			    && pre[0].childNodes[0].nodeType
-			    == pre[0].childNodes[0].TEXT_NODE
-			    && startswith(pre[0].childNodes[0].data, "\n")) {
-			    continue;
-			}
-			while (pre[0].childNodes.length > 0 && !peek(pre[0])) {
-			    while (pre[0].childNodes.length > 0) {
-				var to_move = pre[0].childNodes[0];
-				pre[0].removeChild(to_move);
-				code_pre.append($(to_move));
-				if (to_move.nodeType == to_move.TEXT_NODE
-				    && endswith(to_move.data, "\n") 
-				    && peek(pre[0])) {
-				    break;
-				}
-			    }
-			}
-		    }
-		    _.each($(".docs_cell", table), function(i) {
-			var raw_code = $(i).text();
-			raw_code = line_func(raw_code);
-			$(i).html(converter.makeHtml(raw_code));
-		    });
+		    render_docco(table, doc, text);
                     body.append(table);
 		}
 	    } else {
@@ -400,9 +372,7 @@ function show_file_or_folder(branch_name, revision, path)
 		} else {
 		    throw new Error(doc.encoding);
 		}
-		var pre = $('<pre></pre>');
-		pre.text(hexdump(charcodes));
-		body.append(pre);
+		body.append(render_hexdump(charcodes));
 	    }
 	}
 	else if (doc.type == "git-tree")
@@ -451,9 +421,7 @@ function show_file_or_folder(branch_name, revision, path)
 			})
 		    }
 
-		    var readme_url = db_base + encodeURIComponent(
-			doc.children[i].child._id)
-		    $.get(readme_url, {}, handle_readme, "json");
+		    fetch_doc(doc.children[i].child._id, handle_readme);
 		    break;
 		}
 	    }
@@ -474,6 +442,554 @@ function show_file_or_folder(branch_name, revision, path)
     });
 }
 
+// Trees, blobs, commits, path indexes, renderings, history pages and
+// diffs are named after their content so they are fetched through the
+// object show, which lets the browser cache them forever.  Anything
+// else comes straight from the database.
+function is_immutable_id(doc_id)
+{
+    return /^git-(tree|blob|commit|pathindex|rendered|history|diff)-[0-9a-f]{40}$/.test(doc_id);
+}
+
+function doc_url(doc_id)
+{
+    if (is_immutable_id(doc_id))
+    {
+	return base_path + "object/" + encodeURIComponent(doc_id);
+    }
+    return db_base + encodeURIComponent(doc_id);
+}
+
+// Fetches a document through the cache in doc_cache.js
+function fetch_doc(doc_id, success, error)
+{
+    doc_cache_fetch({
+	"key": doc_id,
+	"url": doc_url(doc_id),
+	"immutable": is_immutable_id(doc_id),
+	"success": success,
+	"error": error
+    });
+}
+
+// The history of a branch comes a page at a time from the
+// git-history-:sha documents that gitcouchdbsync.py writes, each of
+// which names the next, and the next page is fetched whenever the
+// bottom of the list scrolls into view.  The history from a commit
+// other than the head starts part way down a page that holds it,
+// found with the history view.
+var HISTORY_SCROLL_MARGIN = 800; // pixels
+
+function show_history(branch_name, revision)
+{
+    current_show += 1;
+    var show_id = current_show;
+    var body = $('<div></div>');
+    var up_link = $("<a>[files]</a>");
+    up_link.attr("href", make_show_url(branch_name, revision, []));
+    body.append(up_link);
+    var heading = $('<h1></h1>');
+    heading.text("History of " + branch_name);
+    body.append(heading);
+    var table = $('<table class="table history_table"></table>');
+    body.append(table);
+    var message = $('<p></p>');
+    body.append(message);
+    var top_id = null;
+    var next_id = null;
+    var loading = false;
+    function render_page(page)
+    {
+	if (show_id != current_show)
+	{
+	    return;
+	}
+	_.each(page.commits, function(commit) {
+	    var row = $('<tr><td class="history_sha"><a></a></td>'
+			+ '<td class="history_subject"><a></a></td>'
+			+ '<td class="history_author"></td>'
+			+ '<td class="history_date"></td></tr>');
+	    $(".history_sha a", row).text(commit.sha.substring(0, 10));
+	    $(".history_sha a", row).attr(
+		"href", make_show_url(branch_name, commit.sha, []));
+	    $(".history_subject a", row).text(commit.subject);
+	    $(".history_subject a", row).attr(
+		"href", make_diff_url(branch_name, commit.sha, []));
+	    $(".history_author", row).text(commit.author);
+	    $(".history_date", row).text(commit.date);
+	    table.append(row);
+	});
+	next_id = (typeof page.next == "undefined") ? null : page.next._id;
+	loading = false;
+	maybe_load_more();
+    }
+    function load(doc_id)
+    {
+	loading = true;
+	fetch_doc(doc_id, render_page, function() {
+	    loading = false;
+	    message.text("Missing history: " + doc_id);
+	});
+    }
+    function maybe_load_more()
+    {
+	if (show_id != current_show)
+	{
+	    $(window).off("scroll", maybe_load_more);
+	    return;
+	}
+	if (loading || next_id === null)
+	{
+	    return;
+	}
+	var bottom = $(window).scrollTop() + $(window).height();
+	if (bottom < $(document).height() - HISTORY_SCROLL_MARGIN)
+	{
+	    return;
+	}
+	var doc_id = next_id;
+	next_id = null;
+	load(doc_id);
+    }
+    function start(doc_id)
+    {
+	// A cached branch document can be followed by a newer one
+	if (doc_id == top_id)
+	{
+	    return;
+	}
+	top_id = doc_id;
+	table.empty();
+	load(doc_id);
+    }
+    function start_from_commit(page)
+    {
+	var shas = _.map(page.commits, function(c) {return c.sha});
+	var index = _.indexOf(shas, revision);
+	if (index == -1)
+	{
+	    return message.text("Missing history: " + revision);
+	}
+	top_id = page._id;
+	render_page(_.extend({}, page, {
+	    "commits": page.commits.slice(index)}));
+    }
+    $(window).on("scroll", maybe_load_more);
+    if (revision == "head")
+    {
+	fetch_doc("git-branch-" + branch_name, function(doc) {
+	    if (typeof doc.history == "undefined")
+	    {
+		return message.text("No history for " + branch_name);
+	    }
+	    start(doc.history._id);
+	}, function() {
+	    message.text("Missing branch: " + branch_name);
+	});
+    }
+    else
+    {
+	doc_cache_fetch({
+	    "key": "commit-history-" + revision,
+	    "url": base_path + "commit_history",
+	    "data": {"key": JSON.stringify(revision)},
+	    "immutable": true,
+	    "success": start_from_commit,
+	    "error": function() {
+		// Without the history view, there may still be a
+		// page that starts at this commit
+		start("git-history-" + revision);
+	    }
+	});
+    }
+    $("#main_body").text("");
+    $("#main_body").append(body);
+}
+
+// Searches the files at the head of a branch, a line at a time, using
+// the trigram index in search.js to choose which files to read.  The
+// index and branch documents can change, and when a newer one turns
+// up the search starts again.
+var SEARCH_MAX_FILES = 200;
+var SEARCH_MAX_LINES = 5; // per file
+
+function show_search(branch_name, query)
+{
+    current_show += 1;
+    var show_id = current_show;
+    var body = $('<div></div>');
+    var up_link = $("<a>[files]</a>");
+    up_link.attr("href", make_show_url(branch_name, "head", []));
+    body.append(up_link);
+    var heading = $('<h1></h1>');
+    heading.text("Search " + branch_name);
+    body.append(heading);
+    var form = $('<form><input type="text" class="search_query"></form>');
+    $("input", form).val(query);
+    form.on("submit", function(event) {
+	event.preventDefault();
+	Backbone.history.navigate(
+	    make_search_url(branch_name, $("input", form).val()),
+	    {"trigger": true});
+    });
+    body.append(form);
+    var message = $('<p></p>');
+    body.append(message);
+    var results = $('<div></div>');
+    body.append(results);
+    $("#main_body").text("");
+    $("#main_body").append(body);
+    if (query == "")
+    {
+	return;
+    }
+    try
+    {
+	var regexp = new RegExp(query);
+    }
+    catch (err)
+    {
+	return message.text("Not a regular expression: " + err.message);
+    }
+    var trigrams = query_trigrams(query);
+    if (trigrams === null || trigrams.length == 0)
+    {
+	return message.text("Searches need three characters in a row "
+			    + "that every match must contain");
+    }
+    var docs = {};
+    var requested = {};
+    var run = 0;
+    function need(doc_id, missing)
+    {
+	if (!requested[doc_id])
+	{
+	    requested[doc_id] = true;
+	    fetch_doc(doc_id, function(doc) {
+		docs[doc_id] = doc;
+		update();
+	    }, missing);
+	}
+	return docs[doc_id];
+    }
+    function update()
+    {
+	if (show_id != current_show)
+	{
+	    return;
+	}
+	var branch = need("git-branch-" + branch_name, function() {
+	    message.text("Missing branch: " + branch_name);
+	});
+	var trigram_index = need("git-trigrams-index", function() {
+	    message.text("Not indexed, see gitcouchdbsync.py --index");
+	});
+	if (!branch || !trigram_index)
+	{
+	    return;
+	}
+	if (typeof branch.pathindex == "undefined")
+	{
+	    return message.text("No path index for " + branch_name);
+	}
+	var index = need(branch.pathindex._id, function() {
+	    message.text("Missing path index: " + branch.pathindex._id);
+	});
+	var shards = _.map(trigrams, function(key) {
+	    var shard_id = ("git-trigrams-"
+			    + trigram_shard(key, trigram_index.shards));
+	    return need(shard_id, function() {
+		// Nothing has been indexed under this shard yet
+		docs[shard_id] = {"postings": {}};
+		update();
+	    });
+	});
+	if (!index || _.any(shards, function(shard) {return !shard;}))
+	{
+	    return;
+	}
+	var numbers = null;
+	_.each(trigrams, function(key, i) {
+	    var postings = decode_postings(shards[i].postings[key]);
+	    numbers = (numbers === null ? postings
+		       : intersect_postings(numbers, postings));
+	});
+	// Only the blob shards with the numbers that were found are
+	// needed to turn them into blob SHA-1s
+	var per_shard = trigram_index.blobs_per_shard;
+	var blob_shards = {};
+	_.each(numbers, function(number) {
+	    var shard = Math.floor(number / per_shard);
+	    var shard_id = "git-trigrams-blobs-" + shard;
+	    blob_shards[shard] = need(shard_id, function() {
+		message.text("Missing blob numbers: " + shard_id);
+	    });
+	});
+	if (_.any(blob_shards, function(shard) {return !shard;}))
+	{
+	    return;
+	}
+	search(index, numbers, function(number) {
+	    var shard = Math.floor(number / per_shard);
+	    return blob_shards[shard].blobs[number - shard * per_shard];
+	});
+    }
+    function search(index, numbers, blob_sha)
+    {
+	run += 1;
+	var this_run = run;
+	// The index holds every file it has ever seen, on any branch,
+	// so keep only those on this one
+	var paths_by_blob = group_by(
+	    _.filter(_.keys(index.paths), function(path) {
+		return index.paths[path].type == "git-blob";
+	    }),
+	    function(path) {return index.paths[path]._id});
+	var files = [];
+	_.each(numbers, function(number) {
+	    var blob_id = "git-blob-" + blob_sha(number);
+	    _.each(paths_by_blob[blob_id] || [], function(path) {
+		files.push({"path": path, "blob_id": blob_id});
+	    });
+	});
+	files = _.sortBy(files, function(file) {return file.path});
+	var total = files.length;
+	files = files.slice(0, SEARCH_MAX_FILES);
+	var pending = files.length;
+	var found = 0;
+	function finished()
+	{
+	    var text = found + " matching files";
+	    if (total > files.length)
+	    {
+		text += (", only the first " + files.length + " of " 
+			 + total + " possible files were read");
+	    }
+	    message.text(text);
+	}
+	results.empty();
+	message.text("Reading " + pending + " files");
+	if (pending == 0)
+	{
+	    finished();
+	}
+	// Each file has its place in the results, in path order,
+	// from the start so that they can be filled in as they arrive
+	_.each(files, function(file) {
+	    var result = $('<div class="search_file"><a></a>'
+			   + '<pre></pre></div>');
+	    $("a", result).text(file.path);
+	    $("a", result).attr("href", make_show_url(
+		branch_name, "head", file.path.split("/")));
+	    result.hide();
+	    results.append(result);
+	    function done()
+	    {
+		pending -= 1;
+		if (pending == 0)
+		{
+		    finished();
+		}
+	    }
+	    fetch_doc(file.blob_id, function(doc) {
+		if (this_run != run || show_id != current_show)
+		{
+		    return;
+		}
+		var lines = get_text(doc).split(/\r?\n/);
+		var matches = [];
+		for (var i = 0; i < lines.length; i++)
+		{
+		    if (regexp.test(lines[i]))
+		    {
+			matches.push((i + 1) + ": " + lines[i]);
+			if (matches.length == SEARCH_MAX_LINES)
+			{
+			    break;
+			}
+		    }
+		}
+		if (matches.length > 0)
+		{
+		    found += 1;
+		    $("pre", result).text(matches.join("\n"));
+		    result.show();
+		}
+		done();
+	    }, function() {
+		if (this_run == run)
+		{
+		    done();
+		}
+	    });
+	});
+    }
+    update();
+}
+
+// What a commit changed, from the git-diff-:sha document that
+// gitcouchdbsync.py writes, which lists the paths added, removed and
+// modified since the first parent.  The commit page needs only that
+// and the commit, and the page for one file needs only that and the
+// two versions of the file.
+function show_diff(branch_name, sha, path)
+{
+    current_show += 1;
+    var show_id = current_show;
+    var body = $('<div></div>');
+    var files_link = $("<a>[files]</a>");
+    files_link.attr("href", make_show_url(branch_name, sha, []));
+    body.append(files_link);
+    if (path.length > 0)
+    {
+	var up_link = $("<a>[changes]</a>");
+	up_link.attr("href", make_diff_url(branch_name, sha, []));
+	body.append(" ");
+	body.append(up_link);
+    }
+    var heading = $('<h1></h1>');
+    body.append(heading);
+    var message = $('<p></p>');
+    body.append(message);
+    $("#main_body").text("");
+    $("#main_body").append(body);
+    if (!/^[0-9a-f]{40}$/.test(sha))
+    {
+	return message.text("Not a commit sha: " + sha);
+    }
+    function render_commit(commit)
+    {
+	if (show_id != current_show)
+	{
+	    return;
+	}
+	heading.text(commit.message.split("\n")[0]);
+	var pre = $('<pre class="diff_message"></pre>');
+	pre.text(commit.author.name + " <" + commit.author.email + ">\n"
+		 + commit.author.date + "\n\n" + commit.message);
+	heading.after(pre);
+    }
+    function render_changes(diff)
+    {
+	if (show_id != current_show)
+	{
+	    return;
+	}
+	var changes = [].concat(
+	    _.map(diff.added, function(c) {return ["A", c]}),
+	    _.map(diff.removed, function(c) {return ["D", c]}),
+	    _.map(diff.modified, function(c) {return ["M", c]}));
+	changes = _.sortBy(changes, function(c) {return c[1].path});
+	var table = $('<table class="table diff_changes"></table>');
+	_.each(changes, function(change) {
+	    var row = $('<tr><td class="diff_status"></td>'
+			+ '<td><a></a></td></tr>');
+	    $(".diff_status", row).text(change[0]);
+	    $("a", row).text(change[1].path);
+	    $("a", row).attr("href", make_diff_url(
+		branch_name, sha, change[1].path.split("/")));
+	    table.append(row);
+	});
+	body.append(table);
+	if (changes.length == 0)
+	{
+	    message.text("No changes");
+	}
+    }
+    function blob_lines(entry, callback)
+    {
+	if (typeof entry == "undefined")
+	{
+	    return callback([]);
+	}
+	if (entry.type != "git-blob")
+	{
+	    return callback(null, "Submodule at " + entry._id);
+	}
+	fetch_doc(entry._id, function(doc) {
+	    var text = get_text(doc);
+	    if (/\0/.test(text))
+	    {
+		return callback(null, "Binary file");
+	    }
+	    callback(text.replace(/\r\n/g, "\n").split("\n"));
+	}, function() {
+	    message.text("Missing blob: " + entry._id);
+	});
+    }
+    function diff_table(old_lines, new_lines)
+    {
+	var table = $('<table class="diff_table"></table>');
+	_.each(diff_hunks(diff_lines(old_lines, new_lines)), function(hunk) {
+	    table.append('<tr class="diff_gap"><td colspan="3">&hellip;'
+			 + '</td></tr>');
+	    _.each(hunk, function(line) {
+		var row = $('<tr><td class="diff_number"></td>'
+			    + '<td class="diff_number"></td>'
+			    + '<td class="diff_line"></td></tr>');
+		row.addClass({"+": "diff_added", "-": "diff_removed",
+			      " ": "diff_same"}[line.op]);
+		var cells = $("td", row);
+		cells.eq(0).text(line.old_number || "");
+		cells.eq(1).text(line.new_number || "");
+		cells.eq(2).text(line.op + line.line);
+		table.append(row);
+	    });
+	});
+	return table;
+    }
+    function render_file(diff)
+    {
+	if (show_id != current_show)
+	{
+	    return;
+	}
+	var path_string = path.join("/");
+	heading.text(path_string);
+	var change = _.find(
+	    [].concat(diff.added, diff.removed, diff.modified),
+	    function(c) {return c.path == path_string});
+	if (typeof change == "undefined")
+	{
+	    return message.text("Not changed by this commit");
+	}
+	// Both versions are fetched at once
+	var versions = {};
+	function got(side, lines, why)
+	{
+	    versions[side] = lines;
+	    if (lines === null)
+	    {
+		message.text(why);
+	    }
+	    if (show_id != current_show 
+		|| !_.has(versions, "old") || !_.has(versions, "new")
+		|| versions.old === null || versions["new"] === null)
+	    {
+		return;
+	    }
+	    body.append(diff_table(versions.old, versions["new"]));
+	}
+	blob_lines(change.old, function(lines, why) {
+	    got("old", lines, why);
+	});
+	blob_lines(change["new"], function(lines, why) {
+	    got("new", lines, why);
+	});
+    }
+    fetch_doc("git-diff-" + sha, path.length > 0 ? render_file 
+	      : render_changes, function() {
+	message.text("No diff for " + sha + ", it was synchronized "
+		     + "before gitcouchdbsync.py made them");
+    });
+    if (path.length == 0)
+    {
+	fetch_doc("git-commit-" + sha, render_commit, function() {
+	    message.text("Missing commit: " + sha);
+	});
+    }
+}
+
 function get_file_or_folder(params)
 {
     var branch_name = params.branch;
@@ -481,7 +997,7 @@ function get_file_or_folder(params)
     var path = params.path;
     var success = params.success;
     if (typeof success == "undefined") {
-	var success = function(doc) {};
+	var success = function(doc, commit_sha) {};
     }
     var error = params.error;
     if (typeof error == "undefined") {
@@ -489,15 +1005,20 @@ function get_file_or_folder(params)
 	    throw new Error(message);
 	};
     }
-    if (revision != "head")
+    if (revision != "head" && !/^[0-9a-f]{40}$/.test(revision))
     {
-	return error("Must be head revision, for now: " + revision);
+	return error("Revision must be head or a commit sha: " + revision);
+    }
+    var commit_sha = revision;
+    function done(doc)
+    {
+	return success(doc, commit_sha);
     }
     function handle_tree_or_blob(doc, remaining_path)
     {
 	if (remaining_path.length == 0)
 	{
-	    return success(doc);
+	    return done(doc);
 	}
 	if (doc.type != "git-tree")
 	{
@@ -517,59 +1038,61 @@ function get_file_or_folder(params)
 	{
 	    next_remainder.push(remaining_path[i]);
 	}
-	$.get(db_base + encodeURIComponent(child_id), {}, 
-	      function(d) {return handle_tree_or_blob(d, next_remainder)},
-	      "json");
+	get_doc(child_id, 
+		function(d) {return handle_tree_or_blob(d, next_remainder)},
+		"Missing object: " + child_id);
     }
-    function handle_commit(doc)
+    function get_doc(doc_id, callback, message)
     {
-	$.get(db_base + encodeURIComponent(doc.tree._id),
-	      {}, function(d) {return handle_tree_or_blob(d, path)}, "json");
+	fetch_doc(doc_id, callback, function() {return error(message)});
     }
-    function handle_branch(doc)
+    function handle_tree(tree_id)
+    {
+	// The resolve list looks the whole path up in the paths view
+	// and answers with the object itself.  Only trees that have
+	// been at the head of a branch have a path index so otherwise
+	// walk down the trees one level at a time instead.
+	var key = JSON.stringify([tree_id, path.join("/")]);
+	doc_cache_fetch({
+	    "key": "resolve-" + key,
+	    "url": base_path + "resolve",
+	    "data": {"key": key},
+	    "immutable": true,
+	    "success": done,
+	    "error": function() {
+		get_doc(tree_id, 
+			function(d) {return handle_tree_or_blob(d, path)},
+			"Missing tree: " + tree_id);
+	    }
+	});
+    }
+    function handle_commit(doc)
     {
-	$.get(db_base + encodeURIComponent(doc.commit._id),
-	      {}, handle_commit, "json");
+	handle_tree(doc.tree._id);
     }
-    function handle_branches(doc)
+    function handle_branch(doc)
     {
-	var found_it = false;
-	var by_name = group_by(doc.branches, function(b) {return b.branch});
-	var branches = by_name[branch_name];
-	if (typeof branches == "undefined")
+	commit_sha = trim_prefix(doc.commit._id, "git-commit-");
+	if (typeof doc.tree == "undefined")
 	{
-	    return error("Missing branch: " + branch_name);
+	    // Synchronized before branch documents referred to their
+	    // tree
+	    return get_doc(doc.commit._id, handle_commit, 
+			   "Missing commit: " + doc.commit._id);
 	}
-	var branch = get1(branches);
-	$.get(db_base + encodeURIComponent(branch._id),
-	      {}, handle_branch, "json");
+	handle_tree(doc.tree._id);
     }
-    $.get(db_base + "git-branches",
-	  {}, handle_branches, "json");
-}
-
-function utf8_decode(byte_codes) {
-    var codes = [];
-    for (var i = 0; i < byte_codes.length; i++) {
-	var hex_string = "00" + byte_codes[i].toString(16);
-	var hex_string = hex_string.substring(hex_string.length - 2,
-					      hex_string.length);
-	codes.push("%" + hex_string);
-    }
-    return decodeURIComponent(codes.join(""));
-}
-
-function utf8_encode(string) {
-    var encoded = [];
-    for (var i = 0; i < string.length; i++) {
-	var strchr = encodeURIComponent(string[i]);
-	if (strchr.length == 1) {
-	    encoded.push(strchr.charCodeAt(0))
-	} else {
-	    encoded.push(parseInt(trim_prefix(strchr, "%"), 16));
-	}
+    if (revision != "head")
+    {
+	// A pinned revision never changes so skip the branch
+	// documents and start from the commit
+	return get_doc("git-commit-" + revision, handle_commit,
+		       "Missing commit: " + revision);
     }
-    return encoded;
+    // Branch documents are named after the branch so there is no need
+    // to look the branch up in git-branches first
+    get_doc("git-branch-" + branch_name, handle_branch, 
+	    "Missing branch: " + branch_name);
 }
 
 $(function(){
@@ -604,6 +1127,11 @@ $(function(){
 	    "": "redirectHome",
 	    "show/:branch/:rev/*path": "show",
 	    "show/:branch/:rev": "showRoot",
+	    "history/:branch/:rev": "showHistory",
+	    "search/:branch": "showSearch",
+	    "search/:branch/*query": "showSearch",
+	    "diff/:branch/:sha": "showDiffRoot",
+	    "diff/:branch/:sha/*path": "showDiff",
 	    "*unknown": "handleUnknown"
 	},
 
@@ -628,6 +1156,26 @@ $(function(){
 	    show_file_or_folder(branch, rev, []);
 	},
 
+	showHistory: function(branch, rev) {
+	    show_history(branch, rev);
+	},
+
+	showDiffRoot: function(branch, sha) {
+	    show_diff(branch, sha, []);
+	},
+
+	showDiff: function(branch, sha, path) {
+	    show_diff(branch, sha, path == "" ? [] : split_path(path));
+	},
+
+	showSearch: function(branch, query) {
+	    if (typeof query == "undefined")
+	    {
+		var query = "";
+	    }
+	    show_search(branch, decodeURIComponent(query));
+	},
+
 	handleUnknown: function(unknown) {
 	    $("#main_body").html('<h1>Not found</h1><p>The location '
 				 + '<span class="unknown_url" '
@@ -646,6 +1194,20 @@ $(function(){
 	root: base_path
     });
 
+    // Follow links within the browser without reloading the page, so
+    // that the documents cached in memory are still there
+    var in_page_links = ("a[href^='/show/'], a[href^='/history/'], "
+			 + "a[href^='/search/'], a[href^='/diff/']");
+    $(document).on("click", in_page_links, function(event) {
+	if (event.which > 1 || event.metaKey || event.ctrlKey 
+	    || event.shiftKey || event.altKey)
+	{
+	    return;
+	}
+	event.preventDefault();
+	my_router.navigate($(this).attr("href"), {"trigger": true});
+    });
+
     function set_title(title) {
 	$(".brand").text(title);
 	document.title = title;
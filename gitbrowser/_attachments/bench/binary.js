@@ -0,0 +1,115 @@
+// Times blob decoding and the hexdump on generated sample blobs,
+// with and without typed arrays.  The legacy versions get slow
+// quickly so they are only run up to LEGACY_MAX_BYTES, which can be
+// changed with ?legacy_max=BYTES.
+
+var SAMPLE_SIZES = [64 * 1024, 1024 * 1024, 4 * 1024 * 1024,
+		    16 * 1024 * 1024];
+var LEGACY_MAX_BYTES = 1024 * 1024;
+
+function sample_bytes(size)
+{
+    // A fixed linear congruential sequence so runs are comparable
+    var bytes = new Uint8Array(size);
+    var state = 12345;
+    for (var i = 0; i < size; i++)
+    {
+	state = (state * 1103515245 + 12345) & 0x7fffffff;
+	bytes[i] = state >> 16;
+    }
+    return bytes;
+}
+
+function sample_text(size)
+{
+    var line = "Gr\u00fc\u00dfe from the git browser benchmark, line ";
+    var parts = [];
+    var length = 0;
+    for (var i = 0; length < size; i++)
+    {
+	var next = line + i + "\n";
+	parts.push(next);
+	length += next.length;
+    }
+    return parts.join("");
+}
+
+function to_base64(bytes)
+{
+    var chunks = [];
+    for (var i = 0; i < bytes.length; i += 0x8000)
+    {
+	chunks.push(String.fromCharCode.apply(
+	    null, bytes.subarray(i, i + 0x8000)));
+    }
+    return btoa(chunks.join(""));
+}
+
+function time_ms(func)
+{
+    var start = new Date().getTime();
+    func();
+    return new Date().getTime() - start;
+}
+
+function run_benchmarks(results, legacy_max)
+{
+    var container = $('<div></div>');
+    $("#hexdump_sample").append(container);
+    var cases = [];
+    _.each(SAMPLE_SIZES, function(size) {
+	var b64data = to_base64(sample_bytes(size));
+	var utf8_bytes = utf8_encode(sample_text(size));
+	cases.push(["b64decode", size,
+		    function() {b64decode(b64data)},
+		    function() {b64decode_legacy(b64data)}]);
+	cases.push(["utf8_decode", size,
+		    function() {utf8_decode(utf8_bytes)},
+		    function() {utf8_decode_legacy(utf8_bytes)}]);
+	cases.push(["hexdump", size,
+		    function() {
+			container.empty();
+			container.append(render_hexdump(b64decode(b64data)));
+		    },
+		    function() {
+			var pre = $('<pre></pre>');
+			pre.text(hexdump(b64decode_legacy(b64data)));
+			container.empty();
+			container.append(pre);
+		    }]);
+    });
+    function next()
+    {
+	if (cases.length == 0)
+	{
+	    return;
+	}
+	var bench = cases.shift();
+	var row = $('<tr class="result"><td></td><td></td><td></td><td></td></tr>');
+	var cells = $("td", row);
+	$(cells[0]).text(bench[0]);
+	$(cells[1]).text((bench[1] / 1024) + " KiB");
+	$(cells[2]).text(time_ms(bench[2]) + " ms");
+	if (bench[1] <= legacy_max)
+	{
+	    $(cells[3]).text(time_ms(bench[3]) + " ms");
+	}
+	else
+	{
+	    $(cells[3]).text("skipped");
+	}
+	results.append(row);
+	// Let the page repaint between cases
+	setTimeout(next, 0);
+    }
+    next();
+}
+
+$(function() {
+    var match = /[?&]legacy_max=(\d+)/.exec(window.location.search);
+    var legacy_max = match ? parseInt(match[1], 10) : LEGACY_MAX_BYTES;
+    $("#run").click(function() {
+	$("#results tr.result").remove();
+	run_benchmarks($("#results"), legacy_max);
+    });
+});
@@ -0,0 +1,223 @@
+// Decoding blobs and showing them as a hexdump.
+//
+// Blobs can be several megabytes so the bytes are kept in a
+// Uint8Array and decoded with the browser's own atob and TextDecoder
+// where they exist.  The `_legacy` versions, which build plain arrays
+// a byte at a time, remain for browsers without them and for
+// comparison in bench/binary.html.
+
+var HAS_TYPED_ARRAYS = (typeof Uint8Array != "undefined"
+			&& typeof atob != "undefined");
+
+function b64decode_legacy(b64data) {
+    /* Nod to http://www.webtoolkit.info/javascript-base64.html */
+    
+    var keys = ("ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+		+ "abcdefghijklmnopqrstuvwxyz"
+		+ "0123456789+/");
+    var output = [];
+    var chr1, chr2, chr3;
+    var enc1, enc2, enc3, enc4;
+    var i = 0;
+    var input = b64data.replace(/[^A-Za-z0-9\+\/]/g, "");
+    while (i < input.length)
+    {
+	enc1 = keys.indexOf(input.charAt(i++));
+	enc2 = keys.indexOf(input.charAt(i++));
+	chr1 = (enc1 << 2) | (enc2 >> 4);
+	output.push(chr1);
+	if (input.length == i)
+	{
+	    break;
+	}
+	enc3 = keys.indexOf(input.charAt(i++));
+	chr2 = ((enc2 & 15) << 4) | (enc3 >> 2);
+	output.push(chr2);
+	if (input.length == i)
+	{
+	    break;
+	}
+	enc4 = keys.indexOf(input.charAt(i++));
+	chr3 = ((enc3 & 3) << 6) | enc4;
+	output.push(chr3);
+    }
+    return output;
+}
+
+function b64decode(b64data) {
+    if (!HAS_TYPED_ARRAYS) {
+	return b64decode_legacy(b64data);
+    }
+    var binary = atob(b64data.replace(/[^A-Za-z0-9\+\/=]/g, ""));
+    var bytes = new Uint8Array(binary.length);
+    for (var i = 0; i < binary.length; i++) {
+	bytes[i] = binary.charCodeAt(i);
+    }
+    return bytes;
+}
+
+function utf8_decode_legacy(byte_codes) {
+    var codes = [];
+    for (var i = 0; i < byte_codes.length; i++) {
+	var hex_string = "00" + byte_codes[i].toString(16);
+	var hex_string = hex_string.substring(hex_string.length - 2,
+					      hex_string.length);
+	codes.push("%" + hex_string);
+    }
+    return decodeURIComponent(codes.join(""));
+}
+
+function utf8_decode(byte_codes) {
+    if (typeof TextDecoder == "undefined") {
+	return utf8_decode_legacy(byte_codes);
+    }
+    if (!(byte_codes instanceof Uint8Array)) {
+	byte_codes = new Uint8Array(byte_codes);
+    }
+    return new TextDecoder("utf-8", {"fatal": true}).decode(byte_codes);
+}
+
+function utf8_encode_legacy(string) {
+    var encoded = [];
+    for (var i = 0; i < string.length; i++) {
+	var strchr = encodeURIComponent(string[i]);
+	if (strchr.length == 1) {
+	    encoded.push(strchr.charCodeAt(0))
+	} else {
+	    var parts = strchr.substring(1).split("%");
+	    for (var j = 0; j < parts.length; j++) {
+		encoded.push(parseInt(parts[j], 16));
+	    }
+	}
+    }
+    return encoded;
+}
+
+function utf8_encode(string) {
+    if (typeof TextEncoder == "undefined") {
+	return utf8_encode_legacy(string);
+    }
+    return new TextEncoder().encode(string);
+}
+
+// A hexdump in the style of `hexdump -C`: sixteen bytes per row
+// followed by a last row holding the length.  Rows are formatted on
+// demand so that render_hexdump only builds the rows that are on
+// screen, however big the blob.
+
+var HEXDUMP_ROW_HEIGHT = 18; // pixels
+var HEXDUMP_VISIBLE_ROWS = 40;
+var HEXDUMP_OVERSCAN_ROWS = 20;
+
+function hexdump_offset(offset)
+{
+    var line_id = "00000000" + offset.toString(16);
+    return line_id.substring(line_id.length - 8);
+}
+
+function hexdump_row_count(charcodes)
+{
+    return Math.ceil(charcodes.length / 16) + 1;
+}
+
+function hexdump_row(charcodes, row)
+{
+    var start = row * 16;
+    if (start >= charcodes.length)
+    {
+	return hexdump_offset(charcodes.length);
+    }
+    var end = Math.min(start + 16, charcodes.length);
+    var hex_result = [];
+    var str_result = [];
+    for (var i = start; i < end; i++)
+    {
+	var code = charcodes[i];
+	hex_result.push(("0" + code.toString(16)).substr(-2, 2));
+	if (code >= 32 && code <= 126)
+	{
+	    str_result.push(String.fromCharCode(code));
+	}
+	else
+	{
+	    str_result.push(".");
+	}
+    }
+    var hex_part_padding = ("                        "
+			    + "                        ");
+    var hex_part = (hex_result.join(" ") + hex_part_padding).substr(
+	0, hex_part_padding.length);
+    var hex_part = (hex_part.substr(0, hex_part.length / 2) + " "
+		    + hex_part.substr(hex_part.length / 2));
+    return (hexdump_offset(start) + "  " + hex_part + " |"
+	    + str_result.join("") + "|");
+}
+
+function hexdump_rows(charcodes, first, last)
+{
+    var result = [];
+    for (var row = first; row < last; row++)
+    {
+	result.push(hexdump_row(charcodes, row));
+    }
+    return result;
+}
+
+function hexdump(charcodes)
+{
+    return hexdump_rows(
+	charcodes, 0, hexdump_row_count(charcodes)).join("\r\n");
+}
+
+// Returns a scrolling element that holds a <pre> with only the rows
+// near the visible ones, redrawn as it scrolls, above a spacer that
+// gives the scroll bar the height of the whole dump.
+function render_hexdump(charcodes)
+{
+    var row_count = hexdump_row_count(charcodes);
+    var viewport = $('<div class="hexdump"></div>');
+    var spacer = $('<div></div>');
+    var pre = $('<pre></pre>');
+    viewport.css({
+	"height": (Math.min(row_count, HEXDUMP_VISIBLE_ROWS) 
+		   * HEXDUMP_ROW_HEIGHT) + "px"
+    });
+    spacer.css({"height": (row_count * HEXDUMP_ROW_HEIGHT) + "px"});
+    pre.css({"line-height": HEXDUMP_ROW_HEIGHT + "px"});
+    viewport.append(spacer);
+    viewport.append(pre);
+    var drawn_first = -1;
+    var pending = false;
+    function draw()
+    {
+	pending = false;
+	var top_row = Math.floor(viewport.scrollTop() / HEXDUMP_ROW_HEIGHT);
+	var first = Math.max(0, top_row - HEXDUMP_OVERSCAN_ROWS);
+	if (first == drawn_first)
+	{
+	    return;
+	}
+	var last = Math.min(row_count, (top_row + HEXDUMP_VISIBLE_ROWS
+					+ HEXDUMP_OVERSCAN_ROWS));
+	pre.css({"top": (first * HEXDUMP_ROW_HEIGHT) + "px"});
+	pre.text(hexdump_rows(charcodes, first, last).join("\r\n"));
+	drawn_first = first;
+    }
+    viewport.on("scroll", function() {
+	if (pending)
+	{
+	    return;
+	}
+	pending = true;
+	if (typeof requestAnimationFrame != "undefined")
+	{
+	    requestAnimationFrame(draw);
+	}
+	else
+	{
+	    setTimeout(draw, 0);
+	}
+    });
+    draw();
+    return viewport;
+}
@@ -0,0 +1,162 @@
+// Line by line differences between two versions of a file, for the
+// diff page.  The lines that the two have in common at the start and
+// end are set aside first, and the rest are compared with Myers'
+// algorithm, which takes time in proportion to the length of the
+// files times the number of edits.  Past DIFF_MAX_EDITS the whole of
+// the middle is shown as removed and then added.
+
+var DIFF_MAX_EDITS = 2000;
+var DIFF_CONTEXT = 3; // lines
+
+function myers_edits(a, b)
+{
+    var n = a.length;
+    var m = b.length;
+    var v = {"1": 0};
+    var trace = [];
+    search:
+    for (var d = 0; d <= n + m; d++)
+    {
+	if (d > DIFF_MAX_EDITS)
+	{
+	    return null;
+	}
+	trace.push(_.clone(v));
+	for (var k = -d; k <= d; k += 2)
+	{
+	    if (k == -d || (k != d && v[k - 1] < v[k + 1]))
+	    {
+		var x = v[k + 1];
+	    }
+	    else
+	    {
+		var x = v[k - 1] + 1;
+	    }
+	    var y = x - k;
+	    while (x < n && y < m && a[x] == b[y])
+	    {
+		x += 1;
+		y += 1;
+	    }
+	    v[k] = x;
+	    if (x >= n && y >= m)
+	    {
+		break search;
+	    }
+	}
+    }
+    // Walk back from the end, through the furthest points that each
+    // number of edits reached, to find the edits on the way
+    var edits = [];
+    var x = n;
+    var y = m;
+    for (var d = trace.length - 1; d >= 0; d--)
+    {
+	var v = trace[d];
+	var k = x - y;
+	if (k == -d || (k != d && v[k - 1] < v[k + 1]))
+	{
+	    var previous_k = k + 1;
+	}
+	else
+	{
+	    var previous_k = k - 1;
+	}
+	var previous_x = v[previous_k];
+	var previous_y = previous_x - previous_k;
+	while (x > previous_x && y > previous_y)
+	{
+	    x -= 1;
+	    y -= 1;
+	    edits.push([" ", a[x]]);
+	}
+	if (d > 0)
+	{
+	    if (x == previous_x)
+	    {
+		edits.push(["+", b[previous_y]]);
+	    }
+	    else
+	    {
+		edits.push(["-", a[previous_x]]);
+	    }
+	}
+	x = previous_x;
+	y = previous_y;
+    }
+    return edits.reverse();
+}
+
+// Returns a list of [op, line] pairs, where op is " " for a line in
+// both, "-" for one only in a and "+" for one only in b
+function diff_lines(a, b)
+{
+    var start = 0;
+    while (start < a.length && start < b.length && a[start] == b[start])
+    {
+	start += 1;
+    }
+    var end = 0;
+    while (end < a.length - start && end < b.length - start
+	   && a[a.length - 1 - end] == b[b.length - 1 - end])
+    {
+	end += 1;
+    }
+    var middle_a = a.slice(start, a.length - end);
+    var middle_b = b.slice(start, b.length - end);
+    var middle = myers_edits(middle_a, middle_b);
+    if (middle === null)
+    {
+	middle = [].concat(
+	    _.map(middle_a, function(line) {return ["-", line]}),
+	    _.map(middle_b, function(line) {return ["+", line]}));
+    }
+    var same = function(line) {return [" ", line]};
+    return [].concat(_.map(a.slice(0, start), same), middle,
+		     _.map(a.slice(a.length - end), same));
+}
+
+// Groups the edits into hunks of changes with DIFF_CONTEXT lines
+// around them, each a list of {op, line, old_number, new_number}
+function diff_hunks(edits)
+{
+    var lines = [];
+    var old_number = 1;
+    var new_number = 1;
+    _.each(edits, function(edit) {
+	lines.push({"op": edit[0], "line": edit[1], 
+		    "old_number": edit[0] == "+" ? null : old_number,
+		    "new_number": edit[0] == "-" ? null : new_number});
+	old_number += (edit[0] == "+" ? 0 : 1);
+	new_number += (edit[0] == "-" ? 0 : 1);
+    });
+    var shown = [];
+    for (var i = 0; i < lines.length; i++)
+    {
+	if (lines[i].op != " ")
+	{
+	    for (var j = Math.max(0, i - DIFF_CONTEXT); 
+		 j <= Math.min(lines.length - 1, i + DIFF_CONTEXT); j++)
+	    {
+		shown[j] = true;
+	    }
+	}
+    }
+    var hunks = [];
+    var hunk = null;
+    for (var i = 0; i < lines.length; i++)
+    {
+	if (!shown[i])
+	{
+	    hunk = null;
+	    continue;
+	}
+	if (hunk === null)
+	{
+	    hunk = [];
+	    hunks.push(hunk);
+	}
+	hunk.push(lines[i]);
+    }
+    return hunks;
+}
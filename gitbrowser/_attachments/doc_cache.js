@@ -0,0 +1,195 @@
+// A cache of the JSON documents that the browser fetches, in memory
+// for this page and in IndexedDB across visits.
+//
+// Documents named after their content, such as git-tree-:sha, never
+// change so a cached copy is used without asking the server.  Others,
+// such as the branch documents, are returned from the cache straight
+// away and then fetched again in the background; if the server has a
+// different revision then the callback is called a second time with
+// it.  Either way, anything already cached can be shown offline.
+//
+// The memory cache holds DOC_CACHE_MEMORY_ENTRIES documents and
+// IndexedDB at most DOC_CACHE_MAX_BYTES of JSON, both dropping the
+// least recently used documents first.
+
+var DOC_CACHE_MEMORY_ENTRIES = 1000;
+var DOC_CACHE_MAX_BYTES = 50 * 1024 * 1024;
+var DOC_CACHE_EVICT_EVERY = 50; // writes
+var DOC_CACHE_DB_NAME = "gitbrowser-doc-cache";
+var DOC_CACHE_STORE = "docs";
+
+// A Map iterates in insertion order, so a key that is deleted and
+// set again on every use leaves the least recently used key first
+var doc_cache_memory = new Map();
+var doc_cache_db = undefined;
+var doc_cache_db_waiting = [];
+var doc_cache_writes = 0;
+
+function doc_cache_remember(key, doc)
+{
+    doc_cache_memory.delete(key);
+    doc_cache_memory.set(key, doc);
+    if (doc_cache_memory.size > DOC_CACHE_MEMORY_ENTRIES)
+    {
+	doc_cache_memory.delete(doc_cache_memory.keys().next().value);
+    }
+}
+
+// Calls back with the database, or null if there is no IndexedDB or
+// it cannot be opened (e.g. in private browsing)
+function doc_cache_open(callback)
+{
+    if (doc_cache_db !== undefined)
+    {
+	return callback(doc_cache_db);
+    }
+    doc_cache_db_waiting.push(callback);
+    if (doc_cache_db_waiting.length > 1)
+    {
+	return;
+    }
+    function opened(db)
+    {
+	doc_cache_db = db;
+	var waiting = doc_cache_db_waiting;
+	doc_cache_db_waiting = [];
+	for (var i = 0; i < waiting.length; i++)
+	{
+	    waiting[i](db);
+	}
+    }
+    if (typeof indexedDB == "undefined")
+    {
+	return opened(null);
+    }
+    try
+    {
+	var request = indexedDB.open(DOC_CACHE_DB_NAME, 1);
+    }
+    catch (err)
+    {
+	return opened(null);
+    }
+    request.onupgradeneeded = function() {
+	var store = request.result.createObjectStore(
+	    DOC_CACHE_STORE, {"keyPath": "key"});
+	store.createIndex("atime", "atime");
+    };
+    request.onsuccess = function() {opened(request.result)};
+    request.onerror = function() {opened(null)};
+    request.onblocked = function() {opened(null)};
+}
+
+function doc_cache_read(key, callback)
+{
+    if (doc_cache_memory.has(key))
+    {
+	var doc = doc_cache_memory.get(key);
+	doc_cache_remember(key, doc);
+	return callback(doc);
+    }
+    doc_cache_open(function(db) {
+	if (db === null)
+	{
+	    return callback(undefined);
+	}
+	var store = db.transaction(DOC_CACHE_STORE, "readwrite")
+	    .objectStore(DOC_CACHE_STORE);
+	var request = store.get(key);
+	request.onsuccess = function() {
+	    var record = request.result;
+	    if (typeof record == "undefined")
+	    {
+		return callback(undefined);
+	    }
+	    record.atime = new Date().getTime();
+	    store.put(record);
+	    doc_cache_remember(key, record.doc);
+	    callback(record.doc);
+	};
+	request.onerror = function() {callback(undefined)};
+    });
+}
+
+function doc_cache_write(key, doc)
+{
+    doc_cache_remember(key, doc);
+    doc_cache_open(function(db) {
+	if (db === null)
+	{
+	    return;
+	}
+	db.transaction(DOC_CACHE_STORE, "readwrite")
+	    .objectStore(DOC_CACHE_STORE).put({
+		"key": key,
+		"doc": doc,
+		"bytes": JSON.stringify(doc).length,
+		"atime": new Date().getTime()
+	    });
+	doc_cache_writes += 1;
+	if (doc_cache_writes % DOC_CACHE_EVICT_EVERY == 0)
+	{
+	    doc_cache_evict(db);
+	}
+    });
+}
+
+// Walks from the most to the least recently used, deleting everything
+// after the first DOC_CACHE_MAX_BYTES
+function doc_cache_evict(db)
+{
+    var total = 0;
+    var store = db.transaction(DOC_CACHE_STORE, "readwrite")
+	.objectStore(DOC_CACHE_STORE);
+    var request = store.index("atime").openCursor(null, "prev");
+    request.onsuccess = function() {
+	var cursor = request.result;
+	if (!cursor)
+	{
+	    return;
+	}
+	total += cursor.value.bytes;
+	if (total > DOC_CACHE_MAX_BYTES)
+	{
+	    cursor["delete"]();
+	}
+	cursor["continue"]();
+    };
+}
+
+// Takes the same "url", "data", "success" and "error" as $.ajax, plus
+// the "key" to cache the response under and whether it is
+// "immutable"
+function doc_cache_fetch(params)
+{
+    var error = params.error || function() {};
+    doc_cache_read(params.key, function(cached) {
+	var have_cached = (typeof cached != "undefined");
+	if (have_cached)
+	{
+	    params.success(cached);
+	    if (params.immutable)
+	    {
+		return;
+	    }
+	}
+	$.ajax({
+	    "url": params.url,
+	    "data": params.data || {},
+	    "dataType": "json",
+	    "success": function(doc) {
+		doc_cache_write(params.key, doc);
+		if (!have_cached || cached._rev != doc._rev)
+		{
+		    params.success(doc);
+		}
+	    },
+	    "error": function() {
+		if (!have_cached)
+		{
+		    error();
+		}
+	    }
+	});
+    });
+}
@@ -0,0 +1,237 @@
+// Highlights a source file and splits it into docco rows, away from
+// the page's main thread.
+//
+// The worker is sent `{"id", "text", "language", "comment"}`, where
+// `language` is a highlight.js language name (or null to guess) and
+// `comment` is the source of a regular expression that matches the
+// comment markers to strip from the documentation.  It answers
+// `{"id", "segments"}` with a list of `[docs_html, code_html]` rows.
+//
+// The page also loads this script, so that docco_segments can be
+// run directly in browsers without web workers, and so does
+// doccorender.py, which runs docco_render_file under node to store
+// the rows of the files at the head of each branch ahead of time.
+
+var EXTRA_TEXT_TYPES = [
+    "application/javascript",
+    "application/json",
+    "application/x-sh"
+];
+
+// The comment markers are regular expression sources, rather than
+// functions, so that they can be posted to the docco worker
+var HIGHLIGHT_MIME_TYPES = {
+    "text/x-python": {"name": "python", "comment": "^#"},
+    "application/javascript": {"name": "javascript", "comment": "^//"},
+    "text/x-coffeescript": {"name": "coffeescript", "comment": "^#"},
+    "text/x-sql": {"name": "sql", "comment": "^--"}
+};
+
+function is_text_mime_type(mime_type)
+{
+    if (mime_type.substring(0, 5) == "text/")
+    {
+	return true;
+    }
+    for (var i = 0; i < EXTRA_TEXT_TYPES.length; i++)
+    {
+	if (mime_type == EXTRA_TEXT_TYPES[i])
+	{
+	    return true;
+	}
+    }
+    return false;
+}
+
+// Plain text is shown as Markdown, everything else textual as docco
+function is_docco_mime_type(mime_type)
+{
+    return is_text_mime_type(mime_type) && mime_type != "text/plain";
+}
+
+function highlight_options(mime_type)
+{
+    if (HIGHLIGHT_MIME_TYPES.hasOwnProperty(mime_type))
+    {
+	return HIGHLIGHT_MIME_TYPES[mime_type];
+    }
+    return {"name": null, "comment": null};
+}
+
+function docco_escape(text)
+{
+    return text.replace(/&/g, "&amp;").replace(/</g, "&lt;");
+}
+
+function docco_unescape(html)
+{
+    return (html.replace(/<[^>]*>/g, "").replace(/&lt;/g, "<")
+	    .replace(/&gt;/g, ">").replace(/&amp;/g, "&"));
+}
+
+// Splits highlight.js output into its top level nodes: runs of text
+// and whole (possibly nested) spans.
+function split_highlighted(html)
+{
+    var items = [];
+    var tag = /<(\/?)span[^>]*>/g;
+    var depth = 0;
+    var start = 0;
+    var text_start = 0;
+    var match;
+    while ((match = tag.exec(html)) !== null)
+    {
+	if (match[1] == "")
+	{
+	    if (depth == 0)
+	    {
+		if (match.index > text_start)
+		{
+		    items.push({"is_text": true, 
+				"html": html.substring(text_start, 
+						       match.index)});
+		}
+		start = match.index;
+	    }
+	    depth += 1;
+	}
+	else
+	{
+	    depth -= 1;
+	    if (depth == 0)
+	    {
+		var span = html.substring(start, tag.lastIndex);
+		items.push({"is_text": false,
+			    "is_comment": /^<span class="comment"/.test(span),
+			    "html": span});
+		text_start = tag.lastIndex;
+	    }
+	}
+    }
+    if (text_start < html.length)
+    {
+	items.push({"is_text": true, "html": html.substring(text_start)});
+    }
+    return items;
+}
+
+// A row starts with the whole-line comments at the current position,
+// which become its documentation, and takes the code up to the next
+// whole-line comment.  A blank line after a comment block gives that
+// block a row of its own.
+function segment_items(items)
+{
+    var rows = [];
+    var i = 0;
+    function peek()
+    {
+	return (items.length - i >= 2 && items[i].is_comment
+		&& items[i + 1].is_text 
+		&& items[i + 1].html.charAt(0) == "\n");
+    }
+    while (i < items.length)
+    {
+	var docs = [];
+	var code = [];
+	rows.push([docs, code]);
+	while (peek())
+	{
+	    docs.push(items[i].html, "\n");
+	    var newline = items[i + 1].html;
+	    if (newline == "\n")
+	    {
+		i += 2;
+	    }
+	    else
+	    {
+		items[i + 1] = {"is_text": true, 
+				"html": newline.substring(1)};
+		i += 1;
+	    }
+	}
+	if (docs.length > 0 && i < items.length && items[i].is_text
+	    && items[i].html.charAt(0) == "\n")
+	{
+	    continue;
+	}
+	while (i < items.length)
+	{
+	    var item = items[i];
+	    i += 1;
+	    code.push(item.html);
+	    if (item.is_text 
+		&& item.html.charAt(item.html.length - 1) == "\n"
+		&& peek())
+	    {
+		break;
+	    }
+	}
+    }
+    return rows;
+}
+
+function docco_segments(text, language, comment)
+{
+    // Comments are only recognised as whole lines when followed by
+    // a bare newline
+    text = text.replace(/\r\n?/g, "\n");
+    var highlighted;
+    try
+    {
+	if (language === null)
+	{
+	    highlighted = hljs.highlightAuto(text).value;
+	}
+	else
+	{
+	    highlighted = hljs.highlight(language, text).value;
+	}
+    }
+    catch (err)
+    {
+	return [["", docco_escape(text)]];
+    }
+    var converter = new Showdown.converter();
+    var comment_re = (comment === null) ? null : new RegExp(comment, "gm");
+    var rows = segment_items(split_highlighted(highlighted));
+    var segments = [];
+    for (var i = 0; i < rows.length; i++)
+    {
+	var docs = docco_unescape(rows[i][0].join(""));
+	if (comment_re !== null)
+	{
+	    docs = docs.replace(comment_re, "");
+	}
+	segments.push([converter.makeHtml(docs), rows[i][1].join("")]);
+    }
+    return segments;
+}
+
+// Needs libmagic.js, which the worker does not load
+function docco_mime_type(basename)
+{
+    var doc = {"basename": basename};
+    guess_file_type(doc);
+    return doc.mime_type;
+}
+
+function docco_render_file(basename, text)
+{
+    var mime_type = docco_mime_type(basename);
+    var options = highlight_options(mime_type);
+    return {"mime_type": mime_type,
+	    "segments": docco_segments(text, options.name, options.comment)};
+}
+
+if (typeof document == "undefined" && typeof importScripts == "function")
+{
+    importScripts("highlight.js/highlight.pack.js", "showdown.js");
+    onmessage = function(event) {
+	var request = event.data;
+	postMessage({
+	    "id": request.id,
+	    "segments": docco_segments(request.text, request.language,
+				       request.comment)
+	});
+    };
+}
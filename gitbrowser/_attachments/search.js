@@ -0,0 +1,222 @@
+// Searching the files at the head of a branch with the trigram index
+// that `gitcouchdbsync.py --index` writes.
+//
+// A regular expression can only match text that has in it the runs of
+// plain characters that the expression requires, so the only files
+// worth reading are those whose posting lists hold every trigram of
+// those runs.  The runs found here are an underestimate, which is
+// safe: anything inside a group or a character class is left out, and
+// an expression with a "|" outside of any group requires nothing.
+
+// Returns the runs of characters that any match must contain, or null
+// if there is no telling
+function regexp_literals(source)
+{
+    var literals = [];
+    var current = "";
+    function finish()
+    {
+	if (current.length > 0)
+	{
+	    literals.push(current);
+	}
+	current = "";
+    }
+    // Skips over a group or class starting at i, returning the index
+    // after its end
+    function skip_nested(i)
+    {
+	var depth = 0;
+	var in_class = false;
+	for (; i < source.length; i++)
+	{
+	    var c = source.charAt(i);
+	    if (c == "\\")
+	    {
+		i += 1;
+	    }
+	    else if (in_class)
+	    {
+		in_class = (c != "]");
+	    }
+	    else if (c == "[")
+	    {
+		in_class = true;
+	    }
+	    else if (c == "(")
+	    {
+		depth += 1;
+	    }
+	    else if (c == ")")
+	    {
+		depth -= 1;
+	    }
+	    if (depth == 0 && !in_class)
+	    {
+		return i + 1;
+	    }
+	}
+	return i;
+    }
+    var i = 0;
+    while (i < source.length)
+    {
+	var c = source.charAt(i);
+	var braces = /^\{(\d+)(,\d*)?\}/.exec(source.substring(i));
+	if (c == "\\")
+	{
+	    var next = source.charAt(i + 1);
+	    i += 2;
+	    if (!/[0-9A-Za-z]/.test(next))
+	    {
+		current += next;
+		continue;
+	    }
+	    // A class such as \d, a control character or a back
+	    // reference
+	    finish();
+	    if (next == "x")
+	    {
+		i += 2;
+	    }
+	    else if (next == "u")
+	    {
+		i += 4;
+	    }
+	    else if (next == "c")
+	    {
+		i += 1;
+	    }
+	    else if (/[0-9]/.test(next))
+	    {
+		while (/[0-9]/.test(source.charAt(i)))
+		{
+		    i += 1;
+		}
+	    }
+	}
+	else if (c == "*" || c == "?" || (braces && braces[1] == "0"))
+	{
+	    // The character before is optional
+	    current = current.substring(0, current.length - 1);
+	    finish();
+	    i += braces ? braces[0].length : 1;
+	}
+	else if (c == "+" || braces)
+	{
+	    finish();
+	    i += braces ? braces[0].length : 1;
+	}
+	else if (c == "(" || c == "[")
+	{
+	    finish();
+	    i = skip_nested(i);
+	}
+	else if (c == "|")
+	{
+	    return null;
+	}
+	else if (c == "." || c == "^" || c == "$")
+	{
+	    finish();
+	    i += 1;
+	}
+	else
+	{
+	    current += c;
+	    i += 1;
+	}
+    }
+    finish();
+    return literals;
+}
+
+function hex_byte(code)
+{
+    return (code < 16 ? "0" : "") + code.toString(16);
+}
+
+// The trigrams that any match must contain, as the hex keys of the
+// posting lists, or null if there is no telling.  Letters are in lower
+// case, as in the index, and only ASCII ones.
+function query_trigrams(source)
+{
+    var literals = regexp_literals(source);
+    if (literals === null)
+    {
+	return null;
+    }
+    var trigrams = {};
+    _.each(literals, function(literal) {
+	var bytes = utf8_encode(literal);
+	var key = [];
+	for (var i = 0; i < bytes.length; i++)
+	{
+	    var code = bytes[i];
+	    if (code >= 65 && code <= 90)
+	    {
+		code += 32;
+	    }
+	    key.push(hex_byte(code));
+	    if (key.length > 3)
+	    {
+		key.shift();
+	    }
+	    if (key.length == 3)
+	    {
+		trigrams[key.join("")] = true;
+	    }
+	}
+    });
+    return _.keys(trigrams);
+}
+
+// Must agree with trigram_shard() in gitcouchdbsync.py
+function trigram_shard(key, shards)
+{
+    var a = parseInt(key.substring(0, 2), 16);
+    var b = parseInt(key.substring(2, 4), 16);
+    var c = parseInt(key.substring(4, 6), 16);
+    return hex_byte(((a * 31 + b) * 31 + c) % shards);
+}
+
+function decode_postings(postings)
+{
+    var numbers = [];
+    if (typeof postings == "undefined" || postings == "")
+    {
+	return numbers;
+    }
+    var last = 0;
+    _.each(postings.split(","), function(delta) {
+	last += parseInt(delta, 36);
+	numbers.push(last);
+    });
+    return numbers;
+}
+
+// Both lists must be sorted
+function intersect_postings(a, b)
+{
+    var result = [];
+    var i = 0;
+    var j = 0;
+    while (i < a.length && j < b.length)
+    {
+	if (a[i] < b[j])
+	{
+	    i += 1;
+	}
+	else if (a[i] > b[j])
+	{
+	    j += 1;
+	}
+	else
+	{
+	    result.push(a[i]);
+	    i += 1;
+	    j += 1;
+	}
+    }
+    return result;
+}
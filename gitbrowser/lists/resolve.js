@@ -0,0 +1,21 @@
+function(head, req) {
+    // Answers ?key=[tree_id, path] on the paths view with the tree or
+    // blob at that path, rather than a list of rows, so that the
+    // browser gets the object itself in a single response.  A path
+    // within a tree never changes so a successful answer can be
+    // cached forever.  The same goes for ?key=sha on the history
+    // view, which answers with a history page holding that commit.
+    var row = getRow();
+    if (!row || !row.doc) {
+	start({"code": 404, 
+	       "headers": {"Content-Type": "application/json"}});
+	send(JSON.stringify({"error": "not_found", 
+			    "reason": "Nothing at path"}));
+	return;
+    }
+    start({"headers": {
+	"Content-Type": "application/json",
+	"Cache-Control": "public, max-age=31536000, immutable"
+    }});
+    send(JSON.stringify(row.doc));
+}
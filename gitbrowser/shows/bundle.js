@@ -0,0 +1,16 @@
+function(doc, req) {
+    // Serves the script and stylesheet bundles that couchapplib.py
+    // builds from the pages listed in couchapp.json.  A bundle is
+    // named after its content so it can be cached forever.
+    var bundles = this.bundles || {};
+    var bundle = bundles[req.query.name];
+    if (!bundle) {
+	return {"code": 404, 
+		"headers": {"Content-Type": "text/plain"},
+		"body": "No such bundle"};
+    }
+    return {"headers": {
+	"Content-Type": bundle.content_type,
+	"Cache-Control": "public, max-age=31536000, immutable"
+    }, "body": bundle.data};
+}
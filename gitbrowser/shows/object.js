@@ -0,0 +1,19 @@
+function(doc, req) {
+    // Serves a document by id like /db/ does, except that trees,
+    // blobs, commits, path indexes, renderings, history pages and
+    // diffs are named after their content so they are sent with
+    // headers that let them be cached forever.
+    if (!doc) {
+	return {"code": 404, 
+		"headers": {"Content-Type": "application/json"},
+		"body": JSON.stringify({"error": "not_found", 
+					"reason": "missing"})};
+    }
+    var headers = {"Content-Type": "application/json"};
+    if (/^git-(tree|blob|commit|pathindex|rendered|history|diff)-[0-9a-f]{40}$/.test(doc._id)) {
+	headers["Cache-Control"] = "public, max-age=31536000, immutable";
+    } else {
+	headers["Cache-Control"] = "no-cache";
+    }
+    return {"headers": headers, "body": JSON.stringify(doc)};
+}
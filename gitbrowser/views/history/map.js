@@ -0,0 +1,11 @@
+function(doc) {
+    // Every commit in every history page, so that the history from
+    // any commit on a branch can start from a page that holds it.
+    // The pages below a commit are the same whichever page it is
+    // found in.
+    if (doc.type == "git-history") {
+	for (var i = 0; i < doc.commits.length; i++) {
+	    emit(doc.commits[i].sha, null);
+	}
+    }
+}
@@ -0,0 +1,13 @@
+function(doc) {
+    // Every path in the tree at the head of a branch, keyed by
+    // [tree_id, path] with "" for the root, so that a whole path
+    // resolves in one lookup.  The value links to the object for
+    // include_docs.
+    if (doc.type == "git-pathindex") {
+	emit([doc.tree._id, ""], {"_id": doc.tree._id});
+	for (var path in doc.paths) {
+	    var entry = doc.paths[path];
+	    emit([doc.tree._id, path], {"_id": entry._id, "mode": entry.mode});
+	}
+    }
+}
@@ -14,6 +14,38 @@ e.g. git-branch-:branch.  These branch document are also fully mutable
 are ever deleted.  Other documents for the commits, blobs and trees
 are, in theory, are immutable.
 
+The tree at the head of each branch also gets a git-pathindex-:sha
+document listing the id and mode of everything in the tree by its
+full path, e.g. "a/b/c.txt", so that a browser can find any file with
+one lookup instead of walking down the trees.  It is derived entirely
+from the tree and so is immutable too.  The branch document refers to
+its tree and path index directly.
+
+History is stored as git-history-:sha pages of HISTORY_PAGE_SIZE
+commits, following first parents from the commit :sha, each naming
+the page after it.  Pages end at fixed depths (the number of commits
+on the first parent chain down to the root) so that when a branch
+moves on only its top page is new and the rest, which are immutable,
+are shared.  The branch document refers to the page for its head.
+
+Each commit also gets a git-diff-:sha document listing the paths that
+it added, removed and modified compared to its first parent, with the
+blobs before and after, so that a browser can show what a commit
+changed without comparing the two trees itself.  It is synchronized
+along with the commit.
+
+With --render, the text files in those trees are also rendered into
+the git browser's docco view, highlighted and split into
+documentation and code rows, and stored in git-rendered-:sha
+documents named after the blob.  The browser uses these when it finds
+them, rather than doing the same work for every visitor.  See
+doccorender.py.
+
+With --index, the text files in those trees are also indexed by the
+trigrams they contain, in git-trigrams-:shard documents, so that the
+git browser can search them.  These are mutable and are added to as
+new files turn up.  See "Trigram index" below.
+
 Objects are copied in dependency order i.e. the presence of an object
 implied that, recursively, the objects it refers to are also present.
 This is an assumption that the synchronizer relies upon in order to do
@@ -43,7 +75,8 @@ from hashlib import sha1
 from jwalutil import trim, read_lines, get1, is_text
 from pprint import pformat
 from process import call
-from couchdblib import get, put, put_update
+from couchdblib import get, put, put_update, iter_all_docs
+from doccorender import docco_mime_types, render_files
 from posixutils import octal_to_symbolic_mode, symbolic_to_octal_mode
 import base64
 import contextlib
@@ -102,6 +135,13 @@ def resolve_document_using_git(git, docref):
             read_lines(
                 call(git + ["rev-parse", docref.name])))
         document["commit"] = docref_to_dict(ShaDocRef("commit", sha))
+        tree_sha = get1(
+            read_lines(
+                call(git + ["rev-parse", sha + "^{tree}"])))
+        document["tree"] = docref_to_dict(ShaDocRef("tree", tree_sha))
+        document["pathindex"] = docref_to_dict(
+            ShaDocRef("pathindex", tree_sha))
+        document["history"] = docref_to_dict(ShaDocRef("history", sha))
     elif kind == "commit":
         document.update(
             {"author": {"name": get("%an"),
@@ -129,6 +169,24 @@ def resolve_document_using_git(git, docref):
                    "mode": octal_to_symbolic_mode(child_mode)}
             document["children"].append(ref)
         document["children"].sort(key=lambda a: a["child"]["sha"])
+    elif kind == "pathindex":
+        document["tree"] = docref_to_dict(ShaDocRef("tree", docref.name))
+        document["paths"] = {}
+        output = call(git + ["ls-tree", "-r", "-t", "-z", docref.name],
+                      do_crlf_fix=False)
+        for line in output.split("\0"):
+            if line == "":
+                continue
+            child_mode, child_kind, rest = line.split(" ", 2)
+            child_sha, child_path = rest.split("\t", 1)
+            entry = docref_to_dict(ShaDocRef(child_kind, child_sha))
+            entry["mode"] = octal_to_symbolic_mode(child_mode)
+            del entry["sha"]
+            document["paths"][child_path.decode("utf-8")] = entry
+    elif kind == "history":
+        document.update(history_page(git, docref.name))
+    elif kind == "diff":
+        document.update(commit_diff(git, docref.name))
     elif kind == "blob":
         blob = call(git + ["show", docref.name], do_crlf_fix=False)
         if is_text(blob):
@@ -141,8 +199,97 @@ def resolve_document_using_git(git, docref):
         raise NotImplementedError(kind)
     return document
 
+### History pages
+#
+# The depth of the commit after each page is remembered so that
+# walking down a long history only counts the commits once.
+HISTORY_PAGE_SIZE = 100
+HISTORY_FORMAT = "%H%x1f%P%x1f%an%x1f%ai%x1f%s"
+
+history_depths = {}
+
+def first_parent_depth(git, sha):
+    if sha not in history_depths:
+        history_depths[sha] = int(get1(read_lines(
+                    call(git + ["rev-list", "--first-parent", "--count", 
+                                sha]))))
+    return history_depths[sha]
+
+def history_page(git, sha):
+    depth = first_parent_depth(git, sha)
+    count = depth - ((depth - 1) // HISTORY_PAGE_SIZE) * HISTORY_PAGE_SIZE
+    output = call(git + ["log", "--first-parent", "-n", str(count),
+                         "--format=tformat:" + HISTORY_FORMAT, sha])
+    page = {"depth": depth, "commits": []}
+    for i, line in enumerate(read_lines(output)):
+        commit_sha, parents, author, date, subject = line.split("\x1f", 4)
+        page["commits"].append({
+                "sha": commit_sha,
+                "parents": len(parents.split()),
+                "author": author.decode("utf-8", "replace"),
+                "date": date,
+                "subject": subject.decode("utf-8", "replace"),
+                "depth": depth - i})
+        last_parents = parents.split()
+    assert len(page["commits"]) == count, (sha, count)
+    if depth > count:
+        next_sha = last_parents[0]
+        history_depths[next_sha] = depth - count
+        page["next"] = docref_to_dict(ShaDocRef("history", next_sha))
+    return page
+
+### Commit diffs
+#
+# The diff is against the first parent, or against nothing for a root
+# commit, and git prunes the subtrees that are the same on both sides
+# by their ids.  Renames are not detected; they are a removal and an
+# addition.  Submodules show up as a commit rather than a blob.
+def diff_entry(mode, sha):
+    kind = "commit" if mode == "160000" else "blob"
+    entry = docref_to_dict(ShaDocRef(kind, sha))
+    entry["mode"] = octal_to_symbolic_mode(mode)
+    del entry["sha"]
+    return entry
+
+def commit_diff(git, sha):
+    parents = read_lines(call(git + ["rev-list", "--parents", "-n", "1", 
+                                     sha]))
+    parents = get1(parents).split(" ")[1:]
+    diff = {"tree": docref_to_dict(ShaDocRef(
+                "tree", get1(read_lines(call(git + ["rev-parse", 
+                                                    sha + "^{tree}"]))))),
+            "added": [], "removed": [], "modified": []}
+    options = ["diff-tree", "-r", "-z", "--no-renames", "--no-commit-id"]
+    if len(parents) == 0:
+        output = call(git + options + ["--root", sha], do_crlf_fix=False)
+    else:
+        diff["parent"] = docref_to_dict(ShaDocRef("commit", parents[0]))
+        output = call(git + options + [parents[0], sha], do_crlf_fix=False)
+    fields = output.split("\0")
+    assert fields[-1] == "", fields[-1:]
+    for info, path in zip(fields[0:-1:2], fields[1:-1:2]):
+        old_mode, new_mode, old_sha, new_sha, status = \
+            trim(info, prefix=":").split(" ")
+        change = {"path": path.decode("utf-8")}
+        if status == "A":
+            change["new"] = diff_entry(new_mode, new_sha)
+            diff["added"].append(change)
+        elif status == "D":
+            change["old"] = diff_entry(old_mode, old_sha)
+            diff["removed"].append(change)
+        elif status in ("M", "T"):
+            change["old"] = diff_entry(old_mode, old_sha)
+            change["new"] = diff_entry(new_mode, new_sha)
+            diff["modified"].append(change)
+        else:
+            raise NotImplementedError(status)
+    return diff
+
 DocRef = namedtuple("DocRef", ["id", "kind", "name"])
 
+SHA_KINDS = ("tree", "blob", "commit", "pathindex", "rendered", "history",
+             "diff")
+
 def BranchDocref(branch):
     branch = unicode(branch)
     return DocRef("git-branch-" + branch, "branch", branch)
@@ -150,7 +297,7 @@ def BranchDocref(branch):
 def ShaDocRef(kind, sha):
     kind = unicode(kind)
     sha = unicode(sha)
-    assert kind in ("tree", "blob", "commit"), kind
+    assert kind in SHA_KINDS, kind
     assert len(sha) == len(sha1().hexdigest()), repr(sha)
     return DocRef("git-" + kind + "-" + sha, kind, sha)
 
@@ -159,7 +306,7 @@ def id_to_docref(id):
     if most == "branches":
         return BRANCHES_DOCREF
     kind, name = most.split("-", 1)
-    assert kind in ("branch", "tree", "commit", "blob"), repr(id)
+    assert kind in MUTABLE_TYPES or kind in SHA_KINDS, repr(id)
     return DocRef(id, kind, name)
 
 BRANCHES_DOCREF = DocRef(u"git-branches", u"branches", None)
@@ -173,7 +320,7 @@ def docref_to_dict(docref):
         assert docref.name is None, docref
         return {"_id": docref.id,
                 "type": "git-" + docref.kind}
-    elif docref.kind in ("tree", "commit", "blob"):
+    elif docref.kind in SHA_KINDS:
         return {"_id": docref.id,
                 "type": "git-" + docref.kind,
                 "sha": docref.name}
@@ -187,7 +334,7 @@ def dict_to_docref(document):
         return BRANCHES_DOCREF
     elif kind == "branch":
         return BranchDocref(document["branch"])
-    elif kind in ("tree", "commit", "blob"):
+    elif kind in SHA_KINDS:
         return ShaDocRef(trim(document["type"], prefix="git-"), 
                          document["sha"])
     else:
@@ -200,12 +347,31 @@ def find_dependencies(document):
             yield dict_to_docref(branch)
     elif kind == "branch":
         yield dict_to_docref(document["commit"])
+        if "pathindex" in document:
+            yield dict_to_docref(document["pathindex"])
+        if "history" in document:
+            yield dict_to_docref(document["history"])
     elif kind == "commit":
         for parent in document["parents"]:
             yield dict_to_docref(parent)
         yield dict_to_docref(document["tree"])
+        yield ShaDocRef("diff", document["sha"])
     elif kind == "blob":
         pass
+    elif kind == "pathindex":
+        yield dict_to_docref(document["tree"])
+    elif kind == "rendered":
+        yield dict_to_docref(document["blob"])
+    elif kind == "history":
+        yield ShaDocRef("commit", document["sha"])
+        if "next" in document:
+            yield dict_to_docref(document["next"])
+    elif kind == "diff":
+        # Not the commit, which depends on its diff, but what the diff
+        # was made from
+        if "parent" in document:
+            yield dict_to_docref(document["parent"])
+        yield dict_to_docref(document["tree"])
     elif kind == "tree":
         for child in document["children"]:
             yield dict_to_docref(child["child"])
@@ -217,7 +383,7 @@ SMALL_NUMBER = BIG_NUMBER // 2
 assert BIG_NUMBER > SMALL_NUMBER, (BIG_NUMBER, SMALL_NUMBER)
 assert SMALL_NUMBER > 0, SMALL_NUMBER
 
-MUTABLE_TYPES = ("branches", "branch")
+MUTABLE_TYPES = ("branches", "branch", "trigrams")
 
 def fetch_all(resolve_document, couchdb_url, seeds):
     to_fetch = list(seeds)
@@ -238,9 +404,8 @@ def fetch_all(resolve_document, couchdb_url, seeds):
     mutable_buffer = {}
     local_buffer = {}
     fetched = set()
-    for match in get(couchdb_url + "/_all_docs")["rows"]:
-        if not match["id"].startswith("git-"):
-            continue
+    for match in iter_all_docs(couchdb_url, startkey=u"git-",
+                               endkey=u"git-\ufff0"):
         docref = id_to_docref(match["id"])
         if docref.kind not in MUTABLE_TYPES:
             fetched.add(docref)
@@ -281,7 +446,233 @@ def force_couchdb_put(couchdb_url, *documents):
         put_update(posixpath.join(couchdb_url, document["_id"]),
                    lambda _: document)
 
-def git_to_couchdb(cache_root, git_url, couchdb_url):
+def iter_branch_head_blobs(couchdb_url):
+    branches = get(posixpath.join(couchdb_url, BRANCHES_DOCREF.id))
+    for branch in branches["branches"]:
+        branch_doc = get(posixpath.join(couchdb_url, branch["_id"]))
+        if "pathindex" not in branch_doc:
+            continue
+        index = get(posixpath.join(couchdb_url, 
+                                   branch_doc["pathindex"]["_id"]))
+        for path, entry in sorted(index["paths"].items()):
+            if entry["type"] == "git-blob":
+                yield path, trim(entry["_id"], prefix="git-blob-")
+
+### Rendering
+#
+# Only the files at the head of a branch, found through the path
+# indexes, are rendered.  A blob is rendered with the mime type of the
+# first name it is found under; the browser ignores the rendering if
+# it is showing the blob under a name with a different mime type.
+def render_branch_heads(git, couchdb_url):
+    rendered = set(r["id"] for r in iter_all_docs(
+            couchdb_url, startkey=u"git-rendered-", 
+            endkey=u"git-rendered-\ufff0"))
+    basenames = {}
+    for path, sha in iter_branch_head_blobs(couchdb_url):
+        docref = ShaDocRef("rendered", sha)
+        if docref.id not in rendered:
+            basenames.setdefault(docref, posixpath.basename(path))
+    docrefs = sorted(basenames)
+    mime_types = docco_mime_types([basenames[d] for d in docrefs])
+    files = []
+    for docref, mime_type in zip(docrefs, mime_types):
+        if mime_type is None:
+            continue
+        blob = call(git + ["show", docref.name], do_crlf_fix=False)
+        try:
+            files.append((docref, blob.decode("utf-8")))
+        except UnicodeDecodeError:
+            continue
+    results = render_files((basenames[d], text) for (d, text) in files)
+    for (docref, text), result in zip(files, results):
+        document = docref_to_dict(docref)
+        document["blob"] = docref_to_dict(ShaDocRef("blob", docref.name))
+        document["mime_type"] = result["mime_type"]
+        document["segments"] = result["segments"]
+        force_couchdb_put(couchdb_url, document)
+        print "render", docref
+
+### Trigram index
+#
+# The files at the head of each branch are indexed by their trigrams,
+# every run of three bytes with ASCII letters in lower case, so that
+# the browser only has to read the few files that have all of the
+# trigrams of a search.  Each blob is given a number and the posting
+# list for a trigram is the numbers of the blobs that contain it,
+# written as the differences between them in base 36 e.g. "3,a,1".
+# The posting lists are spread over TRIGRAM_SHARDS documents named
+# git-trigrams-:shard.
+#
+# The numbers are handed out in ranges of TRIGRAM_BLOBS_PER_SHARD, the
+# blob with number n being at n % TRIGRAM_BLOBS_PER_SHARD in the
+# "blobs" list of git-trigrams-blobs-:(n / TRIGRAM_BLOBS_PER_SHARD),
+# so a search only fetches the blob shards that its results are in.
+# git-trigrams-index records both shard sizes.
+#
+# A number is given out, and listed as "pending" in its blob shard,
+# before anything is added to the posting lists, and only stops being
+# pending once they have been written.  Every run indexes the pending
+# blobs as well as the new ones, so one that was interrupted is picked
+# up by the next.  All of the documents are changed with put_update
+# and adding to a posting list is a set union, so two runs at once
+# give each blob one number and lose no postings.
+#
+# Binary blobs, very big ones and ones with very many trigrams, which
+# are mostly data rather than code, are numbered but not indexed so
+# they never turn up in a search.
+TRIGRAM_SHARDS = 256
+TRIGRAM_BLOBS_PER_SHARD = 4096
+TRIGRAM_MAX_BLOB_SIZE = 1 << 20 # bytes
+TRIGRAM_MAX_TRIGRAMS = 20000
+TRIGRAMS_INDEX_ID = u"git-trigrams-index"
+TRIGRAMS_BLOBS_PREFIX = u"git-trigrams-blobs-"
+BASE_36_DIGITS = string.digits + string.ascii_lowercase
+
+assert TRIGRAM_SHARDS <= 256, TRIGRAM_SHARDS
+
+def trigram_shard(trigram):
+    a, b, c = [ord(x) for x in trigram]
+    return u"%02x" % (((a * 31 + b) * 31 + c) % TRIGRAM_SHARDS)
+
+def blob_trigrams(blob):
+    if len(blob) > TRIGRAM_MAX_BLOB_SIZE or "\0" in blob[:8000]:
+        return set()
+    blob = blob.lower()
+    trigrams = set(blob[i:i + 3] for i in xrange(len(blob) - 2))
+    if len(trigrams) > TRIGRAM_MAX_TRIGRAMS:
+        return set()
+    return trigrams
+
+def to_base_36(number):
+    digits = []
+    while True:
+        number, digit = divmod(number, 36)
+        digits.append(BASE_36_DIGITS[digit])
+        if number == 0:
+            return "".join(reversed(digits))
+
+def decode_postings(postings):
+    numbers = []
+    for delta in postings.split(","):
+        numbers.append(int(delta, 36) + (numbers[-1] if numbers else 0))
+    return numbers
+
+def merge_postings(postings, numbers):
+    merged = set(numbers)
+    if postings:
+        merged.update(decode_postings(postings))
+    deltas = []
+    last = 0
+    for number in sorted(merged):
+        deltas.append(to_base_36(number - last))
+        last = number
+    return ",".join(deltas)
+
+def check_trigram_index(couchdb_url):
+    def check(document):
+        if "shards" not in document:
+            document.update({"_id": TRIGRAMS_INDEX_ID,
+                             "type": "git-trigrams",
+                             "shards": TRIGRAM_SHARDS,
+                             "blobs_per_shard": TRIGRAM_BLOBS_PER_SHARD})
+        sizes = (document["shards"], document["blobs_per_shard"])
+        expected = (TRIGRAM_SHARDS, TRIGRAM_BLOBS_PER_SHARD)
+        if sizes != expected:
+            raise Exception("Index has %r shards of %r blobs, expected %r"
+                            % (sizes[0], sizes[1], expected))
+    put_update(posixpath.join(couchdb_url, TRIGRAMS_INDEX_ID), check)
+
+def trigram_blobs_id(shard):
+    return TRIGRAMS_BLOBS_PREFIX + unicode(shard)
+
+def get_trigram_blobs(couchdb_url):
+    blob_shards = {}
+    for row in iter_all_docs(couchdb_url, startkey=TRIGRAMS_BLOBS_PREFIX,
+                             endkey=TRIGRAMS_BLOBS_PREFIX + u"\ufff0",
+                             include_docs=True):
+        blob_shards[row["doc"]["shard"]] = row["doc"]
+    return blob_shards
+
+def allocate_blob_numbers(couchdb_url, shard, shas):
+    allocated = {}
+    remaining = list(shas)
+    while len(remaining) > 0:
+        def allocate(document):
+            # Called again with the new document after a conflict
+            added.clear()
+            document.update({"_id": trigram_blobs_id(shard),
+                             "type": "git-trigrams", "shard": shard})
+            blobs = document.setdefault("blobs", [])
+            pending = document.setdefault("pending", [])
+            positions = dict((sha, i) for i, sha in enumerate(blobs))
+            for sha in remaining:
+                if sha not in positions:
+                    if len(blobs) == TRIGRAM_BLOBS_PER_SHARD:
+                        break
+                    positions[sha] = len(blobs)
+                    blobs.append(sha)
+                    pending.append(shard * TRIGRAM_BLOBS_PER_SHARD
+                                   + positions[sha])
+                added[sha] = shard * TRIGRAM_BLOBS_PER_SHARD + positions[sha]
+        added = {}
+        put_update(posixpath.join(couchdb_url, trigram_blobs_id(shard)),
+                   allocate)
+        allocated.update(added)
+        remaining = [sha for sha in remaining if sha not in allocated]
+        shard += 1
+    return allocated
+
+def index_branch_heads(git, couchdb_url):
+    check_trigram_index(couchdb_url)
+    blob_shards = get_trigram_blobs(couchdb_url)
+    numbers = {}
+    pending = set()
+    for shard, document in blob_shards.iteritems():
+        for i, sha in enumerate(document["blobs"]):
+            numbers[sha] = shard * TRIGRAM_BLOBS_PER_SHARD + i
+        pending.update(document["pending"])
+    new_shas = []
+    for path, sha in iter_branch_head_blobs(couchdb_url):
+        if sha not in numbers and sha not in new_shas:
+            new_shas.append(sha)
+    if len(new_shas) > 0:
+        allocated = allocate_blob_numbers(
+            couchdb_url, max(blob_shards) if blob_shards else 0, new_shas)
+        numbers.update(allocated)
+        pending.update(allocated[sha] for sha in new_shas)
+    shas = dict((number, sha) for sha, number in numbers.iteritems())
+    postings = {}
+    for number in sorted(pending):
+        blob = call(git + ["show", shas[number]], do_crlf_fix=False)
+        for trigram in blob_trigrams(blob):
+            postings.setdefault(trigram, []).append(number)
+    shards = {}
+    for trigram, numbers in postings.iteritems():
+        shard = shards.setdefault(trigram_shard(trigram), {})
+        shard[trigram.encode("hex")] = numbers
+    for shard, additions in sorted(shards.items()):
+        def add_postings(document):
+            document.update({"_id": u"git-trigrams-" + shard,
+                             "type": "git-trigrams", "shard": shard})
+            lists = document.setdefault("postings", {})
+            for key, numbers in additions.iteritems():
+                lists[key] = merge_postings(lists.get(key, ""), numbers)
+        put_update(posixpath.join(couchdb_url, "git-trigrams-" + shard),
+                   add_postings)
+        print "index", shard
+    done = {}
+    for number in pending:
+        done.setdefault(number // TRIGRAM_BLOBS_PER_SHARD, set()).add(number)
+    for shard, indexed in sorted(done.items()):
+        def clear_pending(document):
+            document["pending"] = [n for n in document["pending"]
+                                   if n not in indexed]
+        put_update(posixpath.join(couchdb_url, trigram_blobs_id(shard)),
+                   clear_pending)
+
+def git_to_couchdb(cache_root, git_url, couchdb_url, render=False, 
+                   index=False):
     if git_url is None:
         git = ["git"]
     else:
@@ -296,6 +687,10 @@ def git_to_couchdb(cache_root, git_url, couchdb_url):
         call(git + ["fetch", "origin"], stdout=None, stderr=None)
     resolve_document = lambda d: resolve_document_using_git(git, d)
     fetch_all(resolve_document, couchdb_url, [BRANCHES_DOCREF])
+    if render:
+        render_branch_heads(git, couchdb_url)
+    if index:
+        index_branch_heads(git, couchdb_url)
 
 def main(argv):
     parser = optparse.OptionParser(__doc__)
@@ -307,6 +702,14 @@ def main(argv):
                       type=int, default=60*60, 
                       help="unit: seconds, default: hourly")
     parser.add_option("--cache-root", dest="cache_root") 
+    parser.add_option("--render", dest="render", action="store_true",
+                      default=False,
+                      help="pre-render the docco view of text files at "
+                      "the head of each branch (needs node)")
+    parser.add_option("--index", dest="index", action="store_true",
+                      default=False,
+                      help="index text files at the head of each branch "
+                      "for searching")
     options, args = parser.parse_args(argv)
     if len(args) == 0:
         parser.error("Missing: COUCHDB_URL")
@@ -322,10 +725,12 @@ def main(argv):
         cache_root = "/tmp/gitcouchsynccache"
     cache_root = os.path.abspath(cache_root)
     if options.mode == "once":
-        git_to_couchdb(cache_root, git_url, couchdb_url)
+        git_to_couchdb(cache_root, git_url, couchdb_url, options.render,
+                       options.index)
     elif options.mode == "poll":
         while True:
-            git_to_couchdb(cache_root, git_url, couchdb_url)
+            git_to_couchdb(cache_root, git_url, couchdb_url, 
+                           options.render, options.index)
             time.sleep(options.poll_interval)
 
 if __name__ == "__main__":
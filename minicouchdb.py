@@ -0,0 +1,853 @@
+# Copyright 2011 James Ascroft-Leigh
+
+"""\
+%prog [options]
+
+A small in-memory stand-in for CouchDB, good enough to run couchdblib,
+gitcouchdbsync.py and selfcouchapp.py against on one machine without
+a real server.  It knows about documents and their _rev conflicts,
+_all_docs (including keys), _bulk_docs, _changes (normal and
+longpoll), attachments, and views and _update handlers written as
+Python functions.  There is no JavaScript so _show, _list and
+_rewrite are not available.
+
+The --latency and --bandwidth options slow every response down so
+that a benchmark sees roughly the same round trips and transfer times
+as it would against a remote server, but repeatably.
+"""
+
+from __future__ import with_statement
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import base64
+import contextlib
+import hashlib
+import json
+import optparse
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+import zlib
+
+### Errors
+#
+# Failures are reported the way CouchDB reports them, as an HTTP
+# status and a JSON body with `error` and `reason`.
+class CouchError(Exception):
+
+    def __init__(self, status, error, reason):
+        Exception.__init__(self, "%s %s: %s" % (status, error, reason))
+        self.status = status
+        self.error = error
+        self.reason = reason
+
+def not_found(reason="missing"):
+    return CouchError(404, "not_found", reason)
+
+def conflict():
+    return CouchError(409, "conflict", "Document update conflict.")
+
+def bad_request(reason):
+    return CouchError(400, "bad_request", reason)
+
+### Collation
+#
+# View keys are ordered the way CouchDB orders them: null, false, true,
+# numbers, strings, arrays then objects.  Strings are compared by code
+# point rather than with the ICU rules CouchDB uses, which only differs
+# for mixed case and punctuation.  `_all_docs` uses plain string order
+# on the document ids.
+def collation_key(value):
+    if value is None:
+        return (0,)
+    elif value is False:
+        return (1,)
+    elif value is True:
+        return (2,)
+    elif isinstance(value, (int, long, float)):
+        return (3, value)
+    elif isinstance(value, basestring):
+        return (4, value)
+    elif isinstance(value, list):
+        return (5, [collation_key(v) for v in value])
+    elif isinstance(value, dict):
+        return (6, [(k, collation_key(v)) for (k, v) in value.items()])
+    raise Exception("Unexpected key: %r" % (value,))
+
+### Query parameters
+#
+# Some parameters are JSON values, the rest are strings, integers or
+# booleans.  A POST body can provide `keys` (and, for _changes,
+# `doc_ids`) instead of the query string.
+JSON_PARAMS = ("key", "keys", "startkey", "endkey", "start_key",
+               "end_key", "doc_ids")
+INT_PARAMS = ("limit", "skip", "group_level", "since", "timeout")
+BOOL_PARAMS = ("include_docs", "descending", "inclusive_end", "reduce",
+               "group", "attachments")
+
+def parse_params(query):
+    params = {}
+    for name, value in urlparse.parse_qsl(query, keep_blank_values=True):
+        try:
+            if name == "since" and value == "now":
+                pass
+            elif name in JSON_PARAMS:
+                value = json.loads(value)
+            elif name in INT_PARAMS:
+                value = int(value)
+            elif name in BOOL_PARAMS:
+                value = {"true": True, "false": False}[value]
+        except (ValueError, KeyError):
+            raise CouchError(400, "query_parse_error",
+                             "Invalid value for %s: %r" % (name, value))
+        params[name] = value
+    for alias, name in [("start_key", "startkey"), ("end_key", "endkey")]:
+        if alias in params:
+            params[name] = params.pop(alias)
+    return params
+
+### Row selection
+#
+# `_all_docs` and views share the range logic.  Rows are tuples of
+# `(sort_key, doc_id, key, value)` already in ascending order.  The
+# `startkey_docid` and `endkey_docid` parameters break ties between
+# equal keys.  The offset is the number of rows before the start.
+def compare_row(row, sort_key, doc_id):
+    result = cmp(row[0], sort_key)
+    if result == 0 and doc_id is not None:
+        result = cmp(row[1], doc_id)
+    return result
+
+def select_rows(rows, params, to_sort_key):
+    descending = params.get("descending", False)
+    direction = -1 if descending else 1
+    if descending:
+        rows = rows[::-1]
+    if "key" in params:
+        params = dict(params, startkey=params["key"], endkey=params["key"],
+                      inclusive_end=True)
+    offset = 0
+    if "startkey" in params:
+        start = to_sort_key(params["startkey"])
+        start_docid = params.get("startkey_docid")
+        count = len(rows)
+        rows = [r for r in rows
+                if compare_row(r, start, start_docid) * direction >= 0]
+        offset = count - len(rows)
+    if "endkey" in params:
+        end = to_sort_key(params["endkey"])
+        end_docid = params.get("endkey_docid")
+        inclusive = params.get("inclusive_end", True)
+        rows = [r for r in rows
+                if (compare_row(r, end, end_docid) * direction < 0
+                    or (inclusive
+                        and compare_row(r, end, end_docid) == 0))]
+    return rows, offset
+
+def skip_and_limit(rows, params):
+    rows = rows[params.get("skip", 0):]
+    if "limit" in params:
+        rows = rows[:params["limit"]]
+    return rows
+
+### Reduce
+#
+# Besides the built in `_count` and `_sum`, a reduce function is a
+# Python callable taking `(keys, values)` in the same form as a
+# JavaScript reduce function without rereduce.
+def builtin_count(keys, values):
+    return len(values)
+
+def builtin_sum(keys, values):
+    return sum(values)
+
+BUILTIN_REDUCE = {"_count": builtin_count, "_sum": builtin_sum}
+
+def group_key(key, params):
+    if params.get("group", False):
+        return key
+    if "group_level" in params:
+        if isinstance(key, list):
+            return key[:params["group_level"]]
+        return key
+    return None
+
+def reduce_rows(rows, reduce_func, params):
+    reduce_func = BUILTIN_REDUCE.get(reduce_func, reduce_func)
+    groups = []
+    for sort_key, doc_id, key, value in rows:
+        group = group_key(key, params)
+        if len(groups) == 0 or groups[-1][0] != group:
+            groups.append((group, [], []))
+        groups[-1][1].append([key, doc_id])
+        groups[-1][2].append(value)
+    return [{"key": key, "value": reduce_func(keys, values)}
+            for (key, keys, values) in groups]
+
+### Databases
+#
+# Each document keeps only its latest revision: a revision id, the
+# sequence number of its last change, the JSON body (without the
+# underscore fields) and the attachments.  Deleted documents are kept
+# as tombstones so that they still show up in _changes and so that
+# their revision numbers carry on if they are recreated.
+class Database(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.by_seq = {}
+        self.update_seq = 0
+        self.view_indexes = {}
+
+    def info(self):
+        return {"db_name": self.name, "update_seq": self.update_seq,
+                "doc_count": len([d for d in self.docs.values()
+                                  if not d["deleted"]]),
+                "doc_del_count": len([d for d in self.docs.values()
+                                      if d["deleted"]])}
+
+    def current(self, doc_id):
+        record = self.docs.get(doc_id)
+        if record is None:
+            raise not_found("missing")
+        if record["deleted"]:
+            raise not_found("deleted")
+        return record
+
+    def to_json(self, doc_id, record, with_data=False):
+        doc = dict(record["body"])
+        doc["_id"] = doc_id
+        doc["_rev"] = record["rev"]
+        if record["deleted"]:
+            doc["_deleted"] = True
+        if len(record["attachments"]) > 0:
+            doc["_attachments"] = {}
+            for name, att in record["attachments"].items():
+                stub = {"content_type": att["content_type"],
+                        "digest": att["digest"],
+                        "length": len(att["data"]),
+                        "revpos": att["revpos"]}
+                if with_data:
+                    stub["data"] = base64.b64encode(att["data"])
+                else:
+                    stub["stub"] = True
+                doc["_attachments"][name] = stub
+        return doc
+
+    def get(self, doc_id, with_data=False):
+        return self.to_json(doc_id, self.current(doc_id), with_data)
+
+    def check_rev(self, doc_id, rev):
+        old = self.docs.get(doc_id)
+        if old is not None and not old["deleted"]:
+            if rev != old["rev"]:
+                raise conflict()
+        elif rev is not None and (old is None or rev != old["rev"]):
+            raise conflict()
+        return old
+
+    def new_rev(self, old, body):
+        generation = 1
+        previous = ""
+        if old is not None:
+            generation = int(old["rev"].split("-", 1)[0]) + 1
+            previous = old["rev"]
+        digest = hashlib.md5(previous + json.dumps(body, sort_keys=True))
+        return "%d-%s" % (generation, digest.hexdigest())
+
+    def store(self, doc_id, old, body, deleted, attachments):
+        rev = self.new_rev(old, body)
+        generation = int(rev.split("-", 1)[0])
+        for att in attachments.values():
+            if att["revpos"] is None:
+                att["revpos"] = generation
+        if old is not None:
+            del self.by_seq[old["seq"]]
+        self.update_seq += 1
+        self.docs[doc_id] = {"rev": rev, "seq": self.update_seq,
+                             "deleted": deleted, "body": body,
+                             "attachments": attachments}
+        self.by_seq[self.update_seq] = doc_id
+        return rev
+
+    def put(self, doc_id, doc):
+        if not isinstance(doc, dict):
+            raise bad_request("Document must be a JSON object")
+        old = self.check_rev(doc_id, doc.get("_rev"))
+        deleted = doc.get("_deleted", False)
+        body = dict((k, v) for (k, v) in doc.items() if not k.startswith("_"))
+        attachments = {}
+        if not deleted:
+            old_attachments = {}
+            if old is not None and not old["deleted"]:
+                old_attachments = old["attachments"]
+            for name, att in doc.get("_attachments", {}).items():
+                if att.get("stub", False):
+                    if name not in old_attachments:
+                        raise CouchError(412, "missing_stub",
+                                         "Missing attachment %s" % (name,))
+                    attachments[name] = old_attachments[name]
+                else:
+                    attachments[name] = make_attachment(
+                        base64.b64decode(att.get("data", "")),
+                        att.get("content_type", "application/octet-stream"))
+        else:
+            body = {}
+        return self.store(doc_id, old, body, deleted, attachments)
+
+    def delete(self, doc_id, rev):
+        self.current(doc_id)
+        return self.put(doc_id, {"_rev": rev, "_deleted": True})
+
+    def put_attachment(self, doc_id, name, rev, data, content_type):
+        old = self.check_rev(doc_id, rev)
+        body = {}
+        attachments = {}
+        if old is not None and not old["deleted"]:
+            body = old["body"]
+            attachments = dict(old["attachments"])
+        attachments[name] = make_attachment(data, content_type)
+        return self.store(doc_id, old, body, False, attachments)
+
+    def delete_attachment(self, doc_id, name, rev):
+        record = self.current(doc_id)
+        self.check_rev(doc_id, rev)
+        if name not in record["attachments"]:
+            raise not_found("missing")
+        attachments = dict(record["attachments"])
+        del attachments[name]
+        return self.store(doc_id, record, record["body"], False,
+                          attachments)
+
+    def get_attachment(self, doc_id, name):
+        attachment = self.current(doc_id)["attachments"].get(name)
+        if attachment is None:
+            raise not_found("Document is missing attachment")
+        return attachment
+
+    ### Listing documents
+    def all_docs(self, params):
+        if "keys" in params:
+            rows = []
+            for doc_id in params["keys"]:
+                record = self.docs.get(doc_id)
+                if record is None:
+                    rows.append({"key": doc_id, "error": "not_found"})
+                    continue
+                row = {"id": doc_id, "key": doc_id,
+                       "value": {"rev": record["rev"]}}
+                if record["deleted"]:
+                    row["value"]["deleted"] = True
+                if params.get("include_docs", False):
+                    row["doc"] = (None if record["deleted"]
+                                  else self.to_json(doc_id, record))
+                rows.append(row)
+            return {"total_rows": len(self.docs), "offset": 0,
+                    "rows": skip_and_limit(rows, params)}
+        doc_ids = sorted(doc_id for (doc_id, record) in self.docs.items()
+                         if not record["deleted"]
+                         and not doc_id.startswith("_local/"))
+        rows = [(d, d, d, {"rev": self.docs[d]["rev"]}) for d in doc_ids]
+        selected, offset = select_rows(rows, params, lambda k: k)
+        result = []
+        for sort_key, doc_id, key, value in skip_and_limit(selected, params):
+            row = {"id": doc_id, "key": key, "value": value}
+            if params.get("include_docs", False):
+                row["doc"] = self.get(doc_id)
+            result.append(row)
+        return {"total_rows": len(rows),
+                "offset": offset + params.get("skip", 0), "rows": result}
+
+    def changes(self, params):
+        since = params.get("since", 0)
+        if since == "now":
+            since = self.update_seq
+        doc_ids = None
+        if params.get("filter") == "_doc_ids":
+            doc_ids = set(params.get("doc_ids", []))
+        elif params.get("filter") is not None:
+            raise bad_request("Only the _doc_ids filter is supported")
+        results = []
+        for seq in sorted(s for s in self.by_seq if s > since):
+            doc_id = self.by_seq[seq]
+            if doc_ids is not None and doc_id not in doc_ids:
+                continue
+            if doc_id.startswith("_local/"):
+                continue
+            record = self.docs[doc_id]
+            result = {"seq": seq, "id": doc_id,
+                      "changes": [{"rev": record["rev"]}]}
+            if record["deleted"]:
+                result["deleted"] = True
+            if params.get("include_docs", False):
+                result["doc"] = self.to_json(doc_id, record)
+            results.append(result)
+            if len(results) == params.get("limit"):
+                break
+        last_seq = results[-1]["seq"] if len(results) > 0 else since
+        if len(results) == 0 and since < self.update_seq:
+            last_seq = self.update_seq
+        return {"results": results, "last_seq": last_seq}
+
+    ### Views
+    #
+    # Map functions are Python callables taking a document and returning
+    # (or yielding) `(key, value)` pairs.  The index is rebuilt
+    # whenever the database has changed since it was last used.  Design
+    # documents are not passed to map functions, as in CouchDB.
+    def view_index(self, name, map_func):
+        index = self.view_indexes.get(name)
+        if index is not None and index[0] == self.update_seq:
+            return index[1]
+        rows = []
+        for doc_id, record in self.docs.items():
+            if record["deleted"] or doc_id.startswith("_"):
+                continue
+            for key, value in map_func(self.to_json(doc_id, record)) or []:
+                rows.append((collation_key(key), doc_id, key, value))
+        rows.sort()
+        self.view_indexes[name] = (self.update_seq, rows)
+        return rows
+
+    def query_view(self, name, map_func, reduce_func, params):
+        index = self.view_index(name, map_func)
+        if "keys" in params:
+            selected = []
+            offset = 0
+            for key in params["keys"]:
+                selected.extend(select_rows(index, dict(params, key=key),
+                                            collation_key)[0])
+        else:
+            selected, offset = select_rows(index, params, collation_key)
+        if reduce_func is not None and params.get("reduce", True):
+            if params.get("include_docs", False):
+                raise CouchError(400, "query_parse_error",
+                                 "include_docs is invalid for reduce")
+            return {"rows": skip_and_limit(
+                    reduce_rows(selected, reduce_func, params), params)}
+        result = []
+        for sort_key, doc_id, key, value in skip_and_limit(selected, params):
+            row = {"id": doc_id, "key": key, "value": value}
+            if params.get("include_docs", False):
+                # As in CouchDB, a value with an _id names a linked
+                # document to include instead of the emitting one.
+                linked_id = doc_id
+                if isinstance(value, dict) and "_id" in value:
+                    linked_id = value["_id"]
+                try:
+                    row["doc"] = self.get(linked_id)
+                except CouchError:
+                    row["doc"] = None
+            result.append(row)
+        return {"total_rows": len(index),
+                "offset": offset + params.get("skip", 0), "rows": result}
+
+def make_attachment(data, content_type):
+    return {"data": data, "content_type": content_type, "revpos": None,
+            "digest": "md5-" + base64.b64encode(hashlib.md5(data).digest())}
+
+### The HTTP server
+#
+# Each request is handled in its own thread and all access to the
+# databases is serialized by one lock.  The same lock's condition
+# variable wakes up longpoll _changes requests when anything changes.
+#
+# `latency` (seconds) is slept before every response and `bandwidth`
+# (bytes per second), if set, paces both request and response bodies.
+SHUTDOWN_POLL_INTERVAL = 0.01
+
+class MiniCouchDB(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0,
+                 bandwidth=None, gzip=False, verbose=False):
+        HTTPServer.__init__(self, (host, port), RequestHandler)
+        self.databases = {}
+        self.views = {}
+        self.updates = {}
+        self.changed = threading.Condition()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.gzip = gzip
+        self.verbose = verbose
+        self.stats = {"requests": 0, "received": 0, "sent": 0}
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%s/" % (host, port)
+
+    def create_db(self, name):
+        with self.changed:
+            if name not in self.databases:
+                self.databases[name] = Database(name)
+        return self.url + urllib.quote(name, safe="")
+
+    def add_view(self, db_name, design_name, view_name, map_func,
+                 reduce_func=None):
+        with self.changed:
+            self.views[(db_name, "_design/" + design_name, view_name)] = (
+                map_func, reduce_func)
+            database = self.databases.get(db_name)
+            if database is not None:
+                database.view_indexes.pop(
+                    ("_design/" + design_name, view_name), None)
+
+    # An update function is called with the current document, or None,
+    # and a request with the "id" and "body" and returns the new
+    # document, or None to leave it alone, and the response body, just
+    # as an _update handler in JavaScript would.
+    def add_update_handler(self, db_name, design_name, name, update_func):
+        with self.changed:
+            self.updates[(db_name, "_design/" + design_name, name)] = (
+                update_func)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       args=(SHUTDOWN_POLL_INTERVAL,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def throttle(self, size):
+        if self.bandwidth is not None:
+            time.sleep(float(size) / self.bandwidth)
+
+@contextlib.contextmanager
+def running_server(*a, **kw):
+    server = MiniCouchDB(*a, **kw)
+    server.start()
+    try:
+        yield server
+    finally:
+        server.stop()
+
+### Request handling
+#
+# Requests are routed on the unquoted path segments.  Document ids
+# starting with `_design/` or `_local/` take two segments, whether or
+# not the slash was quoted, and anything after the document id names
+# an attachment.
+RESPONSE_CHUNK_SIZE = 16 * 1024
+SPECIAL_PREFIXES = ("_design", "_local")
+
+def parse_rev(headers, params, body=None):
+    if isinstance(body, dict) and "_rev" in body:
+        return body["_rev"]
+    if "rev" in params:
+        return params["rev"]
+    if headers.get("If-Match") is not None:
+        return headers["If-Match"].strip('"')
+    return None
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    # Headers are written one line at a time so without buffering each
+    # small write waits on a delayed ACK.
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self.handle_method("GET")
+
+    def do_HEAD(self):
+        self.handle_method("HEAD")
+
+    def do_PUT(self):
+        self.handle_method("PUT")
+
+    def do_POST(self):
+        self.handle_method("POST")
+
+    def do_DELETE(self):
+        self.handle_method("DELETE")
+
+    def read_body(self):
+        if self.headers.get("Expect", "").lower() == "100-continue":
+            self.wfile.write("HTTP/1.1 100 Continue\r\n\r\n")
+            self.wfile.flush()
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(";")[0], 16)
+                if size == 0:
+                    while self.rfile.readline() not in ("\r\n", "\n", ""):
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            data = "".join(chunks)
+        else:
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.stats["received"] += len(data)
+        self.server.throttle(len(data))
+        if self.headers.get("Content-Encoding", "").lower() == "gzip":
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return data
+
+    def handle_method(self, method):
+        self.server.stats["requests"] += 1
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        url = urlparse.urlsplit(self.path)
+        try:
+            params = parse_params(url.query)
+            data = self.read_body()
+            parts = [urllib.unquote(p).decode("utf-8")
+                     for p in url.path.split("/") if p != ""]
+            if len(parts) > 1 and parts[1].split("/")[0] in SPECIAL_PREFIXES:
+                parts[1:2] = parts[1].split("/", 1)
+            status, headers, body = self.route(method, parts, params, data)
+        except CouchError, e:
+            status, headers, body = error_response(e)
+        except Exception, e:
+            status, headers, body = error_response(
+                CouchError(500, "unknown_error", str(e)))
+        self.send(method, status, headers, body)
+
+    def send(self, method, status, headers, body):
+        headers = dict(headers)
+        accept = self.headers.get("Accept-Encoding", "")
+        if self.server.gzip and "gzip" in accept and len(body) > 0:
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers["Content-Encoding"] = "gzip"
+        self.send_response(status)
+        headers.setdefault("Content-Type", "application/json")
+        headers["Content-Length"] = str(len(body))
+        for name, value in sorted(headers.items()):
+            self.send_header(name, value)
+        self.end_headers()
+        if method == "HEAD" or status == 304:
+            return
+        for i in range(0, len(body), RESPONSE_CHUNK_SIZE):
+            chunk = body[i:i + RESPONSE_CHUNK_SIZE]
+            self.wfile.write(chunk)
+            self.server.stats["sent"] += len(chunk)
+            self.server.throttle(len(chunk))
+
+    def route(self, method, parts, params, data):
+        server = self.server
+        if len(parts) == 0:
+            return json_response({"couchdb": "Welcome",
+                                  "version": "minicouchdb"})
+        if parts == ["_all_dbs"]:
+            with server.changed:
+                return json_response(sorted(server.databases))
+        db_name = parts.pop(0)
+        with server.changed:
+            if len(parts) == 0 and method == "PUT":
+                if db_name in server.databases:
+                    raise CouchError(412, "file_exists",
+                                     "The database could not be created")
+                server.create_db(db_name)
+                return json_response({"ok": True}, 201)
+            database = server.databases.get(db_name)
+            if database is None:
+                raise not_found("no_db_file")
+            if len(parts) == 0:
+                if method == "DELETE":
+                    del server.databases[db_name]
+                    return json_response({"ok": True})
+                elif method == "POST":
+                    doc = json.loads(data)
+                    doc_id = doc.get("_id", uuid.uuid4().hex)
+                    return self.put_doc(database, doc_id, doc)
+                return json_response(database.info())
+            if parts[0] == "_all_docs":
+                if method == "POST":
+                    params["keys"] = json.loads(data)["keys"]
+                return json_response(database.all_docs(params))
+            elif parts[0] == "_bulk_docs":
+                return self.bulk_docs(database, json.loads(data)["docs"])
+            elif parts[0] == "_changes":
+                if method == "POST" and data != "":
+                    params["doc_ids"] = json.loads(data).get("doc_ids", [])
+                return self.changes(database, params)
+            elif parts[0] == "_ensure_full_commit":
+                return json_response({"ok": True}, 201)
+            elif parts[0] in SPECIAL_PREFIXES:
+                if len(parts) < 2:
+                    raise not_found("missing")
+                doc_id = parts[0] + "/" + parts[1]
+                rest = parts[2:]
+            elif parts[0].startswith("_"):
+                raise bad_request("Unsupported: %s" % (parts[0],))
+            else:
+                doc_id = parts[0]
+                rest = parts[1:]
+            if len(rest) > 0 and rest[0] == "_view" and len(rest) == 2:
+                view = server.views.get((db_name, doc_id, rest[1]))
+                if view is None:
+                    raise not_found("missing_named_view")
+                if method == "POST":
+                    params["keys"] = json.loads(data)["keys"]
+                map_func, reduce_func = view
+                return json_response(database.query_view(
+                        (doc_id, rest[1]), map_func, reduce_func, params))
+            elif len(rest) > 2 and rest[0] == "_update":
+                update_func = server.updates.get((db_name, doc_id, rest[1]))
+                if update_func is None:
+                    raise not_found("missing_update_handler")
+                return self.update(database, "/".join(rest[2:]), 
+                                   update_func, data)
+            elif len(rest) > 0 and rest[0].startswith("_"):
+                raise CouchError(501, "not_implemented",
+                                 "%s needs JavaScript" % (rest[0],))
+            elif len(rest) > 0:
+                return self.attachment(method, database, doc_id,
+                                       "/".join(rest), params, data)
+            return self.document(method, database, doc_id, params, data)
+
+    def document(self, method, database, doc_id, params, data):
+        if method in ("GET", "HEAD"):
+            doc = database.get(doc_id, params.get("attachments", False))
+            etag = '"%s"' % (doc["_rev"],)
+            if self.headers.get("If-None-Match") == etag:
+                return 304, {"ETag": etag}, ""
+            status, headers, body = json_response(doc)
+            headers["ETag"] = etag
+            return status, headers, body
+        elif method == "PUT":
+            doc = json.loads(data)
+            if "_rev" not in doc and parse_rev(self.headers, params):
+                doc["_rev"] = parse_rev(self.headers, params)
+            return self.put_doc(database, doc_id, doc)
+        elif method == "DELETE":
+            rev = database.delete(doc_id, parse_rev(self.headers, params))
+            self.server.changed.notify_all()
+            return json_response({"ok": True, "id": doc_id, "rev": rev})
+        raise CouchError(405, "method_not_allowed", method)
+
+    def update(self, database, doc_id, update_func, data):
+        try:
+            doc = database.get(doc_id)
+        except CouchError, e:
+            if e.status != 404:
+                raise
+            doc = None
+        new_doc, body = update_func(doc, {"id": doc_id, "body": data})
+        headers = {}
+        if new_doc is not None:
+            rev = database.put(doc_id, new_doc)
+            self.server.changed.notify_all()
+            headers["X-Couch-Update-NewRev"] = rev
+        return 201, headers, body
+
+    def put_doc(self, database, doc_id, doc):
+        rev = database.put(doc_id, doc)
+        self.server.changed.notify_all()
+        status, headers, body = json_response(
+            {"ok": True, "id": doc_id, "rev": rev}, 201)
+        headers["ETag"] = '"%s"' % (rev,)
+        return status, headers, body
+
+    def bulk_docs(self, database, docs):
+        results = []
+        for doc in docs:
+            doc_id = doc.get("_id", uuid.uuid4().hex)
+            try:
+                rev = database.put(doc_id, doc)
+            except CouchError, e:
+                results.append({"id": doc_id, "error": e.error,
+                                "reason": e.reason})
+            else:
+                results.append({"id": doc_id, "rev": rev})
+        self.server.changed.notify_all()
+        return json_response(results, 201)
+
+    def changes(self, database, params):
+        feed = params.get("feed", "normal")
+        if feed not in ("normal", "longpoll"):
+            raise bad_request("Unsupported feed: %s" % (feed,))
+        result = database.changes(params)
+        if feed == "longpoll":
+            deadline = time.time() + params.get("timeout", 60000) / 1000.0
+            while len(result["results"]) == 0 and time.time() < deadline:
+                self.server.changed.wait(deadline - time.time())
+                if self.server.databases.get(database.name) is not database:
+                    raise not_found("no_db_file")
+                result = database.changes(params)
+        return json_response(result)
+
+    def attachment(self, method, database, doc_id, name, params, data):
+        if method in ("GET", "HEAD"):
+            attachment = database.get_attachment(doc_id, name)
+            md5 = attachment["digest"][len("md5-"):]
+            return 200, {"Content-Type": attachment["content_type"],
+                         "Content-MD5": md5}, attachment["data"]
+        rev = parse_rev(self.headers, params)
+        if method == "PUT":
+            expected = self.headers.get("Content-MD5")
+            actual = base64.b64encode(hashlib.md5(data).digest())
+            if expected is not None and expected != actual:
+                raise CouchError(400, "content_md5_mismatch",
+                                 "Possible message corruption.")
+            content_type = self.headers.get("Content-Type",
+                                            "application/octet-stream")
+            rev = database.put_attachment(doc_id, name, rev, data,
+                                          content_type)
+            status = 201
+        elif method == "DELETE":
+            rev = database.delete_attachment(doc_id, name, rev)
+            status = 200
+        else:
+            raise CouchError(405, "method_not_allowed", method)
+        self.server.changed.notify_all()
+        return json_response({"ok": True, "id": doc_id, "rev": rev}, status)
+
+def json_response(value, status=200):
+    return status, {"Content-Type": "application/json"}, json.dumps(value)
+
+def error_response(e):
+    return json_response({"error": e.error, "reason": e.reason}, e.status)
+
+def main(argv):
+    parser = optparse.OptionParser(__doc__)
+    parser.add_option("--host", dest="host", default="127.0.0.1")
+    parser.add_option("--port", dest="port", type=int, default=5984)
+    parser.add_option("--latency", dest="latency", type=float, default=0,
+                      help="unit: milliseconds, default: 0")
+    parser.add_option("--bandwidth", dest="bandwidth", type=int,
+                      default=None, help="unit: KiB/s, default: unlimited")
+    parser.add_option("--gzip", dest="gzip", action="store_true",
+                      default=False, help="compress responses on request")
+    parser.add_option("--database", dest="databases", action="append",
+                      default=[], help="create this database at startup")
+    parser.add_option("--verbose", dest="verbose", action="store_true",
+                      default=False)
+    options, args = parser.parse_args(argv)
+    if len(args) > 0:
+        parser.error("Unexpected: %r" % (args,))
+    bandwidth = None
+    if options.bandwidth is not None:
+        bandwidth = options.bandwidth * 1024
+    server = MiniCouchDB(options.host, options.port,
+                         options.latency / 1000.0, bandwidth, options.gzip,
+                         options.verbose)
+    for name in options.databases:
+        server.create_db(name)
+    print server.url
+    sys.stdout.flush()
+    server.serve_forever()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -21,8 +21,9 @@ the _design document follows the latest revision of a couchapp managed
 project.  After you run "git commit" the gitcouchdbsync.py process
 pushes this into a CouchDB and then the selfcouchapp.py script,
 subscribed to _changes, notices that the branch has been updated.  It
-will copy down the latest files for that branch and use couchapp to
-replace the specified _design document.
+will read the latest files for that branch and build them, in memory,
+into a replacement for the specified _design document, following the
+couchapp directory conventions.
 
 In the "self" mode, you can configure the selfcouchapp.py script to
 follow all branches in the git repository.  When a new branch is
@@ -35,98 +36,389 @@ contains the stable and topic branches and both design documents.
 
 from __future__ import with_statement
 
-from couchdblib import get, couchapp, url_quote
-from jwalutil import mkdtemp
-from posixutils import symbolic_to_octal_mode
+from couchapplib import blob_to_data, push_couchapp, push_git_tree
+from couchdblib import delete, get, iter_all_docs, iter_docs, url_quote
+from couchdblib import make_query_url, request
+from couchdblib import DocumentCache, use_document_cache
+from jwalutil import mkdtemp, trim
 from pprint import pformat
 import base64
+import json
 import optparse
 import os
 import posixpath
 import pycurl as curl
+import Queue
+import shutil
 import sys
+import threading
 import time
+import traceback
 import urllib
+import uuid
 
 def write_file(path, data):
     with file(path, "wb") as fh:
         fh.write(data)
 
-def blob_to_fs(git_couchdb_url, file_path, blob):
-    blob_data = get(posixpath.join(git_couchdb_url, blob))
-    if blob_data["encoding"] == "raw":
-        write_file(file_path, blob_data["raw"])
-    elif blob_data["encoding"] == "base64":
-        write_file(file_path, base64.b64decode(blob_data["base64"]))
-    else:
-        raise NotImplementedError(blob_data)
+### Blob cache
+#
+# Blob ids are content addresses so a blob that has been downloaded
+# once never needs downloading again, whichever branch or revision it
+# turns up in.  The BlobCache keeps the contents of each blob in a
+# file named after its id and a checkout gets a hard link to that
+# file, or a copy if linking fails.  The checkout must therefore be
+# treated as read-only.  Checkouts are made under `work_dir`, next to
+# the blobs, so that they are on the same filesystem.
+#
+# The cache is bounded by the total size of its files.  A file's
+# modification time is bumped whenever it is used and the least
+# recently used files are removed first.
+class BlobCache(object):
+
+    def __init__(self, cache_dir, max_bytes=256*1024*1024):
+        self.blob_dir = os.path.join(cache_dir, "blobs")
+        self.work_dir = os.path.join(cache_dir, "work")
+        self.max_bytes = max_bytes
+        self.added = 0
+        for path in [self.blob_dir, self.work_dir]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+    def _path(self, blob_id):
+        return os.path.join(self.blob_dir, url_quote(blob_id))
+
+    def _link(self, cache_path, path):
+        try:
+            os.link(cache_path, path)
+        except OSError:
+            shutil.copyfile(cache_path, path)
+
+    def materialize(self, blob_id, path):
+        cache_path = self._path(blob_id)
+        try:
+            os.utime(cache_path, None)
+        except OSError:
+            return False
+        self._link(cache_path, path)
+        return True
 
-def tree_to_fs(git_couchdb_url, local_dir, tree):
+    def add(self, blob_id, data):
+        cache_path = self._path(blob_id)
+        temp_path = "%s.%s.tmp" % (cache_path, uuid.uuid4())
+        write_file(temp_path, data)
+        os.rename(temp_path, cache_path)
+        self.added += 1
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.blob_dir):
+            path = os.path.join(self.blob_dir, name)
+            info = os.stat(path)
+            entries.append((info.st_mtime, path, info.st_size))
+            total += info.st_size
+        for mtime, path, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.unlink(path)
+            total -= size
+
+### Materializing a tree
+#
+# Fetching each tree and then each blob with its own request costs a
+# round trip per file.  Instead the tree is walked a level at a time:
+# every tree and blob found at one depth is fetched together with
+# `iter_docs` and each file is written as soon as its row arrives.
+# The number of round trips is then about the depth of the tree.  The
+# same object can appear at several paths so each is written to all
+# of them.  Blobs found in the `blob_cache`, if given, are not fetched.
+def tree_to_fs(git_couchdb_url, local_dir, tree, blob_cache=None):
     os.mkdir(local_dir)
-    tree_data = get(posixpath.join(git_couchdb_url, tree))
-    for entry in tree_data["children"]:
-        out_path = os.path.join(local_dir, entry["basename"])
-        if entry["child"]["type"] == "git-tree":
-            tree_to_fs(git_couchdb_url, out_path, entry["child"]["_id"])
-        elif entry["child"]["type"] == "git-blob":
-            blob_to_fs(git_couchdb_url, out_path, entry["child"]["_id"])
-        else:
-            raise NotImplementedError(entry)
-        mode = symbolic_to_octal_mode(entry["mode"])
-        # os.chmod(out_path, int(mode, 8) & 0xfff)
+    pending = {tree: [local_dir]}
+    while len(pending) > 0:
+        level = pending
+        pending = {}
+        for doc_id, document in iter_docs(git_couchdb_url, sorted(level)):
+            if document["type"] == "git-blob":
+                data = blob_to_data(document)
+                if blob_cache is not None:
+                    blob_cache.add(doc_id, data)
+                for path in level[doc_id]:
+                    if (blob_cache is None 
+                        or not blob_cache.materialize(doc_id, path)):
+                        write_file(path, data)
+                continue
+            assert document["type"] == "git-tree", document
+            for path in level[doc_id]:
+                for entry in document["children"]:
+                    out_path = os.path.join(path, entry["basename"])
+                    child_id = entry["child"]["_id"]
+                    if entry["child"]["type"] == "git-tree":
+                        os.mkdir(out_path)
+                    elif entry["child"]["type"] != "git-blob":
+                        raise NotImplementedError(entry)
+                    elif (blob_cache is not None 
+                          and blob_cache.materialize(child_id, out_path)):
+                        continue
+                    pending.setdefault(child_id, []).append(out_path)
 
-def sync_batch(git_couchdb_url, design_couchdb_url, branch, app_subdir):
+### Deploying a branch
+#
+# Normally the design document is built in memory straight from the
+# tree documents.  With `checkout` the tree is written to a temporary
+# directory first, as the couchapp tool would need, which is slower
+# but leaves the files around for `blob_cache` to reuse.
+def push_via_checkout(git_couchdb_url, doc_url, tree, blob_cache):
+    work_dir = None if blob_cache is None else blob_cache.work_dir
+    with mkdtemp(dir=work_dir) as temp_dir:
+        local_dir = os.path.join(temp_dir, "app")
+        tree_to_fs(git_couchdb_url, local_dir, tree, blob_cache)
+        write_file(os.path.join(local_dir, "couchapp_git_tree_id"), tree)
+        if os.path.exists(os.path.join(local_dir, "_id")):
+            os.unlink(os.path.join(local_dir, "_id"))
+        push_couchapp(doc_url, local_dir)
+
+def design_doc_id(branch):
+    return "_design/" + urllib.quote(branch, safe="")
+
+def design_doc_url(design_couchdb_url, branch):
+    return posixpath.join(design_couchdb_url, "_design", 
+                          url_quote(urllib.quote(branch, safe="")))
+
+def list_branches(git_couchdb_url, branch):
     if branch is None:
-        branches = [
+        return [
             b["_id"] for b in get(
                 posixpath.join(git_couchdb_url, "git-branches"))["branches"]]
     else:
         # TODO: Should really look for branches with this name using
         # an index
-        branches = ["git-branch-" + branch]
-    with mkdtemp() as temp_dir:
-        for branch in branches:
-            basename = urllib.quote(branch, safe="")
-            local_dir = os.path.join(temp_dir, basename)
-            commit = get(posixpath.join(git_couchdb_url, 
-                                        branch))["commit"]["_id"]
-            tree = get(posixpath.join(git_couchdb_url, 
-                                      commit))["tree"]["_id"]
-            if app_subdir != ".":
-                # TODO: Support multi-level sub_dir
-                assert "/" not in app_subdir, app_subdir
-                for child in get(posixpath.join(git_couchdb_url, 
-                                                tree))["children"]:
-                    if child["basename"] == app_subdir:
-                        assert child["child"]["type"] == "git-tree", child
-                        tree = child["child"]["_id"]
-                        break
-                else:
-                    raise Exception("Missing child %r" % (app_subdir,))
-            doc_url = posixpath.join(design_couchdb_url, 
-                                     "_design", url_quote(basename))
-            existing = get(doc_url)
-            if existing.get("couchapp_git_tree_id") == tree:
-                continue
-            print "Updating %r..." % (branch,)
-            tree_to_fs(git_couchdb_url, local_dir, tree)
-            write_file(os.path.join(local_dir, "couchapp_git_tree_id"),
-                       tree)
-            if os.path.exists(os.path.join(local_dir, "_id")):
-                os.unlink(os.path.join(local_dir, "_id"))
-            couchapp(doc_url, local_dir)
-            print "...done %r" % (branch,)            
+        return ["git-branch-" + branch]
+
+def sync_branch(git_couchdb_url, design_couchdb_url, branch, app_subdir,
+                blob_cache=None, checkout=False):
+    branch_doc = get(posixpath.join(git_couchdb_url, branch))
+    if branch_doc.get("error") is not None:
+        print "Skipping %r: %s" % (branch, branch_doc["error"])
+        return "skipped"
+    if "tree" in branch_doc:
+        tree = branch_doc["tree"]["_id"]
+    else:
+        commit = branch_doc["commit"]["_id"]
+        tree = get(posixpath.join(git_couchdb_url, commit))["tree"]["_id"]
+    if app_subdir != ".":
+        # TODO: Support multi-level sub_dir
+        assert "/" not in app_subdir, app_subdir
+        for child in get(posixpath.join(git_couchdb_url, 
+                                        tree))["children"]:
+            if child["basename"] == app_subdir:
+                assert child["child"]["type"] == "git-tree", child
+                tree = child["child"]["_id"]
+                break
+        else:
+            raise Exception("Missing child %r" % (app_subdir,))
+    doc_url = design_doc_url(design_couchdb_url, branch)
+    existing = get(doc_url)
+    if existing.get("couchapp_git_tree_id") == tree:
+        return "unchanged"
+    print "Updating %r..." % (branch,)
+    if checkout:
+        push_via_checkout(git_couchdb_url, doc_url, tree, blob_cache)
+    else:
+        push_git_tree(doc_url, git_couchdb_url, tree,
+                      {"couchapp_git_tree_id": tree})
+    print "...done %r" % (branch,)            
+    return "updated"
+
+# When following all branches, the _design documents of branches that
+# no longer exist are deleted.  Only documents that were written by
+# this script, and so have a `couchapp_git_tree_id`, are touched.
+def prune_design_docs(design_couchdb_url, branches):
+    keep = set(design_doc_id(b) for b in branches)
+    for row in iter_all_docs(design_couchdb_url, 
+                             startkey=u"_design/git-branch-",
+                             endkey=u"_design/git-branch-\ufff0",
+                             include_docs=True):
+        if row["id"] in keep or "couchapp_git_tree_id" not in row["doc"]:
+            continue
+        print "Deleting %r..." % (row["id"],)
+        delete(posixpath.join(design_couchdb_url, "_design", 
+                              url_quote(trim(row["id"], prefix="_design/"))),
+               row["value"]["rev"])
+
+### Deploying branches in parallel
+#
+# Branches are independent so several are deployed at once by a pool
+# of up to `parallelism` threads, which spend most of their time
+# waiting on CouchDB.  A branch that fails is reported along with its
+# traceback and does not stop the others.  The result for each branch
+# is its status (or the exception) and how long it took.
+def deploy_branches(branches, deploy, parallelism=1):
+    work = Queue.Queue()
+    for branch in branches:
+        work.put(branch)
+    results = {}
+    def worker():
+        while True:
+            try:
+                branch = work.get_nowait()
+            except Queue.Empty:
+                return
+            start_time = time.time()
+            try:
+                status = deploy(branch)
+            except Exception, e:
+                traceback.print_exc()
+                status = e
+            results[branch] = (status, time.time() - start_time)
+    threads = [threading.Thread(target=worker)
+               for i in range(max(1, min(parallelism, len(branches))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def print_deploy_summary(results):
+    if len(results) == 0:
+        return
+    print "Deploy summary:"
+    by_time = sorted(results.items(), key=lambda i: -i[1][1])
+    for branch, (status, seconds) in by_time:
+        if isinstance(status, Exception):
+            status = "FAILED: %s" % (status,)
+        print "  %8.2fs %s %s" % (seconds, branch, status)
+
+def failed_branches(results):
+    return sorted(b for (b, (status, seconds)) in results.items()
+                  if isinstance(status, Exception))
+
+def sync_batch(git_couchdb_url, design_couchdb_url, branch, app_subdir,
+               blob_cache=None, checkout=False, parallelism=1):
+    branches = list_branches(git_couchdb_url, branch)
+    results = deploy_branches(
+        branches, lambda b: sync_branch(git_couchdb_url, design_couchdb_url,
+                                        b, app_subdir, blob_cache, checkout),
+        parallelism)
+    if branch is None:
+        prune_design_docs(design_couchdb_url, branches)
+    if blob_cache is not None:
+        blob_cache.evict()
+    print_deploy_summary(results)
+    if len(failed_branches(results)) > 0:
+        raise Exception("Failed to deploy %s" 
+                        % (", ".join(failed_branches(results)),))
+    return branches
+
+### Following _changes
+#
+# Polling re-reads every branch, commit, tree and _design document on
+# each tick just to find that nothing has changed.  Instead the
+# BranchFollower does one full sync and then waits on a longpoll
+# `_changes` feed filtered to the `git-branches` document and the
+# branch documents it knows about.  Only the branches whose documents
+# change are redeployed.  A change to `git-branches` means branches
+# have come or gone so the new ones are deployed and the _design
+# documents of the old ones deleted.  Branches that failed to deploy
+# are tried again after the next change.
+CHANGES_TIMEOUT = 60
+
+class BranchFollower(object):
+
+    def __init__(self, git_couchdb_url, design_couchdb_url, branch,
+                 app_subdir, blob_cache=None, checkout=False, 
+                 parallelism=1):
+        self.git_couchdb_url = git_couchdb_url
+        self.design_couchdb_url = design_couchdb_url
+        self.branch = branch
+        self.app_subdir = app_subdir
+        self.blob_cache = blob_cache
+        self.checkout = checkout
+        self.parallelism = parallelism
+        self.since = None
+        self.branches = []
+        self.failed = set()
+
+    def deploy(self, branch):
+        return sync_branch(self.git_couchdb_url, self.design_couchdb_url,
+                           branch, self.app_subdir, self.blob_cache,
+                           self.checkout)
+
+    def sync(self, branches):
+        results = deploy_branches(list(branches), self.deploy, 
+                                  self.parallelism)
+        if self.blob_cache is not None:
+            self.blob_cache.evict()
+        print_deploy_summary(results)
+        self.failed = set(failed_branches(results))
+
+    def start(self):
+        db_info = get(self.git_couchdb_url)
+        if db_info.get("error") is not None:
+            raise Exception("Failed to read %s: %s"
+                            % (self.git_couchdb_url, pformat(db_info)))
+        self.since = db_info["update_seq"]
+        self.branches = list_branches(self.git_couchdb_url, self.branch)
+        if self.branch is None:
+            prune_design_docs(self.design_couchdb_url, self.branches)
+        self.sync(self.branches)
+
+    def wait_for_changes(self, timeout):
+        doc_ids = list(self.branches)
+        if self.branch is None:
+            doc_ids.append("git-branches")
+        url = make_query_url(
+            posixpath.join(self.git_couchdb_url, "_changes"),
+            {"feed": "longpoll", "filter": "_doc_ids", "since": self.since,
+             "timeout": int(timeout * 1000)})
+        result = json.loads(request(url, "POST", 
+                                    json.dumps({"doc_ids": doc_ids}),
+                                    ["Content-Type: application/json"]).body)
+        if result.get("error") is not None:
+            raise Exception("Failed to follow %s: %s" % (url, pformat(result)))
+        self.since = result["last_seq"]
+        return set(r["id"] for r in result["results"])
+
+    def step(self, timeout=CHANGES_TIMEOUT):
+        changed = self.wait_for_changes(timeout)
+        if "git-branches" in changed:
+            branches = list_branches(self.git_couchdb_url, self.branch)
+            changed.update(set(branches) - set(self.branches))
+            self.branches = branches
+            prune_design_docs(self.design_couchdb_url, branches)
+        self.sync(b for b in self.branches 
+                  if b in changed or b in self.failed)
 
 def main(argv):
     parser = optparse.OptionParser(__doc__)
     parser.add_option("--poll", dest="mode", action="store_const",
                       const="poll", default="once")
+    parser.add_option("--changes", dest="mode", action="store_const",
+                      const="changes", help="follow the _changes feed")
     parser.add_option("--poll-interval", dest="poll_interval",
                       type=int, default=60*60, 
                       help="unit: seconds, default: hourly")
     parser.add_option("--app-subdir", dest="app_subdir",
                       default=".")
     parser.add_option("--branch", dest="branch", default=None) 
+    parser.add_option("--parallelism", dest="parallelism", type=int,
+                      default=4, help=("deploy up to this many branches "
+                                       "at once, default: 4"))
+    parser.add_option("--cache-dir", dest="cache_dir", default=None,
+                      help=("keep immutable git documents in this "
+                            "directory between runs"))
+    parser.add_option("--cache-size", dest="cache_size", type=int,
+                      default=32, help="unit: MiB, default: 32")
+    parser.add_option("--checkout", dest="checkout", action="store_true",
+                      default=False, help=("write each tree to disk before "
+                                           "building the design document"))
+    parser.add_option("--blob-cache-dir", dest="blob_cache_dir",
+                      default=None, help=("with --checkout, keep the "
+                                          "contents of git blobs in this "
+                                          "directory between runs"))
+    parser.add_option("--blob-cache-size", dest="blob_cache_size",
+                      type=int, default=256, help="unit: MiB, default: 256")
     options, args = parser.parse_args(argv)
     if len(args) == 0:
         git_couchdb = "http://localhost:5984/jwallib"
@@ -138,14 +430,34 @@ def main(argv):
         design_couchdb = args.pop(0)
     if len(args) > 0:
         parser.error("Unexpected: %r" % (args,))
+    use_document_cache(DocumentCache(options.cache_dir,
+                                     options.cache_size * 1024 * 1024))
+    blob_cache = None
+    if options.blob_cache_dir is not None:
+        blob_cache = BlobCache(options.blob_cache_dir,
+                               options.blob_cache_size * 1024 * 1024)
     if options.mode == "once":
         sync_batch(git_couchdb, design_couchdb, options.branch, 
-                   options.app_subdir)
+                   options.app_subdir, blob_cache, options.checkout,
+                   options.parallelism)
     elif options.mode == "poll":
         while True:
-            sync_batch(git_couchdb, design_couchdb, options.branch,
-                       options.app_subdir)
+            try:
+                sync_batch(git_couchdb, design_couchdb, options.branch,
+                           options.app_subdir, blob_cache, options.checkout,
+                           options.parallelism)
+            except Exception:
+                # Failed branches are tried again on the next poll
+                traceback.print_exc()
             time.sleep(options.poll_interval)
+    elif options.mode == "changes":
+        follower = BranchFollower(git_couchdb, design_couchdb, 
+                                  options.branch, options.app_subdir,
+                                  blob_cache, options.checkout,
+                                  options.parallelism)
+        follower.start()
+        while True:
+            follower.step()
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv[1:]))
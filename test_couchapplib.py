@@ -0,0 +1,333 @@
+# Copyright 2011 James Ascroft-Leigh
+
+from jwalutil import mkdtemp, monkey_patch_attr, StringIO
+import base64
+import contextlib
+import couchapplib
+import couchdblib
+import hashlib
+import json
+import minicouchdb
+import os
+import posixpath
+import unittest
+
+def write_tree(root, files):
+    for path, data in files.items():
+        local_path = os.path.join(root, *path.split("/"))
+        if not os.path.exists(os.path.dirname(local_path)):
+            os.makedirs(os.path.dirname(local_path))
+        with open(local_path, "wb") as fh:
+            fh.write(data)
+
+EXAMPLE_APP = {
+    ".couchapprc": "{}",
+    ".couchappignore": '[\n  // Comment\n  ".*~$"\n]',
+    "_id": "_design/example\n",
+    "couchapp.json": '{"name": "Example"}',
+    "language": "javascript\n",
+    "rewrites.json": '[{"from": "/", "to": "/index.html"}]',
+    "views/branches/map.js": "function(doc) {}\n",
+    "evently/items/_changes/query.json": '{"view": "recent"}',
+    "_attachments/index.html": "<html></html>",
+    "_attachments/style/app.css": "body {}",
+    "_attachments/app.js~": "backup",
+    "vendor/couchapp/_attachments/loader.js": "// loader",
+    "vendor/couchapp/lib/path.js": "exports.x = 1;",
+    }
+
+class TestBuildDesignDoc(unittest.TestCase):
+
+    def test_example_app(self):
+        with mkdtemp() as temp_dir:
+            write_tree(temp_dir, EXAMPLE_APP)
+            doc, attachments = couchapplib.build_design_doc(
+                couchapplib.FilesystemSource(temp_dir))
+            index_html = attachments["index.html"].read()
+        self.assertEqual(doc, {
+                "_id": "_design/example",
+                "couchapp": {"name": "Example"},
+                "language": "javascript",
+                "rewrites": [{"from": "/", "to": "/index.html"}],
+                "views": {"branches": {"map": "function(doc) {}"}},
+                "evently": {"items": {"_changes": {
+                                "query": {"view": "recent"}}}},
+                "vendor": {"couchapp": {"lib": {"path": "exports.x = 1;"}}},
+                })
+        self.assertEqual(sorted(attachments), 
+                         ["index.html", "style/app.css", 
+                          "vendor/couchapp/loader.js"])
+        self.assertEqual(attachments["index.html"].content_type, "text/html")
+        self.assertEqual(attachments["index.html"].digest,
+                         "md5-" + base64.b64encode(
+                hashlib.md5("<html></html>").digest()))
+        self.assertEqual(index_html, "<html></html>")
+
+BUNDLED_APP = {
+    "couchapp.json": '{"bundle_pages": ["index.html"]}',
+    "_attachments/index.html": (
+        '<link rel="stylesheet"\n  href="/static/css/a.css"/>\n'
+        '<link href="/static/b.css" rel="stylesheet">\n'
+        '<script src="http://example.com/external.js"></script>\n'
+        '  <script src="/static/lib.js"></script>\n'
+        '  <script src="/static/app.js"></script>\n'),
+    "_attachments/css/a.css": ('/* Comment */\n.icon {\n'
+                               '  background: url("../img/i.png");\n}\n'),
+    "_attachments/b.css": "p { color : red ; }",
+    "_attachments/lib.js": "var lib = 1;",
+    "_attachments/lib.min.js": "var lib=1",
+    "_attachments/app.js": "lib + 1",
+    "_attachments/unused.js": "unused",
+    }
+
+class PrefetchingSource(couchapplib.FilesystemSource):
+
+    def __init__(self, root):
+        super(PrefetchingSource, self).__init__(root)
+        self.prefetched = []
+
+    def prefetch(self, attachments):
+        self.prefetched.extend(a.read() for a in attachments)
+
+class TestBundlePages(unittest.TestCase):
+
+    def test_bundled_app(self):
+        with mkdtemp() as temp_dir:
+            write_tree(temp_dir, BUNDLED_APP)
+            doc, attachments = couchapplib.build_design_doc(
+                couchapplib.FilesystemSource(temp_dir))
+        bundles = doc["bundles"]
+        by_type = dict((b["content_type"], (n, b["data"]))
+                       for (n, b) in bundles.items())
+        js_name, js = by_type["application/javascript"]
+        css_name, css = by_type["text/css"]
+        self.assertEqual(js, "var lib=1\n;\nlib + 1")
+        self.assertEqual(
+            css, '.icon{background: url("/static/img/i.png");}'
+            'p{color : red;}')
+        index_html = attachments["index.html"].read()
+        self.assertEqual(index_html, (
+                '<link href="/bundle/%s" rel="stylesheet">\n'
+                '<script src="http://example.com/external.js"></script>\n'
+                '  <script src="/bundle/%s"></script>\n' 
+                % (css_name, js_name)))
+        self.assertEqual(attachments["index.html"].digest,
+                         "md5-" + base64.b64encode(
+                hashlib.md5(index_html).digest()))
+        self.assertTrue(js_name.startswith("bundle-"))
+        self.assertTrue(js_name.endswith(".js"))
+
+    def test_minify_css_keeps_strings(self):
+        self.assertEqual(
+            couchapplib.minify_css(
+                'a::after {\n  content: "a, b; /* c */" ;\n'
+                "  background: url('x, y.png') ; /* d */\n}\n"),
+            'a::after{content: "a, b; /* c */";'
+            "background: url('x, y.png');}")
+
+    def test_only_bundled_files_are_prefetched(self):
+        with mkdtemp() as temp_dir:
+            write_tree(temp_dir, BUNDLED_APP)
+            source = PrefetchingSource(temp_dir)
+            couchapplib.build_design_doc(source)
+        self.assertEqual(
+            sorted(source.prefetched),
+            sorted(BUNDLED_APP["_attachments/" + n] 
+                   for n in ["index.html", "css/a.css", "b.css", 
+                             "lib.min.js", "app.js"]))
+
+    def test_deploy_from_git_tree(self):
+        server = minicouchdb.MiniCouchDB()
+        server.start()
+        try:
+            db_url = server.create_db("git")
+            tree_id, documents = git_documents(BUNDLED_APP)
+            couchdblib.bulk_docs(db_url, documents)
+            url = posixpath.join(db_url, "_design/app")
+            uploaded = couchapplib.push_git_tree(url, db_url, tree_id)
+            self.assertTrue("index.html" in uploaded)
+            out = StringIO()
+            couchdblib.get_attachment(posixpath.join(url, "index.html"), out)
+            self.assertTrue('<script src="/bundle/bundle-' 
+                            in out.getvalue())
+            self.assertEqual(couchapplib.push_git_tree(url, db_url, tree_id),
+                             [])
+        finally:
+            server.stop()
+
+class FakeDesignDoc(object):
+
+    def __init__(self, existing):
+        self.existing = existing
+        self.puts = []
+
+    def get(self, url):
+        return dict(self.existing)
+
+    def put_update(self, url, update_func):
+        existing = dict(self.existing)
+        existing.pop("_rev", None)
+        self.puts.append(update_func(existing))
+
+    @contextlib.contextmanager
+    def patched(self):
+        with contextlib.nested(
+            monkey_patch_attr(couchapplib, "get", self.get),
+            monkey_patch_attr(couchapplib, "put_update", self.put_update)):
+            yield
+
+class TestPushDesignDoc(unittest.TestCase):
+
+    attachments = {
+        "same.js": couchapplib.Attachment(
+            "application/javascript", "md5-same", lambda: "same"),
+        "new.js": couchapplib.Attachment(
+            "application/javascript", "md5-new", lambda: "new"),
+        }
+
+    digests = {"same.js": "md5-same", "new.js": "md5-new"}
+
+    def test_only_changed_attachments_are_uploaded(self):
+        # CouchDB's own digest may be of the data as it is stored,
+        # compressed, so only the digests recorded at the last deploy
+        # count
+        same_stub = {"stub": True, "content_type": "application/javascript",
+                     "digest": "md5-compressed", "revpos": 3, "length": 4}
+        fake = FakeDesignDoc(
+            {"_id": "_design/app", "_rev": "3-a", "language": "javascript",
+             "couchapp_digests": {"same.js": "md5-same", "new.js": "md5-old",
+                                  "gone.js": "md5-same"},
+             "_attachments": {
+                    "same.js": same_stub,
+                    "new.js": {"stub": True, "digest": "md5-new",
+                               "content_type": "application/javascript"},
+                    "gone.js": same_stub}})
+        with fake.patched():
+            uploaded = couchapplib.push_design_doc(
+                "http://example.com/db/_design/app",
+                {"_id": "_design/app", "language": "javascript"},
+                self.attachments)
+        self.assertEqual(uploaded, ["new.js"])
+        self.assertEqual(fake.puts, [{
+                    "language": "javascript",
+                    "couchapp_digests": self.digests,
+                    "_attachments": {
+                        "same.js": same_stub,
+                        "new.js": {"content_type": "application/javascript",
+                                   "data": "bmV3"}}}])
+
+    def test_unchanged_document_is_not_written(self):
+        stub = lambda d: {"stub": True, "digest": d, 
+                          "content_type": "application/javascript"}
+        fake = FakeDesignDoc(
+            {"_id": "_design/app", "_rev": "3-a", "language": "javascript",
+             "couchapp_digests": self.digests,
+             "_attachments": {"same.js": stub("md5-compressed"),
+                              "new.js": stub("md5-compressed")}})
+        with fake.patched():
+            uploaded = couchapplib.push_design_doc(
+                "http://example.com/db/_design/app",
+                {"language": "javascript"}, self.attachments)
+        self.assertEqual(uploaded, [])
+        self.assertEqual(fake.puts, [])
+
+    def test_attachments_without_recorded_digests_are_uploaded(self):
+        stub = {"stub": True, "digest": "md5-same", 
+                "content_type": "application/javascript"}
+        fake = FakeDesignDoc(
+            {"_id": "_design/app", "_rev": "3-a", "language": "javascript",
+             "_attachments": {"same.js": stub, "new.js": stub}})
+        with fake.patched():
+            uploaded = couchapplib.push_design_doc(
+                "http://example.com/db/_design/app",
+                {"language": "javascript"}, self.attachments)
+        self.assertEqual(uploaded, ["new.js", "same.js"])
+
+def git_documents(files):
+    documents = {}
+    def add_tree(entries):
+        children = []
+        for name, value in sorted(entries.items()):
+            if isinstance(value, dict):
+                child = add_tree(value)
+            else:
+                sha = hashlib.sha1(value).hexdigest()
+                child = {"_id": "git-blob-" + sha, "type": "git-blob",
+                         "sha": sha, "encoding": "base64",
+                         "base64": base64.b64encode(value)}
+                documents[child["_id"]] = child
+            children.append({"basename": name, "mode": "-rw-r--r--",
+                             "child": {"_id": child["_id"], 
+                                       "type": child["type"]}})
+        sha = hashlib.sha1(json.dumps(children)).hexdigest()
+        tree = {"_id": "git-tree-" + sha, "type": "git-tree", "sha": sha,
+                "children": children}
+        documents[tree["_id"]] = tree
+        return tree
+    nested = {}
+    for path, data in files.items():
+        parts = path.split("/")
+        parent = nested
+        for part in parts[:-1]:
+            parent = parent.setdefault(part, {})
+        parent[parts[-1]] = data
+    root = add_tree(nested)
+    return root["_id"], documents.values()
+
+class TestGitTreeSource(unittest.TestCase):
+
+    def setUp(self):
+        self.server = minicouchdb.MiniCouchDB()
+        self.server.start()
+        self.db_url = self.server.create_db("git")
+
+    def tearDown(self):
+        self.server.stop()
+
+    def add_app(self, files):
+        tree_id, documents = git_documents(files)
+        couchdblib.bulk_docs(self.db_url, [
+                d for d in documents 
+                if "error" in couchdblib.get(posixpath.join(self.db_url,
+                                                            d["_id"]))])
+        return tree_id
+
+    def test_same_as_filesystem(self):
+        tree_id = self.add_app(EXAMPLE_APP)
+        git_doc, git_attachments = couchapplib.build_design_doc(
+            couchapplib.GitTreeSource(self.db_url, tree_id))
+        with mkdtemp() as temp_dir:
+            write_tree(temp_dir, EXAMPLE_APP)
+            doc, attachments = couchapplib.build_design_doc(
+                couchapplib.FilesystemSource(temp_dir))
+            for name, attachment in attachments.items():
+                self.assertEqual(git_attachments[name].read(), 
+                                 attachment.read())
+        self.assertEqual(git_doc, doc)
+        self.assertEqual(sorted(git_attachments), sorted(attachments))
+
+    def test_unchanged_attachments_are_not_fetched(self):
+        url = posixpath.join(self.db_url, "_design/example")
+        tree_id = self.add_app(EXAMPLE_APP)
+        uploaded = couchapplib.push_git_tree(url, self.db_url, tree_id)
+        self.assertEqual(len(uploaded), 3)
+        changed_app = dict(EXAMPLE_APP)
+        changed_app["_attachments/index.html"] = "<html>Changed</html>"
+        tree_id = self.add_app(changed_app)
+        fetched = []
+        def recording_iter_docs(db_url, doc_ids):
+            fetched.extend(doc_ids)
+            return couchdblib.iter_docs(db_url, doc_ids)
+        with monkey_patch_attr(couchapplib, "iter_docs", 
+                               recording_iter_docs):
+            uploaded = couchapplib.push_git_tree(url, self.db_url, tree_id)
+        self.assertEqual(uploaded, ["index.html"])
+        blob_ids = couchdblib.get(url)["couchapp_git_blob_ids"]
+        self.assertEqual([i for i in fetched if i in blob_ids.values()],
+                         [blob_ids["index.html"]])
+        out = StringIO()
+        couchdblib.get_attachment(posixpath.join(url, "index.html"), out)
+        self.assertEqual(out.getvalue(), "<html>Changed</html>")
+
+if __name__ == "__main__":
+    unittest.main()
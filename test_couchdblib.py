@@ -0,0 +1,383 @@
+# Copyright 2011 James Ascroft-Leigh
+
+from distutils.spawn import find_executable
+from jwalutil import monkey_patch_attr, mkdtemp, StringIO
+from process import call
+import base64
+import contextlib
+import couchdblib
+import hashlib
+import json
+import unittest
+import urlparse
+import zlib
+
+class FakeDocument(object):
+
+    def __init__(self, conflicts=0, error=None):
+        self.doc = {"_id": "a", "_rev": "1-a", "count": 0}
+        self.conflicts = conflicts
+        self.error = error
+        self.puts = 0
+
+    def get(self, url):
+        return dict(self.doc)
+
+    def put(self, url, document):
+        self.puts += 1
+        if self.error is not None:
+            return {"error": self.error, "reason": "Just testing"}
+        if self.conflicts > 0:
+            self.conflicts -= 1
+            return {"error": "conflict", "reason": "Just testing"}
+        self.doc = dict(document)
+        self.doc["_rev"] = "2-b"
+        return {"ok": True, "id": "a", "rev": "2-b"}
+
+    @contextlib.contextmanager
+    def patched(self):
+        with contextlib.nested(
+            monkey_patch_attr(couchdblib, "get", self.get),
+            monkey_patch_attr(couchdblib, "put", self.put),
+            monkey_patch_attr(couchdblib, "backoff_delay", lambda a: 0)):
+            yield
+
+def increment(doc):
+    doc["count"] += 1
+
+class TestPutUpdate(unittest.TestCase):
+
+    def test_retries_conflicts(self):
+        fake = FakeDocument(conflicts=3)
+        url = "http://example.com/db/retries"
+        with fake.patched():
+            result = couchdblib.put_update(url, increment)
+        self.assertEqual(result["count"], 1)
+        self.assertEqual(result["_rev"], "2-b")
+        self.assertEqual(fake.puts, 4)
+        self.assertEqual(couchdblib.CONFLICT_COUNTS[url], 3)
+
+    def test_retry_budget(self):
+        fake = FakeDocument(conflicts=10)
+        with fake.patched():
+            self.assertRaises(Exception, couchdblib.put_update,
+                              "http://example.com/db/budget", increment,
+                              max_attempts=5)
+        self.assertEqual(fake.puts, 5)
+
+    def test_other_errors_are_not_retried(self):
+        fake = FakeDocument(error="forbidden")
+        with fake.patched():
+            self.assertRaises(Exception, couchdblib.put_update,
+                              "http://example.com/db/forbidden", increment)
+        self.assertEqual(fake.puts, 1)
+
+class TestBackoffDelay(unittest.TestCase):
+
+    def test_window_grows_and_is_capped(self):
+        for attempt in range(100):
+            delay = couchdblib.backoff_delay(attempt, base_delay=0.5,
+                                             max_delay=3.0)
+            self.assertTrue(0 <= delay <= min(3.0, 0.5 * 2 ** attempt))
+
+class TestRowParser(unittest.TestCase):
+
+    rows = [
+        {"id": "a", "key": "a", "value": {"rev": "1-a"}},
+        {"id": "b]", "key": ["[", "{"], "value": "\\\"}]"},
+        {"id": "c", "key": None, "value": [[], {}, [{"x": "]"}]]},
+        ]
+
+    def body(self):
+        return json.dumps({"total_rows": 3, "offset": 0, "rows": self.rows})
+
+    def test_whole_body(self):
+        parser = couchdblib.RowParser()
+        parser.feed(self.body())
+        self.assertEqual(parser.pop_rows(), self.rows)
+        parser.close()
+
+    def test_one_byte_at_a_time(self):
+        parser = couchdblib.RowParser()
+        received = []
+        biggest_row = max(len(json.dumps(r)) for r in self.rows)
+        for char in self.body():
+            parser.feed(char)
+            received.extend(parser.pop_rows())
+            self.assertTrue(len(parser.buffer) <= biggest_row, parser.buffer)
+        self.assertEqual(received, self.rows)
+        parser.close()
+
+    def test_changes_results(self):
+        parser = couchdblib.RowParser("results")
+        parser.feed('{"results":[\r\n{"seq":1,"id":"a"}\r\n],\r\n'
+                    '"last_seq":1}')
+        self.assertEqual(parser.pop_rows(), [{"seq": 1, "id": "a"}])
+        parser.close()
+
+    def test_error_response(self):
+        parser = couchdblib.RowParser()
+        parser.feed('{"error":"not_found","reason":"missing"}')
+        self.assertEqual(parser.pop_rows(), [])
+        self.assertRaises(Exception, parser.close)
+
+class TestMakeQueryUrl(unittest.TestCase):
+
+    def test_json_params(self):
+        url = couchdblib.make_query_url(
+            "http://example.com/db/_all_docs",
+            {"startkey": "git-", "limit": 3, "include_docs": True,
+             "endkey": None})
+        self.assertEqual(url, "http://example.com/db/_all_docs"
+                         "?include_docs=true&limit=3&startkey=%22git-%22")
+
+class FakeView(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.urls = []
+
+    def iter_rows(self, url):
+        self.urls.append(url)
+        query = dict(urlparse.parse_qsl(urlparse.urlparse(url).query))
+        start = (json.loads(query.get("startkey", "null")), 
+                 query.get("startkey_docid", ""))
+        rows = [r for r in self.rows 
+                if "startkey" not in query or (r["key"], r["id"]) >= start]
+        return iter(rows[:int(query["limit"])])
+
+class TestIterView(unittest.TestCase):
+
+    rows = [{"id": "doc-%02d" % i, "key": i // 4, "value": None} 
+            for i in range(10)]
+
+    def test_keyset_pagination_with_duplicate_keys(self):
+        view = FakeView(self.rows)
+        with monkey_patch_attr(couchdblib, "iter_rows", view.iter_rows):
+            result = couchdblib.query_view(
+                "http://example.com/db/_design/app/_view/v", page_size=3,
+                stale="update_after")
+        self.assertEqual(result, self.rows)
+        self.assertEqual(len(view.urls), 4)
+        self.assertEqual(view.urls[1],
+                         "http://example.com/db/_design/app/_view/v"
+                         "?limit=4&stale=update_after&startkey=0"
+                         "&startkey_docid=doc-03")
+
+    def test_stale_is_checked(self):
+        self.assertRaises(Exception, couchdblib.query_view,
+                          "http://example.com/db/_design/app/_view/v",
+                          stale="yes")
+
+    def test_view_url(self):
+        self.assertEqual(couchdblib.view_url("http://example.com/db/"
+                                             "_design/app", "a b"),
+                         "http://example.com/db/_design/app/_view/a%20b")
+
+class FakeServer(object):
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.requests = []
+
+    def request(self, url, method="GET", body=None, headers=()):
+        self.requests.append((url, list(headers)))
+        doc_id = url.rsplit("/", 1)[-1]
+        if doc_id not in self.documents:
+            return couchdblib.Response(404, {}, '{"error":"not_found"}')
+        body = json.dumps(self.documents[doc_id])
+        etag = '"%s"' % (self.documents[doc_id]["_rev"],)
+        if "If-None-Match: %s" % (etag,) in headers:
+            return couchdblib.Response(304, {"etag": etag}, "")
+        return couchdblib.Response(200, {"etag": etag}, body)
+
+class TestDocumentCache(unittest.TestCase):
+
+    documents = {
+        "git-blob-1": {"_id": "git-blob-1", "_rev": "1-a", "raw": "x" * 50},
+        "git-blob-2": {"_id": "git-blob-2", "_rev": "1-b", "raw": "y" * 50},
+        "git-branch-master": {"_id": "git-branch-master", "_rev": "1-c"},
+        }
+
+    def test_immutable_documents_are_fetched_once(self):
+        server = FakeServer(self.documents)
+        cache = couchdblib.DocumentCache()
+        with monkey_patch_attr(couchdblib, "request", server.request):
+            for i in range(3):
+                doc = cache.get("http://example.com/db/git-blob-1")
+        self.assertEqual(doc, self.documents["git-blob-1"])
+        self.assertEqual(len(server.requests), 1)
+
+    def test_memory_is_bounded(self):
+        server = FakeServer(self.documents)
+        cache = couchdblib.DocumentCache(max_bytes=100)
+        with monkey_patch_attr(couchdblib, "request", server.request):
+            cache.get("http://example.com/db/git-blob-1")
+            cache.get("http://example.com/db/git-blob-2")
+            cache.get("http://example.com/db/git-blob-1")
+        self.assertEqual(len(server.requests), 3)
+        self.assertTrue(cache.size <= 100)
+
+    def test_disk_store(self):
+        server = FakeServer(self.documents)
+        with mkdtemp() as temp_dir:
+            with monkey_patch_attr(couchdblib, "request", server.request):
+                couchdblib.DocumentCache(temp_dir).get(
+                    "http://example.com/db/git-blob-1")
+                doc = couchdblib.DocumentCache(temp_dir).get(
+                    "http://example.com/db/git-blob-1")
+        self.assertEqual(doc, self.documents["git-blob-1"])
+        self.assertEqual(len(server.requests), 1)
+
+    def test_databases_are_kept_apart(self):
+        server = FakeServer(self.documents)
+        urls = ["http://example.com/db/git-blob-1",
+                "http://example.com/otherdb/git-blob-1"]
+        with mkdtemp() as temp_dir:
+            with monkey_patch_attr(couchdblib, "request", server.request):
+                cache = couchdblib.DocumentCache(temp_dir)
+                for url in urls:
+                    cache.get(url)
+                for url in urls:
+                    couchdblib.DocumentCache(temp_dir).get(url)
+        self.assertEqual([url for url, headers in server.requests], urls)
+
+    def test_mutable_documents_are_revalidated(self):
+        server = FakeServer(self.documents)
+        cache = couchdblib.DocumentCache()
+        url = "http://example.com/db/git-branch-master"
+        with monkey_patch_attr(couchdblib, "request", server.request):
+            cache.get(url)
+            doc = cache.get(url)
+        self.assertEqual(doc, self.documents["git-branch-master"])
+        self.assertEqual(server.requests, 
+                         [(url, []), (url, ['If-None-Match: "1-c"'])])
+        self.assertEqual(cache.revalidations, 1)
+
+    def test_missing_documents_are_not_cached(self):
+        server = FakeServer(self.documents)
+        cache = couchdblib.DocumentCache()
+        with monkey_patch_attr(couchdblib, "request", server.request):
+            cache.get("http://example.com/db/git-blob-3")
+            result = cache.get("http://example.com/db/git-blob-3")
+        self.assertEqual(result["error"], "not_found")
+        self.assertEqual(len(server.requests), 2)
+
+class TestAttachmentHelpers(unittest.TestCase):
+
+    def test_file_md5_is_chunked(self):
+        data = "".join(chr(i % 256) for i in range(100000))
+        expected = base64.b64encode(hashlib.md5(data).digest())
+        self.assertEqual(couchdblib.file_md5(StringIO(data), chunk_size=7),
+                         expected)
+
+    def test_attachment_url(self):
+        self.assertEqual(
+            couchdblib.attachment_url("http://example.com/db/_design/app",
+                                      "highlight.js/styles/a b.css"),
+            "http://example.com/db/_design/app/highlight.js/styles/a%20b.css")
+
+@unittest.skipIf(find_executable("node") is None, "needs node")
+class TestUpdateHandlerScripts(unittest.TestCase):
+
+    def run_handler(self, name, doc, changes):
+        request = {"id": "a", "body": json.dumps(changes)}
+        script = ("var handler = %s;\n"
+                  "console.log(JSON.stringify(handler(%s, %s)));"
+                  % (couchdblib.UPDATE_HANDLERS[name], json.dumps(doc), 
+                     json.dumps(request)))
+        new_doc, body = json.loads(call(["node", "-e", script]))
+        self.assertEqual(json.loads(body), {"ok": True, "id": "a"})
+        return new_doc
+
+    def test_replace(self):
+        existing = {"_id": "a", "_rev": "1-x", "old": 1}
+        self.assertEqual(
+            self.run_handler("replace", existing, {"new": 2, "_rev": "9-z"}),
+            {"_id": "a", "_rev": "1-x", "new": 2})
+        self.assertEqual(
+            self.run_handler("replace", None, {"new": 2, "_rev": "9-z"}),
+            {"_id": "a", "new": 2})
+
+    def test_merge(self):
+        existing = {"_id": "a", "_rev": "1-x", "old": 1, "both": 1}
+        self.assertEqual(
+            self.run_handler("merge", existing, 
+                             {"both": 2, "new": 3, "_id": "b", "_rev": "9-z"}),
+            {"_id": "a", "_rev": "1-x", "old": 1, "both": 2, "new": 3})
+        self.assertEqual(self.run_handler("merge", None, {"new": 3}),
+                         {"_id": "a", "new": 3})
+
+class TestTracing(unittest.TestCase):
+
+    def test_endpoint_class(self):
+        cases = [
+            ("http://host/db/_all_docs?limit=3", "GET _all_docs"),
+            ("http://host/db/_changes", "GET _changes"),
+            ("http://host/db/git-blob-ab12", "GET git-blob-*"),
+            ("http://host/db/git-branches", "GET git-branches"),
+            ("http://host/db/git-branch-master", "GET git-branch-*"),
+            ("http://host/db/_design/app", "GET _design"),
+            ("http://host/db/_design/app/_view/v", "GET _design/_view"),
+            ("http://host/db/_design/app/index.html", 
+             "GET _design attachment"),
+            ("http://host/prefix/db", "GET database"),
+            ]
+        for url, expected in cases:
+            self.assertEqual(couchdblib.endpoint_class("GET", url), expected)
+
+    def test_histogram(self):
+        histogram = couchdblib.LatencyHistogram()
+        for total in [0.001, 0.003, 0.003, 0.1]:
+            histogram(couchdblib.RequestTrace(
+                    "GET", "http://host/db/git-tree-1", 200, 0, 10,
+                    0.0, 0.0005, 0.0, total / 2, total))
+        histogram(couchdblib.RequestTrace(
+                "GET", "http://host/db/git-tree-2", 0, 0, 0,
+                0.0, 0.0, 0.0, 0.0, 0.0))
+        stats = histogram.classes["GET git-tree-*"]
+        self.assertEqual(stats["count"], 5)
+        self.assertEqual(stats["errors"], 1)
+        self.assertEqual(stats["received"], 40)
+        self.assertEqual(stats["buckets"], {0: 2, 2: 2, 7: 1})
+        report = histogram.report()
+        self.assertTrue(report.startswith("GET git-tree-*: count=5"), report)
+
+    def test_environment(self):
+        before = list(couchdblib.REQUEST_HOOKS)
+        try:
+            couchdblib.install_tracing_from_environment(
+                {"COUCHDBLIB_TRACE": "log"})
+            self.assertEqual(couchdblib.REQUEST_HOOKS, 
+                             before + [couchdblib.log_request])
+        finally:
+            couchdblib.REQUEST_HOOKS[:] = before
+        self.assertRaises(Exception, 
+                          couchdblib.install_tracing_from_environment,
+                          {"COUCHDBLIB_TRACE": "nonsense"})
+
+class TestCompressedTransfer(unittest.TestCase):
+
+    def test_gzip_round_trip(self):
+        data = json.dumps([{"_id": "git-tree-%d" % i} for i in range(100)])
+        compressed = couchdblib.gzip_compress(data)
+        self.assertTrue(len(compressed) < len(data))
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS),
+                         data)
+
+    def test_request_bodies_are_not_compressed_by_default(self):
+        with monkey_patch_attr(couchdblib, "gzip_request_min_size", None):
+            body, headers = couchdblib.compress_body("x" * 1000, ["A: b"])
+        self.assertEqual((body, headers), ("x" * 1000, ["A: b"]))
+
+    def test_request_body_threshold(self):
+        with monkey_patch_attr(couchdblib, "gzip_request_min_size", 100):
+            small = couchdblib.compress_body("x" * 99, [])
+            big = couchdblib.compress_body("x" * 100, [])
+        self.assertEqual(small, ("x" * 99, []))
+        self.assertEqual(big[1], ["Content-Encoding: gzip"])
+        self.assertEqual(zlib.decompress(big[0], 16 + zlib.MAX_WBITS),
+                         "x" * 100)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,8 +8,10 @@ from __future__ import with_statement
 
 from pprint import pformat
 from selenium import webdriver
-from couchdblib import delete, couchapp
+from couchapplib import push_couchapp
+from couchdblib import delete
 from couchdblib import get, put, post_new, put_update, url_quote
+from couchdblib import iter_view
 from jwalutil import add_user_to_url, mkdtemp, monkey_patch_attr, group_by
 import contextlib
 import datetime
@@ -187,14 +189,14 @@ class GitbrowserSeleniumTests(unittest.TestCase):
 
     def _run_test(self):
         # Wipe out all git-related documents and the design document
-        result = get(posixpath.join(self.couchdb_url, 
-                                    "_design/test/_view/git-documents"))
-        for item in result["rows"]:
+        rows = iter_view(posixpath.join(self.couchdb_url, 
+                                        "_design/test/_view/git-documents"))
+        for item in rows:
             delete(posixpath.join(self.couchdb_url, url_quote(item["id"])))
         # Upload the gitbrowser to the couchdb design document
         gitbrowser_source_path = os.path.join(self.source_path, "gitbrowser")
-        couchapp(posixpath.join(self.couchdb_url, "_design/gitbrowser"), 
-                 gitbrowser_source_path)
+        push_couchapp(posixpath.join(self.couchdb_url, "_design/gitbrowser"), 
+                      gitbrowser_source_path)
         # Populate a test GIT repository
         with mkdtemp() as temp_dir:
             cwd_script = ["bash", "-c", 'cd "$1" && shift && exec "$@"', "-", 
@@ -331,9 +333,9 @@ function (doc) {
             }
         put_update(posixpath.join(self.couchdb_url, "_design/test"),
                    lambda a=None: design_doc)
-        result = get(posixpath.join(self.couchdb_url, 
-                                    "_design/test/_view/pending-tests"))
-        pending_ids = set(i["id"] for i in result["rows"])
+        pending_ids = set(i["id"] for i in iter_view(
+                posixpath.join(self.couchdb_url, 
+                               "_design/test/_view/pending-tests")))
         for missing_id in pending_ids - queued_ids:
             put_update(posixpath.join(self.couchdb_url, url_quote(missing_id)),
                        mark_aborted)
@@ -0,0 +1,277 @@
+# Copyright 2011 James Ascroft-Leigh
+
+from __future__ import with_statement
+
+from couchapplib import blob_to_data
+from distutils.spawn import find_executable
+from jwalutil import mkdtemp, monkey_patch_attr
+from process import call
+import contextlib
+import couchdblib
+import gitcouchdbsync
+import minicouchdb
+import os
+import posixpath
+import unittest
+
+GIT = ["git", "-c", "user.name=Test", "-c", "user.email=test@example.com"]
+
+@contextlib.contextmanager
+def chdir(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+class GitCouchDBSyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = minicouchdb.MiniCouchDB()
+        self.server.start()
+        self.db_url = self.server.create_db("git")
+
+    def tearDown(self):
+        self.server.stop()
+
+    def commit(self, repo_dir, files, message="Change"):
+        for path, data in files.items():
+            local_path = os.path.join(repo_dir, *path.split("/"))
+            if not os.path.exists(os.path.dirname(local_path)):
+                os.makedirs(os.path.dirname(local_path))
+            with open(local_path, "wb") as fh:
+                fh.write(data)
+        with chdir(repo_dir):
+            call(GIT + ["add", "-A"])
+            call(GIT + ["commit", "-q", "-m", message])
+
+    def sync(self, repo_dir, render=False, index=False):
+        with chdir(repo_dir):
+            gitcouchdbsync.git_to_couchdb(None, None, self.db_url, render,
+                                          index)
+
+    def get(self, doc_id):
+        return couchdblib.get(posixpath.join(self.db_url, doc_id))
+
+class TestPathIndex(GitCouchDBSyncTestCase):
+
+    def test_branch_head_has_path_index(self):
+        with mkdtemp() as repo_dir:
+            call(["git", "init", "-q", repo_dir])
+            self.commit(repo_dir, {"a/b/c.txt": "deep\n", "top.txt": "top\n"})
+            self.sync(repo_dir)
+            branch = self.get("git-branch-master")
+            index = self.get(branch["pathindex"]["_id"])
+            self.assertEqual(index["tree"]["_id"], branch["tree"]["_id"])
+            self.assertEqual(sorted(index["paths"]),
+                             ["a", "a/b", "a/b/c.txt", "top.txt"])
+            entry = index["paths"]["a/b/c.txt"]
+            self.assertEqual(entry["mode"], "-rw-r--r--")
+            self.assertEqual(blob_to_data(self.get(entry["_id"])), "deep\n")
+
+class TestHistory(GitCouchDBSyncTestCase):
+
+    def history(self, doc_id):
+        pages = []
+        while doc_id is not None:
+            page = self.get(doc_id)
+            pages.append((page["depth"], 
+                          [c["subject"] for c in page["commits"]]))
+            doc_id = page.get("next", {}).get("_id")
+        return pages
+
+    def history_ids(self):
+        return set(r["id"] for r in couchdblib.iter_all_docs(
+                self.db_url, startkey="git-history-",
+                endkey=u"git-history-\ufff0"))
+
+    def test_pages_are_shared_as_the_branch_moves(self):
+        with contextlib.nested(
+            mkdtemp(), 
+            monkey_patch_attr(gitcouchdbsync, "HISTORY_PAGE_SIZE", 2)
+            ) as (repo_dir, _):
+            call(["git", "init", "-q", repo_dir])
+            for i in range(1, 6):
+                self.commit(repo_dir, {"f.txt": "%d\n" % i}, "c%d" % i)
+            self.sync(repo_dir)
+            head = self.get("git-branch-master")["history"]["_id"]
+            self.assertEqual(self.history(head), 
+                             [(5, ["c5"]), (4, ["c4", "c3"]), 
+                              (2, ["c2", "c1"])])
+            page_ids = self.history_ids()
+            self.commit(repo_dir, {"f.txt": "6\n"}, "c6")
+            self.sync(repo_dir)
+            head = self.get("git-branch-master")["history"]["_id"]
+            self.assertEqual(self.history(head), 
+                             [(6, ["c6", "c5"]), (4, ["c4", "c3"]), 
+                              (2, ["c2", "c1"])])
+            self.assertEqual(self.history_ids() - page_ids, set([head]))
+
+class TestDiff(GitCouchDBSyncTestCase):
+
+    def test_changes_against_first_parent(self):
+        with mkdtemp() as repo_dir:
+            call(["git", "init", "-q", repo_dir])
+            self.commit(repo_dir, {"a.txt": "a\n", "d/x.txt": "x\n", 
+                                   "d/y.txt": "y\n", "e/same.txt": "s\n"})
+            self.sync(repo_dir)
+            root_id = self.get("git-branch-master")["commit"]["_id"]
+            old_paths = self.get(
+                self.get("git-branch-master")["pathindex"]["_id"])["paths"]
+            os.remove(os.path.join(repo_dir, "a.txt"))
+            self.commit(repo_dir, {"d/x.txt": "x2\n", "d/z.txt": "z\n"})
+            self.sync(repo_dir)
+            branch = self.get("git-branch-master")
+            new_paths = self.get(branch["pathindex"]["_id"])["paths"]
+            diff = self.get(branch["commit"]["_id"].replace("-commit-", 
+                                                            "-diff-"))
+            self.assertEqual(diff["parent"]["_id"], root_id)
+            self.assertEqual(diff["tree"]["_id"], branch["tree"]["_id"])
+            self.assertEqual([c["path"] for c in diff["added"]], ["d/z.txt"])
+            self.assertEqual(diff["added"][0]["new"]["_id"], 
+                             new_paths["d/z.txt"]["_id"])
+            self.assertEqual([c["path"] for c in diff["removed"]], ["a.txt"])
+            self.assertEqual(diff["removed"][0]["old"]["_id"],
+                             old_paths["a.txt"]["_id"])
+            self.assertEqual(diff["modified"], 
+                             [{"path": "d/x.txt", 
+                               "old": old_paths["d/x.txt"],
+                               "new": new_paths["d/x.txt"]}])
+            root_diff = self.get(root_id.replace("-commit-", "-diff-"))
+            self.assertTrue("parent" not in root_diff)
+            self.assertEqual([c["path"] for c in root_diff["added"]],
+                             ["a.txt", "d/x.txt", "d/y.txt", "e/same.txt"])
+
+class TestTrigramIndex(GitCouchDBSyncTestCase):
+
+    def postings(self, trigram):
+        shard = self.get("git-trigrams-"
+                         + gitcouchdbsync.trigram_shard(trigram))
+        postings = shard.get("postings", {}).get(trigram.encode("hex"), "")
+        if postings == "":
+            return []
+        return gitcouchdbsync.decode_postings(postings)
+
+    def blob_numbers(self):
+        per_shard = self.get("git-trigrams-index")["blobs_per_shard"]
+        numbers = {}
+        pending = []
+        for shard, doc in gitcouchdbsync.get_trigram_blobs(
+            self.db_url).items():
+            for i, sha in enumerate(doc["blobs"]):
+                self.assertFalse(sha in numbers, sha)
+                numbers[sha] = shard * per_shard + i
+            pending.extend(doc["pending"])
+        return numbers, pending
+
+    def number(self, numbers, path):
+        paths = self.get(self.get("git-branch-master")["pathindex"]["_id"])
+        return numbers[paths["paths"][path]["_id"][len("git-blob-"):]]
+
+    def test_merge_postings(self):
+        postings = gitcouchdbsync.merge_postings("", [40, 3])
+        self.assertEqual(postings, "3,11")
+        postings = gitcouchdbsync.merge_postings(postings, [41, 40, 1, 100])
+        self.assertEqual(postings, "1,2,11,1,1n")
+        self.assertEqual(gitcouchdbsync.decode_postings(postings),
+                         [1, 3, 40, 41, 100])
+
+    def test_new_blobs_are_added(self):
+        with contextlib.nested(
+            mkdtemp(),
+            monkey_patch_attr(gitcouchdbsync, "TRIGRAM_BLOBS_PER_SHARD", 2)
+            ) as (repo_dir, unused):
+            call(["git", "init", "-q", repo_dir])
+            self.commit(repo_dir, {"a.txt": "Hello world\n",
+                                   "b.txt": "help\n",
+                                   "c.bin": "hello\0\n"})
+            self.sync(repo_dir, index=True)
+            numbers, pending = self.blob_numbers()
+            self.assertEqual(sorted(numbers.values()), [0, 1, 2])
+            self.assertEqual(pending, [])
+            number = lambda path: self.number(numbers, path)
+            self.assertEqual(self.postings("hel"),
+                             sorted([number("a.txt"), number("b.txt")]))
+            self.assertEqual(self.postings("wor"), [number("a.txt")])
+            self.assertEqual(self.postings("xyz"), [])
+            old = [number("a.txt"), number("b.txt")]
+            self.commit(repo_dir, {"b.txt": "Well, hello\n"})
+            self.sync(repo_dir, index=True)
+            new_numbers, pending = self.blob_numbers()
+            self.assertEqual(len(new_numbers), 4)
+            for sha, n in numbers.items():
+                self.assertEqual(new_numbers[sha], n)
+            self.assertEqual(self.postings("hel"), sorted(old + [3]))
+            self.assertEqual(self.postings("wel"),
+                             [self.number(new_numbers, "b.txt")])
+            self.assertEqual(self.number(new_numbers, "b.txt"), 3)
+
+    def test_interrupted_run_is_finished(self):
+        def interrupt(blob):
+            raise KeyboardInterrupt()
+        with mkdtemp() as repo_dir:
+            call(["git", "init", "-q", repo_dir])
+            self.commit(repo_dir, {"a.txt": "Hello world\n"})
+            with monkey_patch_attr(gitcouchdbsync, "blob_trigrams",
+                                   interrupt):
+                self.assertRaises(KeyboardInterrupt, self.sync, repo_dir,
+                                  index=True)
+            numbers, pending = self.blob_numbers()
+            self.assertEqual(pending, [0])
+            self.assertEqual(self.postings("hel"), [])
+            self.commit(repo_dir, {"b.txt": "help\n"})
+            self.sync(repo_dir, index=True)
+            numbers, pending = self.blob_numbers()
+            self.assertEqual(pending, [])
+            self.assertEqual(self.postings("hel"), [0, 1])
+
+    def test_interleaved_runs(self):
+        # The second run starts and finishes while the first one is
+        # reading its blobs, after it has numbered them
+        blob_trigrams = gitcouchdbsync.blob_trigrams
+        def interleave(blob):
+            if len(interleaved) == 0:
+                interleaved.append(True)
+                self.commit(repo_dir, {"b.txt": "help\n"})
+                self.sync(repo_dir, index=True)
+            return blob_trigrams(blob)
+        interleaved = []
+        with mkdtemp() as repo_dir:
+            call(["git", "init", "-q", repo_dir])
+            self.commit(repo_dir, {"a.txt": "Hello world\n"})
+            with monkey_patch_attr(gitcouchdbsync, "blob_trigrams",
+                                   interleave):
+                self.sync(repo_dir, index=True)
+            numbers, pending = self.blob_numbers()
+            self.assertEqual(sorted(numbers.values()), [0, 1])
+            self.assertEqual(pending, [])
+            self.assertEqual(self.postings("hel"), [0, 1])
+            self.assertEqual(self.postings("wor"),
+                             [self.number(numbers, "a.txt")])
+
+@unittest.skipIf(find_executable("node") is None, "needs node")
+class TestRender(GitCouchDBSyncTestCase):
+
+    def test_renders_source_files_at_branch_heads(self):
+        with mkdtemp() as repo_dir:
+            call(["git", "init", "-q", repo_dir])
+            self.commit(repo_dir, {"lib/a.py": "# Says *hello*\n\nx = 1\n",
+                                   "notes.txt": "Just text\n"})
+            self.sync(repo_dir, render=True)
+            index = self.get(self.get("git-branch-master")["pathindex"]["_id"])
+            blob_id = index["paths"]["lib/a.py"]["_id"]
+            rendered = self.get(blob_id.replace("-blob-", "-rendered-"))
+            self.assertEqual(rendered["mime_type"], "text/x-python")
+            self.assertEqual(rendered["blob"]["_id"], blob_id)
+            self.assertEqual(rendered["segments"][0][0], 
+                             "<p>Says <em>hello</em></p>")
+            self.assertTrue('<span class="number">1</span>' 
+                            in rendered["segments"][1][1])
+            notes_id = index["paths"]["notes.txt"]["_id"]
+            self.assertEqual(
+                self.get(notes_id.replace("-blob-", "-rendered-"))["error"],
+                "not_found")
+
+if __name__ == "__main__":
+    unittest.main()
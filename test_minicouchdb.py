@@ -0,0 +1,234 @@
+# Copyright 2011 James Ascroft-Leigh
+
+from __future__ import with_statement
+
+from jwalutil import StringIO, monkey_patch_attr
+import couchdblib
+import json
+import minicouchdb
+import posixpath
+import time
+import threading
+import unittest
+
+class MiniCouchDBTestCase(unittest.TestCase):
+
+    server_options = {}
+
+    def setUp(self):
+        self.server = minicouchdb.MiniCouchDB(**self.server_options)
+        self.server.start()
+        self.db_url = self.server.create_db("test")
+
+    def tearDown(self):
+        self.server.stop()
+
+    def url(self, doc_id):
+        return posixpath.join(self.db_url, couchdblib.url_quote(doc_id))
+
+class TestDocuments(MiniCouchDBTestCase):
+
+    def test_create_update_and_conflict(self):
+        url = self.url("a")
+        result = couchdblib.put(url, {"x": 1})
+        self.assertTrue(result["rev"].startswith("1-"))
+        self.assertEqual(couchdblib.put(url, {"x": 2})["error"], "conflict")
+        doc = couchdblib.get(url)
+        self.assertEqual((doc["_id"], doc["x"]), ("a", 1))
+        doc["x"] = 2
+        self.assertTrue(couchdblib.put(url, doc)["rev"].startswith("2-"))
+        self.assertEqual(couchdblib.get_rev(url), couchdblib.get(url)["_rev"])
+
+    def test_delete_and_recreate(self):
+        url = self.url("a")
+        couchdblib.put(url, {"x": 1})
+        couchdblib.delete(url)
+        self.assertEqual(couchdblib.get(url),
+                         {"error": "not_found", "reason": "deleted"})
+        self.assertTrue(couchdblib.put(url, {"x": 3})["rev"].startswith("3-"))
+
+    def test_put_update_and_post_new(self):
+        def increment(doc):
+            doc.setdefault("count", 0)
+            doc["count"] += 1
+        for i in range(3):
+            couchdblib.put_update(self.url("counter"), increment)
+        self.assertEqual(couchdblib.get(self.url("counter"))["count"], 3)
+        result = couchdblib.post_new(self.db_url, {"y": 1}, "new-%s")
+        self.assertEqual(couchdblib.get(self.url(result["id"]))["y"], 1)
+
+    def test_conditional_get(self):
+        couchdblib.put(self.url("a"), {"x": 1})
+        response = couchdblib.request(self.url("a"))
+        etag = response.headers["etag"]
+        response = couchdblib.request(self.url("a"),
+                                      headers=["If-None-Match: " + etag])
+        self.assertEqual(response.status, 304)
+
+class TestBulkAndListing(MiniCouchDBTestCase):
+
+    def test_bulk_docs_and_all_docs(self):
+        docs = [{"_id": "git-blob-%02d" % i, "i": i} for i in range(25)]
+        docs.append({"_id": "other"})
+        results = couchdblib.bulk_docs(self.db_url, docs)
+        self.assertEqual(len([r for r in results if "rev" in r]), 26)
+        results = couchdblib.bulk_docs(self.db_url, docs[:1])
+        self.assertEqual(results[0]["error"], "conflict")
+        rows = list(couchdblib.iter_all_docs(
+                self.db_url, page_size=4, startkey="git-",
+                endkey=u"git-\ufff0", include_docs=True))
+        self.assertEqual([r["doc"]["i"] for r in rows], range(25))
+
+    def test_all_docs_keys(self):
+        couchdblib.bulk_docs(self.db_url, [{"_id": "a"}, {"_id": "b"}])
+        rows = list(couchdblib.iter_rows(
+                posixpath.join(self.db_url, "_all_docs?include_docs=true"),
+                body={"keys": ["b", "missing"]}))
+        self.assertEqual(rows[0]["doc"]["_id"], "b")
+        self.assertEqual(rows[1], {"key": "missing", "error": "not_found"})
+
+    def test_iter_docs_uses_cache(self):
+        docs = [{"_id": "git-blob-%d" % i} for i in range(5)]
+        couchdblib.bulk_docs(self.db_url, docs)
+        previous = couchdblib.use_document_cache(couchdblib.DocumentCache())
+        try:
+            ids = [d["_id"] for d in docs]
+            first = dict(couchdblib.iter_docs(self.db_url, ids, 2))
+            requests = self.server.stats["requests"]
+            second = dict(couchdblib.iter_docs(self.db_url, ids, 2))
+        finally:
+            couchdblib.use_document_cache(previous)
+        self.assertEqual(sorted(first), ids)
+        self.assertEqual(first, second)
+        self.assertEqual(self.server.stats["requests"], requests)
+
+    def test_changes(self):
+        couchdblib.bulk_docs(self.db_url, [{"_id": "a"}, {"_id": "b"}])
+        couchdblib.put_update(self.url("a"), lambda doc: doc)
+        changes = couchdblib.get(posixpath.join(self.db_url, "_changes"))
+        self.assertEqual([(r["seq"], r["id"]) for r in changes["results"]],
+                         [(2, "b"), (3, "a")])
+        url = couchdblib.make_query_url(
+            posixpath.join(self.db_url, "_changes"),
+            {"filter": "_doc_ids", "doc_ids": '["b"]', "since": 2,
+             "feed": "longpoll"})
+        def later():
+            time.sleep(0.1)
+            couchdblib.put_update(self.url("b"), lambda doc: doc)
+        thread = threading.Thread(target=later)
+        thread.start()
+        changes = couchdblib.get(url)
+        thread.join()
+        self.assertEqual([r["id"] for r in changes["results"]], ["b"])
+
+class TestAttachments(MiniCouchDBTestCase):
+
+    def test_round_trip(self):
+        data = "".join(chr(i % 256) for i in range(200000))
+        couchdblib.put_attachment(self.url("a"), "dir/data.bin",
+                                  StringIO(data))
+        out = StringIO()
+        result = couchdblib.get_attachment(
+            couchdblib.attachment_url(self.url("a"), "dir/data.bin"), out)
+        self.assertEqual(out.getvalue(), data)
+        stub = couchdblib.get(self.url("a"))["_attachments"]["dir/data.bin"]
+        self.assertEqual(stub["digest"], "md5-" + result["md5"])
+        self.assertEqual(stub["length"], len(data))
+
+class TestViews(MiniCouchDBTestCase):
+
+    def test_paging_and_reduce(self):
+        def by_parity(doc):
+            if "i" not in doc:
+                return
+            yield [doc["i"] % 2, doc["i"]], None
+            yield doc["i"] % 2, {"_id": "linked"}
+        self.server.add_view("test", "app", "parity", by_parity, "_count")
+        docs = [{"_id": "d%02d" % i, "i": i} for i in range(10)]
+        couchdblib.bulk_docs(self.db_url, docs + [{"_id": "linked"}])
+        view = couchdblib.view_url(self.url("_design/app"), "parity")
+        rows = couchdblib.query_view(view, page_size=3, reduce=False,
+                                     startkey=1, endkey=1,
+                                     include_docs=True, stale="ok")
+        self.assertEqual([r["id"] for r in rows],
+                         ["d%02d" % i for i in range(1, 10, 2)])
+        self.assertEqual(set(r["doc"]["_id"] for r in rows), set(["linked"]))
+        rows = couchdblib.query_view(view, group_level=1,
+                                     startkey=[0], endkey=[1, {}])
+        self.assertEqual(rows, [{"key": [0], "value": 5},
+                                {"key": [1], "value": 5}])
+
+def merge(doc, req):
+    if doc is None:
+        doc = {"_id": req["id"]}
+    doc.update(json.loads(req["body"]))
+    return doc, json.dumps({"ok": True, "id": req["id"]})
+
+class TestUpdateHandlers(MiniCouchDBTestCase):
+
+    def handler_url(self, update_func):
+        self.server.add_update_handler("test", "app", "merge", update_func)
+        return posixpath.join(self.url("_design/app"), "_update/merge")
+
+    def test_put_via_handler(self):
+        couchdblib.install_update_handlers(self.url("_design/app"))
+        design_doc = couchdblib.get(self.url("_design/app"))
+        self.assertEqual(design_doc["updates"], couchdblib.UPDATE_HANDLERS)
+        url = self.handler_url(merge)
+        result = couchdblib.put_via_handler(url, "a/b", {"x": 1})
+        self.assertEqual(result["id"], "a/b")
+        result = couchdblib.put_via_handler(url, "a/b", {"y": 2})
+        doc = couchdblib.get(self.url("a/b"))
+        self.assertEqual((doc["x"], doc["y"]), (1, 2))
+        self.assertEqual(result["rev"], doc["_rev"])
+
+    def test_conflicts_are_retried(self):
+        calls = []
+        def stale_once(doc, req):
+            calls.append(doc)
+            doc, body = merge(doc, req)
+            if len(calls) == 1:
+                doc["_rev"] = "1-stale"
+            return doc, body
+        url = self.handler_url(stale_once)
+        couchdblib.put(self.url("a"), {"x": 1})
+        with monkey_patch_attr(couchdblib, "CONFLICT_COUNTS", {}):
+            couchdblib.put_via_handler(url, "a", {"y": 2})
+            self.assertEqual(couchdblib.CONFLICT_COUNTS.values(), [1])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(couchdblib.get(self.url("a"))["y"], 2)
+
+    def test_gives_up_after_max_attempts(self):
+        def always_stale(doc, req):
+            return dict(doc, _rev="1-stale"), "{}"
+        url = self.handler_url(always_stale)
+        couchdblib.put(self.url("a"), {"x": 1})
+        self.assertRaises(Exception, couchdblib.put_via_handler, url, "a",
+                          {"y": 2}, max_attempts=2)
+
+class TestThrottling(MiniCouchDBTestCase):
+
+    server_options = {"latency": 0.05, "gzip": True}
+
+    def test_latency_and_gzip(self):
+        couchdblib.put(self.url("a"), {"x": "y" * 10000})
+        start = time.time()
+        self.assertEqual(couchdblib.get(self.url("a"))["x"], "y" * 10000)
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertTrue(self.server.stats["sent"] < 1000)
+
+    def test_streamed_rows_are_counted(self):
+        docs = [{"_id": "d%03d" % i, "text": "same " * 50}
+                for i in range(200)]
+        couchdblib.bulk_docs(self.db_url, docs)
+        counts = dict((k, 0) for k in couchdblib.TRANSFER_COUNTS)
+        with monkey_patch_attr(couchdblib, "TRANSFER_COUNTS", counts):
+            rows = list(couchdblib.iter_rows(posixpath.join(
+                        self.db_url, "_all_docs?include_docs=true")))
+        self.assertEqual(len(rows), 200)
+        self.assertTrue(counts["received_wire"] > 0)
+        self.assertTrue(counts["received_wire"]
+                        < counts["received_uncompressed"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+# Copyright 2011 James Ascroft-Leigh
+
+from __future__ import with_statement
+
+from jwalutil import mkdtemp, monkey_patch_attr, read_file
+from test_couchapplib import git_documents
+import base64
+import couchdblib
+import minicouchdb
+import os
+import posixpath
+import selfcouchapp
+import time
+import unittest
+
+def blob(name, data):
+    return {"_id": "git-blob-" + name, "type": "git-blob", "sha": name,
+            "encoding": "base64", "base64": base64.b64encode(data)}
+
+def tree(name, **children):
+    return {"_id": "git-tree-" + name, "type": "git-tree", "sha": name,
+            "children": [{"basename": basename, "mode": "-rw-r--r--",
+                          "child": {"_id": child["_id"],
+                                    "type": child["type"]}}
+                         for (basename, child) in sorted(children.items())]}
+
+class TestTreeToFs(unittest.TestCase):
+
+    def setUp(self):
+        self.server = minicouchdb.MiniCouchDB()
+        self.server.start()
+        self.db_url = self.server.create_db("git")
+        shared = {"_id": "git-blob-1", "type": "git-blob", "sha": "1",
+                  "encoding": "raw", "raw": "shared\n"}
+        binary = blob("2", "\x00\xff")
+        views = tree("3", **{"map.js": shared})
+        app = tree("4", views=views, **{"a.bin": binary, "b.txt": shared})
+        root = tree("5", app=app, views=views, **{"c.txt": shared})
+        couchdblib.bulk_docs(self.db_url,
+                             [shared, binary, views, app, root])
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_one_request_per_level(self):
+        requests = self.server.stats["requests"]
+        with mkdtemp() as temp_dir:
+            out = os.path.join(temp_dir, "out")
+            selfcouchapp.tree_to_fs(self.db_url, out, "git-tree-5")
+            for path in ["c.txt", "views/map.js", "app/b.txt",
+                         "app/views/map.js"]:
+                self.assertEqual(read_file(os.path.join(out, path)),
+                                 "shared\n")
+            with open(os.path.join(out, "app", "a.bin"), "rb") as fh:
+                self.assertEqual(fh.read(), "\x00\xff")
+        self.assertEqual(self.server.stats["requests"] - requests, 4)
+
+class TestBlobCache(unittest.TestCase):
+
+    def setUp(self):
+        self.server = minicouchdb.MiniCouchDB()
+        self.server.start()
+        self.db_url = self.server.create_db("git")
+        files = [blob(str(i), "file %d\n" % (i,)) for i in range(5)]
+        changed = blob("5", "changed\n")
+        couchdblib.bulk_docs(self.db_url, files + [
+                changed,
+                tree("a", **dict(("%d.txt" % i, f) 
+                                 for (i, f) in enumerate(files))),
+                tree("b", **dict(("%d.txt" % i, f) 
+                                 for (i, f) in enumerate(files[:4] 
+                                                         + [changed])))])
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_only_new_blobs_are_fetched(self):
+        fetched = []
+        def recording_iter_docs(db_url, doc_ids):
+            fetched.extend(doc_ids)
+            return couchdblib.iter_docs(db_url, doc_ids)
+        with mkdtemp() as temp_dir:
+            cache = selfcouchapp.BlobCache(os.path.join(temp_dir, "cache"))
+            with monkey_patch_attr(selfcouchapp, "iter_docs", 
+                                   recording_iter_docs):
+                selfcouchapp.tree_to_fs(self.db_url, 
+                                        os.path.join(temp_dir, "a"),
+                                        "git-tree-a", cache)
+                del fetched[:]
+                selfcouchapp.tree_to_fs(self.db_url, 
+                                        os.path.join(temp_dir, "b"),
+                                        "git-tree-b", cache)
+            self.assertEqual(fetched, ["git-tree-b", "git-blob-5"])
+            self.assertEqual(read_file(os.path.join(temp_dir, "b", "4.txt")),
+                             "changed\n")
+            self.assertEqual(read_file(os.path.join(temp_dir, "b", "0.txt")),
+                             "file 0\n")
+
+    def test_eviction(self):
+        with mkdtemp() as temp_dir:
+            cache = selfcouchapp.BlobCache(temp_dir, max_bytes=10)
+            for i in range(3):
+                cache.add("git-blob-%d" % (i,), "12345")
+                os.utime(cache._path("git-blob-%d" % (i,)), (i, i))
+            cache.materialize("git-blob-0", os.path.join(temp_dir, "x"))
+            cache.evict()
+            self.assertEqual(sorted(os.listdir(cache.blob_dir)),
+                             ["git-blob-0", "git-blob-2"])
+
+class TestBranchFollower(unittest.TestCase):
+
+    def setUp(self):
+        self.server = minicouchdb.MiniCouchDB()
+        self.server.start()
+        self.db_url = self.server.create_db("git")
+        self.put_branches(["a", "b"])
+        self.put_branch("a", {"index.html": "a"})
+        self.put_branch("b", {"index.html": "b"})
+
+    def tearDown(self):
+        self.server.stop()
+
+    def put_branches(self, names):
+        couchdblib.put_update(
+            posixpath.join(self.db_url, "git-branches"),
+            lambda doc: {"type": "git-branches", "branches": [
+                    {"_id": "git-branch-" + n, "type": "git-branch", 
+                     "branch": n} for n in names]})
+
+    def put_branch(self, name, attachments):
+        files = dict(("_attachments/" + k, v) 
+                     for (k, v) in attachments.items())
+        tree_id, documents = git_documents(files)
+        commit_id = "git-commit-" + tree_id
+        documents.append({"_id": commit_id, "type": "git-commit",
+                          "tree": {"_id": tree_id, "type": "git-tree"}})
+        for document in documents:
+            couchdblib.put_update(posixpath.join(self.db_url, 
+                                                 document["_id"]),
+                                  lambda doc, d=document: d)
+        couchdblib.put_update(
+            posixpath.join(self.db_url, "git-branch-" + name),
+            lambda doc: {"type": "git-branch", "branch": name,
+                         "commit": {"_id": commit_id, 
+                                    "type": "git-commit"}})
+
+    def design_doc(self, name):
+        return couchdblib.get(posixpath.join(self.db_url, 
+                                             "_design/git-branch-" + name))
+
+    def test_follows_branch_changes(self):
+        follower = selfcouchapp.BranchFollower(self.db_url, self.db_url,
+                                               None, ".")
+        follower.start()
+        revs = dict((n, self.design_doc(n)["_rev"]) for n in "ab")
+        self.put_branch("a", {"index.html": "a2"})
+        follower.step(timeout=5)
+        self.assertNotEqual(self.design_doc("a")["_rev"], revs["a"])
+        self.assertEqual(self.design_doc("b")["_rev"], revs["b"])
+        self.put_branches(["a"])
+        follower.step(timeout=5)
+        self.assertEqual(self.design_doc("b").get("error"), "not_found")
+        self.assertEqual(follower.branches, ["git-branch-a"])
+
+class TestDeployBranches(unittest.TestCase):
+
+    def test_failures_are_isolated(self):
+        deployed = []
+        def deploy(branch):
+            if branch == "bad":
+                raise Exception("Just testing")
+            time.sleep(0.1)
+            deployed.append(branch)
+            return "updated"
+        start = time.time()
+        with monkey_patch_attr(selfcouchapp.traceback, "print_exc",
+                               lambda: None):
+            results = selfcouchapp.deploy_branches(
+                ["a", "bad", "b", "c"], deploy, parallelism=3)
+        self.assertTrue(time.time() - start < 0.3)
+        self.assertEqual(sorted(deployed), ["a", "b", "c"])
+        self.assertEqual(results["a"][0], "updated")
+        self.assertEqual(selfcouchapp.failed_branches(results), ["bad"])
+
+if __name__ == "__main__":
+    unittest.main()